@@ -0,0 +1,104 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""
+Evaluate policies from an event loop.
+
+Rules with an `approve_request_async` or `use_quota_async` method are awaited, so db-backed
+rules don't block the loop.  Other rules, like time ranges and profile ids, are cheap
+and are called directly.
+
+```
+engine = RuleEngine.from_yml_file("policy.yml")
+rs_id = await approve_engine(engine, request)
+```
+"""
+
+import asyncio
+import logging
+import weakref
+from typing import Dict, Optional, Union
+
+from atakama import ApprovalRequest, RulePlugin, RuleSet, RuleTree, RuleEngine
+
+log = logging.getLogger(__name__)
+
+# RuleSet evaluation is serialized per event loop, like the lock in RuleSet.approve_request
+_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[int, asyncio.Lock]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _set_lock(rule_set: RuleSet) -> asyncio.Lock:
+    locks = _locks.setdefault(asyncio.get_running_loop(), {})
+    lock = locks.get(id(rule_set))
+    if lock is None:
+        lock = locks[id(rule_set)] = asyncio.Lock()
+        weakref.finalize(rule_set, locks.pop, id(rule_set), None)
+    return lock
+
+
+async def approve_request(rule: RulePlugin, request: ApprovalRequest) -> Optional[bool]:
+    """Awaits rule.approve_request_async if the rule has one, otherwise calls approve_request."""
+    func = getattr(rule, "approve_request_async", None)
+    if func is None:
+        return rule.approve_request(request)
+    return await func(request)
+
+
+async def use_quota(rule: RulePlugin, request: ApprovalRequest):
+    """Awaits rule.use_quota_async if the rule has one, otherwise calls use_quota."""
+    func = getattr(rule, "use_quota_async", None)
+    if func is None:
+        return rule.use_quota(request)
+    return await func(request)
+
+
+async def approve_rule_set(rule_set: RuleSet, request: ApprovalRequest) -> bool:
+    """Same as RuleSet.approve_request: all rules must approve, then quotas are used."""
+    async with _set_lock(rule_set):
+        for i, rule in enumerate(rule_set):
+            try:
+                res = await approve_request(rule, request)
+                log.debug(
+                    "approve_rule_set[%s]: rule_id=%s i=%i res=%s",
+                    request.request_type,
+                    rule.rule_id,
+                    i,
+                    res,
+                )
+                if res is None:
+                    log.error("unknown request type error in rule %s", rule)
+                if not res:
+                    return False
+            except Exception as ex:  # pylint: disable=broad-except
+                log.error("error in rule %s: %s", rule, repr(ex))
+                return False
+
+        for rule in rule_set:
+            try:
+                await use_quota(rule, request)
+            except Exception as ex:  # pylint: disable=broad-except
+                log.error("error in rule use_quota %s: %s", rule, repr(ex))
+                return False
+    return True
+
+
+async def approve_rule_tree(
+    tree: RuleTree, request: ApprovalRequest
+) -> Union[bool, int]:
+    """Same as RuleTree.approve_request: the id of the first approving set, or False."""
+    for rule_set in tree:
+        if await approve_rule_set(rule_set, request):
+            return id(rule_set)
+    return False
+
+
+async def approve_engine(
+    engine: RuleEngine, request: ApprovalRequest
+) -> Optional[Union[bool, int]]:
+    """Same as RuleEngine.approve_request, None if there's no tree for the request type."""
+    tree = engine.map.get(request.request_type, None)
+    if tree is None:
+        return None
+    return await approve_rule_tree(tree, request)
@@ -1,12 +1,207 @@
 # SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
 # SPDX-License-Identifier: LGPL-3.0-or-later
 
+import functools
 import re
-from typing import Optional, List, Tuple, Pattern
+from typing import Optional, List, Tuple, Pattern, Dict, Sequence, Iterable, Set
 
-from atakama import RulePlugin, ApprovalRequest
+from atakama import RulePlugin, ApprovalRequest, MetaInfo
 
 MINIMUM_WORD_COUNT = 4
+# bounds memory used to skip repeated entries in a single match_many call
+DEDUPE_LIMIT = 4096
+
+
+class _Node:  # pylint: disable=too-few-public-methods
+    __slots__ = ("children", "globs", "any_id", "dir_id")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        # component wildcard -> (its regex, node)
+        self.globs: Dict[str, Tuple[Pattern, "_Node"]] = {}
+        # lowest entry ending here, and lowest entry ending here that must be a parent dir
+        self.any_id: Optional[int] = None
+        self.dir_id: Optional[int] = None
+
+    def insert(self, comps: Sequence[str], i: int, is_dir: bool, flags: int):
+        node = self
+        for comp in comps:
+            if "*" in comp:
+                ent = node.globs.get(comp)
+                if ent is None:
+                    ent = node.globs[comp] = (
+                        re.compile(_glob_regex(comp), flags),
+                        _Node(),
+                    )
+                node = ent[1]
+            else:
+                node = node.children.setdefault(comp, _Node())
+        if is_dir:
+            node.dir_id = _min_id(node.dir_id, i)
+        else:
+            node.any_id = _min_id(node.any_id, i)
+
+
+def _step(nodes: List[_Node], comp: str) -> List[_Node]:
+    """The nodes reached from nodes by a component."""
+    if len(nodes) == 1 and not nodes[0].globs:
+        # the usual case, no wildcards
+        node = nodes[0].children.get(comp)
+        return [] if node is None else [node]
+    reached = []
+    for node in nodes:
+        child = node.children.get(comp)
+        if child is not None:
+            reached.append(child)
+        for glob, child in node.globs.values():
+            if glob.fullmatch(comp):
+                reached.append(child)
+    return reached
+
+
+def _glob_regex(path: str) -> str:
+    # "*" matches within a path component
+    return re.escape(path).replace("\\*", "[^/]*")
+
+
+def _min_id(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+class _PathIndex:
+    """Path entries, matched by walking the components of the metadata.
+
+    Anchored paths are a trie from the root, subpaths are a trie tried at each
+    component, basenames are a dict lookup of the last component.  Components with
+    wildcards are matched by regex at their node in the trie, several nodes can be
+    followed at once.
+    """
+
+    def __init__(self, flags: int):
+        self.__flags = flags
+        self.__anchored = _Node()
+        self.__subpaths = _Node()
+        self.__basenames: Dict[str, int] = {}
+        self.__basename_globs: List[Tuple[int, Pattern]] = []
+
+    def __bool__(self):
+        return bool(
+            self.__anchored.children
+            or self.__anchored.globs
+            or self.__subpaths.children
+            or self.__subpaths.globs
+            or self.__basenames
+            or self.__basename_globs
+        )
+
+    def add(self, i: int, path: str):
+        # same semantics as the regexes built by MetaRule.__comp_path
+        if path[0] == "/":
+            comps = path.rstrip("/").split("/")
+            self.__anchored.insert(comps, i, False, self.__flags)
+        elif "/" in path:
+            is_dir = path.endswith("/")
+            comps = path.rstrip("/").split("/")
+            self.__subpaths.insert(comps, i, is_dir, self.__flags)
+        elif "*" in path:
+            self.__basename_globs.append(
+                (i, re.compile(_glob_regex(path), self.__flags))
+            )
+        elif self.__basenames.get(path, i) >= i:
+            self.__basenames[path] = i
+
+    def first(self, comps: List[str]) -> Optional[int]:
+        best = self.__basenames.get(comps[-1])
+        for i, glob in self.__basename_globs:
+            if best is not None and i > best:
+                break
+            if glob.fullmatch(comps[-1]):
+                best = i
+                break
+
+        nodes = [self.__anchored]
+        for comp in comps:
+            nodes = _step(nodes, comp)
+            if not nodes:
+                break
+            for node in nodes:
+                best = _min_id(best, node.any_id)
+
+        if self.__subpaths.children or self.__subpaths.globs:
+            # subpaths must follow a "/", so they can't start at the first component
+            num = len(comps)
+            for start in range(1, num):
+                nodes = [self.__subpaths]
+                for end in range(start, num):
+                    nodes = _step(nodes, comps[end])
+                    if not nodes:
+                        break
+                    for node in nodes:
+                        best = _min_id(best, node.any_id)
+                        if end + 1 < num:
+                            best = _min_id(best, node.dir_id)
+
+        return best
+
+
+class _FirstMatch:
+    """Finds the lowest numbered entry that matches a string.
+
+    Paths are looked up in a _PathIndex.
+
+    Other patterns are also combined into one regex, an alternation of them all, which
+    finds whether any of them match in a single search.  Only when the order matters are
+    strings that match it searched for with each pattern in order.
+    """
+
+    def __init__(self, flags: int):
+        self.flags = flags
+        self.paths = _PathIndex(flags)
+        self.__entries: List[Tuple[int, Pattern]] = []
+        self.__any: Optional[Pattern] = None
+        self.__has_paths = False
+
+    def add_regex(self, i: int, comp: Pattern):
+        self.__entries.append((i, comp))
+
+    def compile(self):
+        self.__has_paths = bool(self.paths)
+        alts = []
+        for _, comp in self.__entries:
+            if comp.groups:
+                # numbered groups and backrefs would shift, and groups stop re from
+                # skipping ahead to where an alternative could start
+                return
+            alts.append("(?:%s)" % comp.pattern)
+        if alts:
+            try:
+                self.__any = re.compile("|".join(alts), self.flags)
+            except re.error:
+                # inline flags, etc. can't be combined, fall back to the loop
+                pass
+
+    def any(self, norm: str, comps: List[str]) -> bool:
+        """Whether any entry matches, one search of the combined regex if there is one."""
+        if self.__has_paths and self.paths.first(comps) is not None:
+            return True
+        if self.__any is not None:
+            return self.__any.search(norm) is not None
+        return any(comp.search(norm) for _, comp in self.__entries)
+
+    def first(self, norm: str, comps: List[str]) -> Optional[int]:
+        best = self.paths.first(comps) if self.__has_paths else None
+        if self.__any is not None and not self.__any.search(norm):
+            return best
+        for i, comp in self.__entries:
+            if best is not None and i > best:
+                break
+            if comp.search(norm):
+                return i
+        return best
 
 
 class MetaRule(RulePlugin):
@@ -20,6 +215,7 @@ class MetaRule(RulePlugin):
         - list of regexes
      - case_sensitive: true or false
      - require_complete: require paths to have complete, validated metadata
+     - cache_size: number of recent metadata results to remember, default 0 (no cache)
     ```
     Example:
         - rule: meta-rule
@@ -61,9 +257,8 @@ class MetaRule(RulePlugin):
     def __comp_path(self, path) -> Tuple[Pattern, bool]:
         invert, flags, path = self.__precomp(path)
         if path[0] == "*":
-            path = re.escape(path[1:])
-            path = path.replace("\\*", "[^/]*")
-            regex = f".*{path}"
+            # searched for, so a leading .* would only add backtracking
+            regex = _glob_regex(path[1:])
         elif path[0] == "/":
             if path.endswith("/"):
                 path = path.rstrip("/")
@@ -96,48 +291,116 @@ class MetaRule(RulePlugin):
 
         return comp, invert
 
+    def __indexed_path(self, path) -> Optional[Tuple[str, bool]]:
+        invert, _, path = self.__precomp(path)
+        if path[0] == "*":
+            return None
+        if not self.__sensitive:
+            # lower() only agrees with re.I for ascii
+            if not path.isascii():
+                return None
+            path = path.lower()
+        return path, invert
+
     def __init__(self, args):
         # partial strings can match or not, depending on whether they contain the necessary info
         self.__require_complete = args.get("require_complete", False)
         self.__sensitive = args.get("case_sensitive", False)
-        self.__regexes: List[Tuple[Pattern, bool]] = []
+        flags = 0 if self.__sensitive else re.I
+        self.__matcher = _FirstMatch(flags)
+        self.__inverted = _FirstMatch(flags)
+        self.__first_inverted: Optional[int] = None
+
+        num = 0
         for regex in args.get("regexes", []):
-            comp = self.__comp_regex(regex)
-            self.__regexes.append(comp)
+            comp, invert = self.__comp_regex(regex)
+            self.__add_entry(num, invert).add_regex(num, comp)
+            num += 1
 
         for path in args.get("paths", []):
-            comp = self.__comp_path(path)
-            self.__regexes.append(comp)
+            indexed = self.__indexed_path(path)
+            if indexed:
+                path, invert = indexed
+                self.__add_entry(num, invert).paths.add(num, path)
+            else:
+                comp, invert = self.__comp_path(path)
+                self.__add_entry(num, invert).add_regex(num, comp)
+            num += 1
+
+        self.__matcher.compile()
+        self.__inverted.compile()
+
+        # entries never change after init, so results can be cached by metadata
+        self.__cache = None
+        self.__verdict = self.__meta_match
+        cache_size = args.get("cache_size", 0)
+        if cache_size:
+            self.__cache = functools.lru_cache(maxsize=cache_size)(self.__meta_match)
+            self.__verdict = self.__cache
         super().__init__(args)
 
-    def approve_request(self, request: ApprovalRequest) -> Optional[bool]:
+    def cache_info(self):
+        """Returns hits, misses, maxsize and currsize of the cache, or None if not enabled."""
+        return self.__cache.cache_info() if self.__cache else None
+
+    def __add_entry(self, i: int, invert: bool) -> _FirstMatch:
+        if not invert:
+            return self.__matcher
+        if self.__first_inverted is None:
+            self.__first_inverted = i
+        return self.__inverted
+
+    def __match(self, norm: str) -> bool:
+        # same result as checking each entry in order:
+        #   the first matching entry approves, unless it's inverted
+        #   a non-matching inverted entry approves, unless a later inverted entry matches first
+        comps = norm.split("/")
+        inv = self.__inverted.first(norm, comps)
+        if inv is None:
+            return self.__first_inverted is not None or self.__matcher.any(norm, comps)
+        if inv != self.__first_inverted:
+            return True
+        pos = self.__matcher.first(norm, comps)
+        return pos is not None and pos < inv
+
+    def __meta_match(self, norm: str, complete: bool) -> bool:
+        assert norm[0] != "/"
+        if complete:
+            norm = "/" + norm
+        return self.__match(norm)
+
+    def match_many(self, metas: Iterable[MetaInfo]) -> bool:
+        """Returns True if all metadata entries match, False at the first that doesn't.
+
+        An empty list does not match.
+
+        Any iterable is accepted, and generators are consumed one entry at a time.
+        Repeated entries are only matched once.
+        """
+        require_complete = self.__require_complete
+        sensitive = self.__sensitive
+        verdict = self.__verdict
+        seen: Set[Tuple[str, bool]] = set()
         has_meta = False
-        for meta in request.auth_meta:
-            if self.__require_complete and not meta.complete:
+        for meta in metas:
+            complete = meta.complete
+            if require_complete and not complete:
                 return False
-            should_approve = False
             has_meta = True
 
-            norm = meta.meta
-            if not self.__sensitive:
-                norm = norm.lower()
+            key = (meta.meta, complete)
+            if key in seen:
+                continue
 
-            assert norm[0] != "/"
-            if meta.complete:
-                norm = "/" + norm
-
-            for regex, invert in self.__regexes:
-                res = regex.search(norm)
-                if invert:
-                    if res:
-                        break
-                    should_approve = True
-                else:
-                    if res:
-                        should_approve = True
-                        break
-
-            if not should_approve:
+            norm = meta.meta if sensitive else meta.meta.lower()
+            if not verdict(norm, complete):
                 return False
 
+            if len(seen) >= DEDUPE_LIMIT:
+                seen.clear()
+            seen.add(key)
+
         return has_meta
+
+    def approve_request(self, request: ApprovalRequest) -> Optional[bool]:
+        return self.match_many(request.auth_meta)
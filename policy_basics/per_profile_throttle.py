@@ -1,17 +1,38 @@
 # SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
 # SPDX-License-Identifier: LGPL-3.0-or-later
+# pylint: disable=too-many-lines
 
 import os
 import json
+import random
+import struct
+import threading
 import time
 from datetime import datetime
 
 import logging
-from typing import Optional, Union
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 from atakama import RulePlugin, ApprovalRequest, ProfileInfo
 
-from policy_basics.simple_db import UriDb, MemoryDb
+from policy_basics.simple_db import (
+    AbstractDb,
+    UriDb,
+    CounterDb,
+    WriteBehindDb,
+    AsyncDb,
+)
+from policy_basics.shared_db import PackedMemoryDb, SharedMemoryDb, MmapDb
+from policy_basics.redis_db import RedisDb
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
@@ -21,6 +42,10 @@ LOCAL_TIMEZONE = datetime.now().astimezone().tzinfo
 INFINITE = -1
 # A mofnop times out in 60 seconds. Allow 30 seconds of clock skew. => 90 second default
 DEFAULT_EXPIRY_TIME = 90
+HOUR_SECS = 3600
+# profiles counted by a non-persistent rule, the least recently used are dropped
+DEFAULT_MAX_ENTRIES = 100000
+DAY_SECS = 86400
 
 
 class Timer:
@@ -36,6 +61,12 @@ class Timer:
 class ProfileCount:
     hour_cnt: int = 0
     day_cnt: int = 0
+    # set on a new count that replaces invalid data
+    invalid: bool = False
+    # changed on every compare-and-swap write of persistent counts
+    version: int = 0
+    # the db value last written for these counts, so a swap can skip reading it back
+    stored = None
 
     def __init__(
         self,
@@ -64,10 +95,12 @@ class ProfileCount:
         self._ts = Timer.time()
         self.hour_cnt = int(hour_cnt)
         self.day_cnt = int(day_cnt)
+        self.lock_value = self._live_lock(timestamp, lock_value, expiry_secs)
+
+    def _live_lock(self, timestamp, lock_value, expiry_secs) -> Optional[str]:
         if timestamp and timestamp + expiry_secs < self._ts:
-            self.lock_value = None
-        else:
-            self.lock_value = lock_value
+            return None
+        return lock_value
 
     @staticmethod
     def from_dict(dat, expiry_secs=DEFAULT_EXPIRY_TIME):
@@ -79,9 +112,12 @@ class ProfileCount:
             expiry_secs=expiry_secs,
         )
 
-    @staticmethod
-    def from_str(dat: str, expiry_secs=DEFAULT_EXPIRY_TIME):
-        return ProfileCount.from_dict(json.loads(dat), expiry_secs=expiry_secs)
+    @classmethod
+    def from_str(cls, dat: str, expiry_secs=DEFAULT_EXPIRY_TIME, **kws):
+        dct = json.loads(dat)
+        pc = cls.from_dict(dct, expiry_secs=expiry_secs, **kws)
+        pc.version = int(dct.get("v", 0))
+        return pc
 
     def to_dict(self, lock_value: str = None):
         ret = {"tm": self._ts, "hr": self.hour_cnt, "dy": self.day_cnt}
@@ -90,52 +126,577 @@ class ProfileCount:
         return ret
 
     def to_str(self, lock_value: str = None) -> str:
-        return self._dict_to_str(self.to_dict(lock_value))
+        dct = self.to_dict(lock_value)
+        if self.version:
+            dct["v"] = self.version
+        return self._dict_to_str(dct)
 
     @staticmethod
     def _dict_to_str(dct) -> str:
         return json.dumps(dct)
 
+    @staticmethod
+    def from_row(row: dict, expiry_secs=DEFAULT_EXPIRY_TIME):
+        pc = ProfileCount(
+            row["ts"],
+            row["hour_cnt"],
+            row["day_cnt"],
+            row.get("lk", None),
+            expiry_secs=expiry_secs,
+        )
+        pc.version = row.get("ver", 0)
+        return pc
+
+    def to_row(self, lock_value: str = None) -> dict:
+        return {
+            "ts": self._ts,
+            "hour_cnt": self.hour_cnt,
+            "day_cnt": self.day_cnt,
+            "lk": lock_value,
+            "ver": self.version,
+        }
+
+    # packed counts all start with the ts
+    TS = struct.Struct("<d")
+    # ts, hour count, day count, locked
+    _PACKED = struct.Struct("<dIIB")
+
+    @staticmethod
+    def from_bytes(data: bytes, lock_value=None, expiry_secs=DEFAULT_EXPIRY_TIME):
+        """Locks are stored as a flag, lock_value is the lock of a row that has it set."""
+        ts, hour_cnt, day_cnt, locked = ProfileCount._PACKED.unpack(data)
+        return ProfileCount(
+            ts,
+            hour_cnt,
+            day_cnt,
+            lock_value if locked else None,
+            expiry_secs=expiry_secs,
+        )
+
+    def to_bytes(self, lock_value: str = None) -> bytes:
+        return self._PACKED.pack(
+            self._ts, self.hour_cnt, self.day_cnt, lock_value is not None
+        )
+
     def increment(self):
         self.hour_cnt += 1
         self.day_cnt += 1
 
+    def within_quota(self, per_hour, per_day) -> bool:
+        return (per_day == INFINITE or self.day_cnt < per_day) and (
+            per_hour == INFINITE or self.hour_cnt < per_hour
+        )
+
+
+def _slide(timestamp, now, length, cur, prev):
+    """Moves the counts of fixed length windows forward to the window containing now."""
+    passed = int(now // length) - int(timestamp // length)
+    if passed <= 0:
+        return cur, prev
+    if passed == 1:
+        return 0, cur
+    return 0, 0
+
+
+def _estimate(now, length, cur, prev) -> float:
+    """Requests in the last length seconds, if the previous window's were spread evenly."""
+    return cur + prev * (1 - (now % length) / length)
+
+
+class SlidingCount(ProfileCount):  # pylint: disable=too-many-instance-attributes
+    """Counts for the current hour and day windows, and the ones before them.
+
+    hour_cnt and day_cnt are estimates of the requests in the last hour and day, so limits
+    free up gradually, instead of all at once at the top of the hour.
+    """
+
+    def __init__(
+        self,
+        timestamp=None,
+        hour_cnt=0,
+        day_cnt=0,
+        lock_value: Optional[str] = None,
+        expiry_secs: float = DEFAULT_EXPIRY_TIME,
+        *,
+        prev_hour=0,
+        prev_day=0,
+    ):
+        # pylint: disable=super-init-not-called,too-many-arguments
+        self._ts = Timer.time()
+        self.cur_hour, self.prev_hour = int(hour_cnt), int(prev_hour)
+        self.cur_day, self.prev_day = int(day_cnt), int(prev_day)
+        if timestamp:
+            self.cur_hour, self.prev_hour = _slide(
+                timestamp, self._ts, HOUR_SECS, self.cur_hour, self.prev_hour
+            )
+            self.cur_day, self.prev_day = _slide(
+                timestamp, self._ts, DAY_SECS, self.cur_day, self.prev_day
+            )
+        self.lock_value = self._live_lock(timestamp, lock_value, expiry_secs)
+        self.__estimate()
+
+    def __estimate(self):
+        self.hour_cnt = _estimate(self._ts, HOUR_SECS, self.cur_hour, self.prev_hour)
+        self.day_cnt = _estimate(self._ts, DAY_SECS, self.cur_day, self.prev_day)
+
+    @staticmethod
+    def from_dict(dat, expiry_secs=DEFAULT_EXPIRY_TIME):
+        return SlidingCount(
+            dat["tm"],
+            dat["hr"],
+            dat["dy"],
+            dat.get("lk", None),
+            expiry_secs=expiry_secs,
+            prev_hour=dat.get("ph", 0),
+            prev_day=dat.get("pd", 0),
+        )
+
+    def to_dict(self, lock_value: str = None):
+        ret = {
+            "tm": self._ts,
+            "hr": self.cur_hour,
+            "dy": self.cur_day,
+            "ph": self.prev_hour,
+            "pd": self.prev_day,
+        }
+        if lock_value is not None:
+            ret["lk"] = lock_value
+        return ret
+
+    # ts, current and previous hour counts, current and previous day counts, locked
+    _PACKED = struct.Struct("<dIIIIB")
+
+    @staticmethod
+    def from_bytes(data: bytes, lock_value=None, expiry_secs=DEFAULT_EXPIRY_TIME):
+        (
+            ts,
+            cur_hour,
+            prev_hour,
+            cur_day,
+            prev_day,
+            locked,
+        ) = SlidingCount._PACKED.unpack(data)
+        return SlidingCount(
+            ts,
+            cur_hour,
+            cur_day,
+            lock_value if locked else None,
+            expiry_secs=expiry_secs,
+            prev_hour=prev_hour,
+            prev_day=prev_day,
+        )
+
+    def to_bytes(self, lock_value: str = None) -> bytes:
+        return self._PACKED.pack(
+            self._ts,
+            self.cur_hour,
+            self.prev_hour,
+            self.cur_day,
+            self.prev_day,
+            lock_value is not None,
+        )
+
+    def increment(self):
+        self.cur_hour += 1
+        self.cur_day += 1
+        self.__estimate()
+
+
+class TokenBucket(ProfileCount):
+    """Tokens refill at rate per hour, up to burst, and each request takes one.
+
+    hour_cnt and day_cnt are the tokens used, for logging.
+    """
+
+    def __init__(
+        self,
+        timestamp=None,
+        tokens=None,
+        lock_value: Optional[str] = None,
+        expiry_secs: float = DEFAULT_EXPIRY_TIME,
+        *,
+        rate: float,
+        burst: float,
+    ):
+        # pylint: disable=super-init-not-called,too-many-arguments
+        self._ts = Timer.time()
+        self.burst = burst
+        if timestamp and tokens is not None:
+            elapsed = max(0.0, self._ts - timestamp)
+            self.tokens = min(burst, tokens + elapsed * rate / HOUR_SECS)
+        else:
+            self.tokens = burst
+        self.lock_value = self._live_lock(timestamp, lock_value, expiry_secs)
+        self.hour_cnt = self.day_cnt = burst - self.tokens
+
+    @staticmethod
+    def from_dict(  # pylint: disable=arguments-differ
+        dat, expiry_secs=DEFAULT_EXPIRY_TIME, *, rate, burst
+    ):
+        return TokenBucket(
+            dat["tm"],
+            dat.get("tk", None),
+            dat.get("lk", None),
+            expiry_secs=expiry_secs,
+            rate=rate,
+            burst=burst,
+        )
 
-class ProfileThrottleDb:
-    db: Union[MemoryDb, UriDb]
+    def to_dict(self, lock_value: str = None):
+        ret = {"tm": self._ts, "tk": self.tokens}
+        if lock_value is not None:
+            ret["lk"] = lock_value
+        return ret
+
+    # ts, tokens, locked
+    _PACKED = struct.Struct("<ddB")
+
+    @staticmethod
+    def from_bytes(  # pylint: disable=arguments-differ
+        data: bytes,
+        lock_value=None,
+        expiry_secs=DEFAULT_EXPIRY_TIME,
+        *,
+        rate,
+        burst,
+    ):
+        ts, tokens, locked = TokenBucket._PACKED.unpack(data)
+        return TokenBucket(
+            ts,
+            tokens,
+            lock_value if locked else None,
+            expiry_secs=expiry_secs,
+            rate=rate,
+            burst=burst,
+        )
+
+    def to_bytes(self, lock_value: str = None) -> bytes:
+        return self._PACKED.pack(self._ts, self.tokens, lock_value is not None)
+
+    def increment(self):
+        self.tokens -= 1
+        self.hour_cnt = self.day_cnt = self.burst - self.tokens
+
+    def within_quota(self, per_hour, per_day) -> bool:
+        return self.tokens >= 1
+
+
+_WINDOWS = {
+    "calendar": ProfileCount,
+    "sliding": SlidingCount,
+    "token_bucket": TokenBucket,
+}
+
+# dbs opened by throttles, shared by those with the same settings:
+# key -> [db, stale_secs of each user]
+_stores: Dict[tuple, list] = {}
+_stores_lock = threading.Lock()
+
+
+def _open_store(
+    key: tuple, opener: Callable[[], AbstractDb], stale_secs: float
+) -> AbstractDb:
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = [opener(), []]
+        store[1].append(stale_secs)
+        return store[0]
+
+
+def _release_store(key: tuple, stale_secs: float):
+    with _stores_lock:
+        store = _stores[key]
+        store[1].remove(stale_secs)
+        if store[1]:
+            return
+        del _stores[key]
+    store[0].close()
+
+
+def _store_stale_secs(key: tuple) -> float:
+    """Longest any user of the store keeps rows, rows older than this are no use to any."""
+    with _stores_lock:
+        return max(_stores[key][1])
+
+
+class ProfileThrottleDb:  # pylint: disable=too-many-instance-attributes
+    db: Union[
+        PackedMemoryDb, SharedMemoryDb, MmapDb, RedisDb, UriDb, CounterDb, WriteBehindDb
+    ]
+
+    MMAP_SCHEME = "mmap:"
+    REDIS_SCHEMES = ("redis:", "rediss:")
+    # packed counts in a shared table are followed by the lock value, zeros if unlocked
+    LOCK_SIZE = 8
 
     def __init__(self, args):
-        self.lock_value = os.urandom(8).hex()
+        self.lock_value = os.urandom(self.LOCK_SIZE).hex()
+        self.rule_id = args.get("rule_id")
         self.expiry_secs = args.get("expiry_secs", DEFAULT_EXPIRY_TIME)
-        if not args.get("persistent", False):
-            self.db = MemoryDb()
-        else:
-            uri = args.get("db-uri")
-            kws = {}
-            if args.get("db-table"):
-                kws["table"] = args.get("db-table")
-            path = (
-                str(args.get("db-file", os.path.expanduser("~/profile-throttle.db")))
-                if not uri
-                else None
+        # atomic: counts are checked and incremented in one statement
+        self.atomic = args.get("atomic", False)
+        uri = args.get("db-uri")
+        mmap_path = (
+            uri[len(self.MMAP_SCHEME) :]
+            if uri and uri.startswith(self.MMAP_SCHEME)
+            else None
+        )
+        # in memory counts are packed, and only this db uses them, unless shared
+        self.packed = not args.get("persistent", False) or bool(mmap_path)
+        self.shared = bool(args.get("shared-memory") or mmap_path)
+        self.redis = not self.packed and bool(
+            uri and uri.startswith(self.REDIS_SCHEMES)
+        )
+        # columns: counts are typed columns, not json
+        self.columns = args.get("columns", False) or (
+            self.atomic and not self.packed and not self.redis
+        )
+        assert not (self.redis and self.columns), "columns requires a sql db"
+        self.window = args.get("window", "calendar")
+        assert self.window in _WINDOWS, f"unknown window: {self.window}"
+        assert self.window == "calendar" or not (
+            self.columns or self.redis and self.atomic
+        ), "persistent atomic and columns require calendar windows"
+        self.count_class = _WINDOWS[self.window]
+        self.count_args = {}
+        # rows older than this are the same as no row: two days covers calendar days with
+        # a dst change, and the day before for sliding windows.  The db may be shared by
+        # rules with other windows, so this is the most for any calendar or sliding rule.
+        self.stale_secs = max(2 * DAY_SECS, self.expiry_secs)
+        if self.window == "token_bucket":
+            rate = args["rate"]
+            self.count_args = {"rate": rate, "burst": args.get("burst", rate)}
+            if rate > 0:
+                refill_secs = self.count_args["burst"] * HOUR_SECS / rate
+                self.stale_secs = max(self.stale_secs, refill_secs)
+        # rows written by someone else meanwhile, or leased to them, are retried
+        self.cas_tries = args.get("cas-retries", 6)
+        self.cas_backoff_secs = args.get("cas-backoff-secs", 0.005)
+        # number of retries so far, for monitoring contention
+        self.cas_retries = 0
+        self.__retries_lock = threading.Lock()
+        self.sweep_secs = args.get("sweep-secs", 3600)
+        self.sweep_rows = args.get("sweep-rows", 1000)
+        self.max_rows: Optional[int] = args.get("max-rows")
+        self.__next_sweep = time.monotonic() + self.sweep_secs
+        self.__sweep_lock = threading.Lock()
+        self.__sweeper: Optional[threading.Thread] = None
+        self.__store_key: Optional[tuple] = None
+        self.db = self.__open_db(args, mmap_path)
+        self.aio = AsyncDb(self.db)
+
+    def __open_db(self, args, mmap_path) -> AbstractDb:
+        if self.packed:
+            return self.__packed_db(args, mmap_path)
+        if self.redis:
+            uri = args["db-uri"]
+            prefix = args.get("db-prefix", "policy_basics:")
+            # there is no sweep, rows expire instead
+            return self.__open_store(
+                (RedisDb, uri, prefix, self.stale_secs),
+                lambda: RedisDb(uri, prefix=prefix, ttl_secs=int(self.stale_secs)),
             )
-            try:
-                self.db = UriDb(path=path, uri=uri, **kws)
-            except Exception as ex:  # pylint: disable=broad-except
-                if path:
-                    # deal with corruption by recovering
-                    log.error("unable to open %s: %s", path, repr(ex))
-                    # save the old one, maybe for debugging or something
-                    os.replace(path, path + ".old")
-                    self.db = UriDb(path)
-                else:
-                    raise
+        return self.__sql_db(args)
+
+    def __sql_db(self, args) -> Union[UriDb, CounterDb, WriteBehindDb]:
+        uri = args.get("db-uri")
+        db_class = CounterDb if self.columns else UriDb
+        kws = {}
+        json_table = args.get("db-table") or UriDb.TABLE_NAME
+        if args.get("db-table"):
+            # the columns table is a different table from the json one, moved from it
+            kws["table"] = (
+                "%s_%s" % (json_table, CounterDb.TABLE_NAME)
+                if self.columns
+                else json_table
+            )
+        if args.get("db-pool-size"):
+            kws["pool_size"] = args.get("db-pool-size")
+        path = (
+            str(args.get("db-file", os.path.expanduser("~/profile-throttle.db")))
+            if not uri
+            else None
+        )
+        store_key = (
+            db_class,
+            path and os.path.abspath(path),
+            uri,
+            *sorted(kws.items()),
+        )
+        db = self.__open_store(
+            store_key, lambda: self.__open_sql(db_class, path, uri, kws)
+        )
+        if self.columns and args.get("rule_id"):
+            # before any write-behind, which can't migrate
+            self.db = db
+            self.migrate(args["rule_id"], json_table)
+        if args.get("write-behind"):
+            assert not self.atomic, "atomic can't be used with write-behind"
+            db = WriteBehindDb(
+                db,
+                close_backing=False,
+                max_staleness=args.get("write-behind-secs", 1.0),
+                flush_count=args.get("write-behind-count", 100),
+            )
+        return db
+
+    @staticmethod
+    def __open_sql(db_class, path, uri, kws) -> Union[UriDb, CounterDb]:
+        import notanorm  # pylint: disable=import-outside-toplevel
+
+        try:
+            return db_class(path=path, uri=uri, **kws)
+        except notanorm.errors.SchemaError as ex:
+            if not path:
+                raise
+            # a table of the same name laid out differently, keep it and the file's others
+            table = kws.get("table") or db_class.TABLE_NAME
+            log.error("unable to use table %s in %s: %s", table, path, repr(ex))
+            with notanorm.open_db("sqlite:" + path) as db:
+                db.execute("drop table if exists %s_old" % table)
+                db.execute("alter table %s rename to %s_old" % (table, table))
+            return db_class(path, **kws)
+        except Exception as ex:  # pylint: disable=broad-except
+            if not path:
+                raise
+            # deal with corruption by recovering
+            log.error("unable to open %s: %s", path, repr(ex))
+            # save the old one, maybe for debugging or something
+            os.replace(path, path + ".old")
+            return db_class(path, **kws)
+
+    def __open_store(self, key: tuple, opener: Callable[[], AbstractDb]) -> AbstractDb:
+        """Opens the db, or uses the one already open with the same key."""
+        db = _open_store(key, opener, self.stale_secs)
+        self.__store_key = key
+        return db
+
+    def __packed_db(
+        self, args, mmap_path
+    ) -> Union[PackedMemoryDb, SharedMemoryDb, MmapDb]:
+        assert not self.columns, "columns requires a persistent sql db"
+        max_entries = args.get("max-entries", DEFAULT_MAX_ENTRIES)
+        if mmap_path:
+            assert not args.get("write-behind"), "write-behind requires a sql db"
+            kws = {"slots": max_entries, "sync_secs": args.get("db-sync-secs")}
+            return self.__open_store(
+                (MmapDb, os.path.abspath(mmap_path)),
+                lambda: self.__open_mmap(mmap_path, kws),
+            )
+        if args.get("shared-memory"):
+            name = args["shared-memory"]
+            return self.__open_store(
+                (SharedMemoryDb, name), lambda: SharedMemoryDb(name, slots=max_entries)
+            )
+        # packed counts of a window are all the same size
+        return PackedMemoryDb(
+            len(self.__new_count().to_bytes()),
+            max_entries=max_entries,
+            ttl_secs=args.get("ttl-secs"),
+        )
+
+    @staticmethod
+    def __open_mmap(path, kws) -> MmapDb:
+        try:
+            return MmapDb(path, **kws)
+        except Exception as ex:  # pylint: disable=broad-except
+            log.error("unable to open %s: %s", path, repr(ex))
+            os.replace(path, path + ".old")
+            return MmapDb(path, **kws)
 
     @staticmethod
     def _get_db_key(rule_id: str, profile_id: bytes):
         return profile_id.hex() + ":" + rule_id
 
-    def get(
+    def __key(self, rule_id: str, profile_id: bytes):
+        if self.packed and not self.shared and rule_id == self.rule_id:
+            # the request's profile id is the key for this db's own rule
+            return profile_id
+        if self.columns:
+            return rule_id, profile_id.hex()
+        return self._get_db_key(rule_id, profile_id)
+
+    def __pack(self, pc: ProfileCount, lock_value: Optional[str]) -> bytes:
+        data = pc.to_bytes(lock_value)
+        if self.shared:
+            # other processes' locks are in the same table
+            data += bytes.fromhex(lock_value) if lock_value else bytes(self.LOCK_SIZE)
+        return data
+
+    def __encode(self, pc: ProfileCount, lock_value: Optional[str]):
+        if self.columns:
+            return pc.to_row(lock_value)
+        return pc.to_str(lock_value)
+
+    def __parse(self, data) -> ProfileCount:
+        if self.packed:
+            lock_value = self.lock_value
+            if self.shared:
+                data, lock = data[: -self.LOCK_SIZE], data[-self.LOCK_SIZE :]
+                lock_value = lock.hex()
+            return self.count_class.from_bytes(
+                data, lock_value, self.expiry_secs, **self.count_args
+            )
+        if self.columns:
+            return ProfileCount.from_row(data, expiry_secs=self.expiry_secs)
+        return self.count_class.from_str(
+            data, expiry_secs=self.expiry_secs, **self.count_args
+        )
+
+    def __new_count(self) -> ProfileCount:
+        return self.count_class(expiry_secs=self.expiry_secs, **self.count_args)
+
+    def __load(self, data) -> ProfileCount:
+        """Parses the data, or returns a new count if there is none, or it's invalid."""
+        if not data:
+            return self.__new_count()
+        try:
+            return self.__parse(data)
+        except (ValueError, TypeError, AssertionError, KeyError, struct.error):
+            log.warning("invalid value in db, resetting: (%s)", data)
+            pc = self.__new_count()
+            pc.invalid = True
+            return pc
+
+    def migrate(self, rule_id: str, table: Optional[str] = None) -> int:
+        """Moves the json rows for a rule from a UriDb table to the columns table.
+
+        table is the UriDb's table, by default its default one.
+
+        Rows already in the columns table are kept.  Returns the number of rows moved.
+        """
+        import notanorm  # pylint: disable=import-outside-toplevel
+
+        table = table or UriDb.TABLE_NAME
+        key_like = notanorm.Op("like", "%:" + rule_id)
+        moved = 0
+        # a pooled connection, the store may be in use by other threads
+        with self.db._conn() as db:  # pylint: disable=protected-access
+            try:
+                rows = db.select(table, ["key", "val"], key=key_like)
+            except notanorm.errors.TableNotFoundError:
+                return 0
+            for row in rows:
+                # like also matches _ and % in the rule id as wildcards, and ignores case
+                hexid, _, key_rule_id = row.key.partition(":")
+                if key_rule_id != rule_id:
+                    continue
+                try:
+                    pc = ProfileCount.from_str(row.val, expiry_secs=self.expiry_secs)
+                except (ValueError, TypeError, AssertionError, KeyError):
+                    log.warning("invalid value in db, not migrating: (%s)", row.val)
+                else:
+                    if self.db.insert_missing(
+                        (rule_id, hexid), pc.to_row(pc.lock_value)
+                    ):
+                        moved += 1
+                db.delete(table, key=row.key)
+        if moved:
+            log.info("migrated %i throttle rows for rule_id=%s", moved, rule_id)
+        return moved
+
+    def get(  # pylint: disable=too-many-return-statements
         self, rule_id: str, profile_id: bytes, lock: bool
     ) -> Optional[ProfileCount]:
         """Gets the row in the db.
@@ -144,49 +705,308 @@ class ProfileThrottleDb:
             lock - Whether or not to try to lock the row
 
         Returns None if the row is already locked by someone else, otherwise a ProfileCount object.
+
+        Atomic dbs have no locks.
         """
-        key = self._get_db_key(rule_id, profile_id)
-        data = self.db.get(key)
-        pc = None
-        if not data:
-            pc = ProfileCount()
-            if lock:
-                self.db.set(key, pc.to_str(self.lock_value))
-            return pc
-        try:
-            pc = ProfileCount.from_str(data, expiry_secs=self.expiry_secs)
-        except (ValueError, TypeError, AssertionError, KeyError):
-            log.warning("invalid value in db, resetting: (%s)", data)
-            pc = ProfileCount()
-            if lock:
-                self.db.set(key, pc.to_str(self.lock_value))
-            return pc
+        lock = lock and not self.atomic
+        key = self.__key(rule_id, profile_id)
+        if self.redis and self.atomic:
+            hour_cnt, day_cnt = self.db.counts(key, **self.__window_starts())
+            return ProfileCount(
+                Timer.time(), hour_cnt, day_cnt, expiry_secs=self.expiry_secs
+            )
+        if lock and self.packed:
+            for _ in self.__attempts():
+                pc = self.__lock_packed(key)
+                if pc is not None:
+                    return pc
+            return None
         if lock:
-            if self.is_locked(pc):
-                return None
-            self.db.set(key, pc.to_str(self.lock_value))
-            return pc
-        return pc
+            return self.__swap(key, lambda pc: self.lock_value)
+        return self.__load(self.db.get(key))
 
-    def increment(self, rule_id: str, profile_id: bytes, pc: ProfileCount):
-        pc.increment()
-        self.db.set(self._get_db_key(rule_id, profile_id), pc.to_str(lock_value=None))
-        return pc
+    def __lock_packed(self, key) -> Optional[ProfileCount]:
+        # in memory, the lock is checked and taken in one update of the current counts
+        locked = None
 
-    def lock(self, rule_id, profile_id, pc: ProfileCount):
-        self.db.set(
-            self._get_db_key(rule_id, profile_id), pc.to_str(lock_value=self.lock_value)
+        def take(data):
+            nonlocal locked
+            pc = self.__load(data)
+            if data and not pc.invalid and self.is_locked(pc):
+                return data
+            locked = pc
+            return self.__pack(pc, self.lock_value)
+
+        self.db.update(key, take)
+        return locked
+
+    def __relock_packed(self, key, lock_value: Optional[str]):
+        # sets the lock on the current counts, so other threads' increments are kept
+        self.db.update(key, lambda data: self.__pack(self.__load(data), lock_value))
+
+    def __attempts(self) -> Iterator[int]:
+        """Yields the attempt number, with a random, growing wait before each retry."""
+        yield 0
+        for attempt in range(1, self.cas_tries + 1):
+            with self.__retries_lock:
+                self.cas_retries += 1
+            time.sleep(random.uniform(0, self.cas_backoff_secs * 2 ** (attempt - 1)))
+            yield attempt
+
+    def __swap(
+        self,
+        key,
+        change: Callable[[ProfileCount], Optional[str]],
+        pc: Optional[ProfileCount] = None,
+        wait=True,
+    ) -> Optional[ProfileCount]:
+        """Changes persistent counts with compare-and-swap on their version.
+
+        change updates the counts and returns the lock value to write.  If pc was the last
+        value written by this db, it's swapped without reading it first.  Rows leased to
+        someone else are retried until the lease is released or expires, or left alone if
+        not wait.  Returns the new counts, or None if not written.
+        """
+        for _ in self.__attempts():
+            if pc is not None and pc.stored is not None:
+                data = pc.stored
+            else:
+                data = self.db.get(key)
+                pc = self.__load(data)
+                if data and not pc.invalid and self.is_locked(pc):
+                    if not wait:
+                        return None
+                    pc = None
+                    continue
+            lock_value = change(pc)
+            pc.version += 1
+            stored = self.__encode(pc, lock_value)
+            if self.db.set_if(key, stored, data):
+                pc.stored = stored
+                return pc
+            # changed since read, re-read it
+            pc = None
+        log.warning(
+            "ProfileThrottleDb gave up on contended row after %i retries",
+            self.cas_tries,
         )
+        return None
+
+    def sweep(self, max_rows: Optional[int] = None) -> int:
+        """Removes rows, for any rule, that no throttle needs.  Returns the number removed.
+
+        Those are rows older than the longest stale_secs of the throttles in this process
+        that use the db, for example a token bucket that refills slowly.  Locks older than
+        that have always expired.  Rows written while sweeping are kept.
+        """
+        if self.redis:
+            # rows expire instead
+            return 0
+        stale_secs = self.stale_secs
+        if self.__store_key is not None:
+            stale_secs = _store_stale_secs(self.__store_key)
+        cutoff = Timer.time() - stale_secs
+        if self.columns:
+            removed = self.db.sweep(cutoff, max_rows)
+        else:
+            removed = 0
+            for key, data in self.db.items():
+                if max_rows is not None and removed >= max_rows:
+                    break
+                if self.__timestamp(data) < cutoff and self.db.remove_if(key, data):
+                    removed += 1
+        log.info("ProfileThrottleDb.sweep removed %i rows", removed)
+        return removed
+
+    def trim(self, max_rows: int) -> int:
+        """Removes the least recently written rows past max_rows.  Returns the number removed.
+
+        Their counts start over, so only for persistent tables that must not grow past a size.
+        """
+        if self.packed or self.redis:
+            # fixed number of slots, or rows expire instead
+            return 0
+        if self.columns:
+            removed = self.db.trim(max_rows)
+        else:
+            rows = sorted(
+                (self.__timestamp(data), key, data) for key, data in self.db.items()
+            )
+            removed = 0
+            for _, key, data in rows[: max(len(rows) - max_rows, 0)]:
+                # unless written since
+                removed += self.db.remove_if(key, data)
+        if removed:
+            log.warning("ProfileThrottleDb.trim removed %i rows", removed)
+        return removed
+
+    @staticmethod
+    def __timestamp(data) -> float:
+        if isinstance(data, bytes):
+            return ProfileCount.TS.unpack_from(data)[0]
+        try:
+            return float(json.loads(data)["tm"])
+        except (ValueError, TypeError, KeyError):
+            # invalid rows are reset when read, so can go
+            return 0
+
+    def __maybe_sweep(self):
+        # amortized over writes, at most one sweep at a time, off the request's thread
+        if not self.sweep_secs or time.monotonic() < self.__next_sweep:
+            return
+        # pylint: disable=consider-using-with
+        if not self.__sweep_lock.acquire(blocking=False):
+            return
+        self.__next_sweep = time.monotonic() + self.sweep_secs
+        self.__sweeper = threading.Thread(target=self.__sweep_thread, daemon=True)
+        self.__sweeper.start()
+
+    def __sweep_thread(self):
+        try:
+            self.sweep(self.sweep_rows)
+            if self.max_rows is not None:
+                self.trim(self.max_rows)
+        except Exception as ex:  # pylint: disable=broad-except
+            log.error("ProfileThrottleDb.sweep failed: %s", repr(ex))
+        finally:
+            self.__sweep_lock.release()
+
+    def reserve(self, rule_id: str, profile_id: bytes, per_hour, per_day) -> bool:
+        """Atomic dbs only: increment the counts if within the limits, returns False if not."""
+        self.__maybe_sweep()
+        key = self.__key(rule_id, profile_id)
+        if self.packed:
+            reserved = False
+
+            def take(data):
+                nonlocal reserved
+                pc = self.__load(data)
+                reserved = pc.within_quota(per_hour, per_day)
+                if not reserved:
+                    return data
+                pc.increment()
+                return self.__pack(pc, None)
+
+            self.db.update(key, take)
+            return reserved
+
+        return self.db.reserve(
+            key,
+            Timer.time(),
+            **self.__window_starts(),
+            per_hour=per_hour,
+            per_day=per_day,
+        )
+
+    def reserve_many(self, reservations: Sequence[Tuple[str, bytes, int, int]]) -> bool:
+        """Atomic dbs only: reserve for each (rule_id, profile_id, per_hour, per_day).
+
+        With columns, all are reserved in one transaction, or none are, and with redis in
+        one round trip.  Otherwise they are reserved one at a time, stopping at the first
+        that is over its limits.
+        """
+        if not self.batches:
+            return all(self.reserve(*res) for res in reservations)
+        self.__maybe_sweep()
+        return self.db.reserve_many(
+            [(self.__key(rid, pid), ph, pd) for rid, pid, ph, pd in reservations],
+            Timer.time(),
+            **self.__window_starts(),
+        )
+
+    def release_many(self, keys: Sequence[Tuple[str, bytes]]):
+        """Takes back reservations of (rule_id, profile_id) made with reserve_many.
+
+        Dbs with batches only.  Counts that have reset since are left alone.
+        """
+        assert self.batches, "release_many needs a db with batches"
+        self.db.release_many(
+            [self.__key(rid, pid) for rid, pid in keys], **self.__window_starts()
+        )
+
+    @staticmethod
+    def __window_starts() -> Dict[str, float]:
+        now = Timer.now()
+        hour_start = now.replace(minute=0, second=0, microsecond=0)
+        day_start = hour_start.replace(hour=0)
+        return {
+            "hour_start": hour_start.timestamp(),
+            "day_start": day_start.timestamp(),
+        }
+
+    def increment(self, rule_id: str, profile_id: bytes, pc: Optional[ProfileCount]):
+        """Adds a request to the counts, and unlocks.  Returns the new counts.
+
+        The current counts are incremented, atomically in memory, or with compare-and-swap,
+        so no increments are lost.  pc is the counts from get, or None.  Rows leased to
+        someone else are retried, returns None if they stay leased.
+        """
+        self.__maybe_sweep()
+        key = self.__key(rule_id, profile_id)
+        if self.redis and self.atomic:
+            self.reserve(rule_id, profile_id, INFINITE, INFINITE)
+            return self.get(rule_id, profile_id, lock=False)
+        if self.packed:
+            added = None
+
+            def add(data):
+                nonlocal added
+                cur = self.__load(data)
+                if data and not cur.invalid and self.is_locked(cur):
+                    return data
+                cur.increment()
+                added = cur
+                return self.__pack(cur, None)
+
+            for _ in self.__attempts():
+                self.db.update(key, add)
+                if added is not None:
+                    return added
+            return None
+        # increment returns None, so the row is unlocked
+        return self.__swap(key, lambda cur: cur.increment(), pc)
+
+    def lock(self, rule_id, profile_id, pc: ProfileCount):
+        if self.packed:
+            self.__relock_packed(self.__key(rule_id, profile_id), self.lock_value)
+        else:
+            self.__swap(
+                self.__key(rule_id, profile_id), lambda cur: self.lock_value, pc
+            )
 
     def unlock(self, rule_id, profile_id, pc: ProfileCount):
-        self.db.set(self._get_db_key(rule_id, profile_id), pc.to_str(lock_value=None))
+        if self.packed:
+            self.__relock_packed(self.__key(rule_id, profile_id), None)
+        else:
+            self.__swap(
+                self.__key(rule_id, profile_id), lambda cur: None, pc, wait=False
+            )
 
     def is_locked(self, pc):
         """Returns whether or not the row is locked by someone else."""
         return not ((pc.lock_value is None) or (pc.lock_value == self.lock_value))
 
     def clear(self, rule_id: str, profile_id: bytes):
-        self.db.remove(self._get_db_key(rule_id, profile_id))
+        key = self.__key(rule_id, profile_id)
+        if self.redis and self.atomic:
+            self.db.clear_counts(key, **self.__window_starts())
+        else:
+            self.db.remove(key)
+
+    @property
+    def batches(self) -> bool:
+        """Whether reserve_many reserves all or none."""
+        return self.atomic and (self.columns or self.redis)
+
+    def close(self):
+        """Writes any buffered changes, and closes the db, once no other throttle uses it."""
+        if self.__store_key is None:
+            self.db.close()
+            return
+        if isinstance(self.db, WriteBehindDb):
+            # the backing db is shared
+            self.db.close()
+        _release_store(self.__store_key, self.stale_secs)
 
 
 class ProfileThrottleRule(RulePlugin):
@@ -197,6 +1017,55 @@ class ProfileThrottleRule(RulePlugin):
      - per_hour: requests per hour
      - per_day: requests per day
      - persistent: restarting the server not clear current quotas
+     - columns: store counts in typed columns of a "throttle" table, instead of json.
+       Existing json rows for the rule are moved over.  Requires persistent.
+     - atomic: counts are checked and incremented in one step when the quota is used,
+       instead of locking the row between approval and use.  When persistent with a sql
+       db, implies columns, and is one statement.
+     - db-uri: `mmap:<path>` keeps counts in a memory mapped file instead of a sql db, for
+       persistent counts on a single host, at about the speed of in memory ones.
+       max-entries is the number of profiles it has room for, as for shared-memory.
+     - db-sync-secs: with `mmap:`, flush changes to disk at most this often, by default
+       the OS writes them when it likes
+     - db-uri: `redis://<host>:<port>/<db>` keeps counts on a redis server, to share them
+       between keyservers on several hosts.  With atomic, counts are counters that are
+       checked and incremented in one round trip.  Counts expire instead of being swept.
+       Requires the redis package.
+     - db-prefix: with redis, prefix for the keys, default "policy_basics:"
+     - db-pool-size: connections to the persistent db, for use by several threads, default 1
+     - cas-retries: without atomic, a profile's counts are leased from approval until use,
+       and written with compare-and-swap.  Times to retry a profile leased to, or just
+       written by, another server or thread, before failing, default 6.  Leases expire
+       after expiry_secs.  db.cas_retries is the number of retries so far.
+     - cas-backoff-secs: most time before the first retry, doubling for each, default 0.005
+     - write-behind: serve counts from memory, and write them to the persistent db in batches.
+       For use when a single process uses the db.  Can't be combined with atomic.
+     - write-behind-secs: longest time a change stays unwritten, default 1.0
+     - write-behind-count: write sooner when this many profiles have changed, default 100
+     - window: how requests are counted, one of:
+        - calendar: counts reset at the start of each hour and day, the default
+        - sliding: counts are of the last hour and day, so limits free up gradually
+        - token_bucket: `rate` requests per hour, up to `burst` at once, default burst is
+          the rate.  per_hour and per_day are not used.
+
+       sliding and token_bucket can't be used with columns or atomic.
+     - sweep-secs: how often rows that have no effect any more (over two days old, or
+       older for slow token buckets using the same db in the process, for any rule) are
+       removed, default 3600, 0 to never remove them.  Sweeps run in a background
+       thread, json rows are all read to find old ones.
+     - sweep-rows: most rows removed at a time, default 1000
+     - max-rows: persistent sql dbs only, most rows kept, none by default.  After each sweep the
+       least recently written rows past this are removed, and those profiles' counts
+       start over.
+     - max-entries: not persistent only, most profiles counted, default 100000.  Room
+       for them is allocated up front, about 30 bytes each.  A profile's count takes the
+       place of the least recently used one of the few it can go in, when they're full.
+     - ttl-secs: not persistent only, drop counts not changed for this long
+     - shared-memory: not persistent only, a name for counts kept in shared memory, so
+       all the processes on the host using that name enforce one quota.  max-entries is
+       the number of profiles it has room for, counts are not dropped to make room, and
+       ttl-secs is not used.  Counts last until the host restarts.  POSIX and
+       python 3.8 or later only.
 
     ```
     Example:
@@ -208,6 +1077,9 @@ class ProfileThrottleRule(RulePlugin):
 
     Request data are stored per-rule. If there are 2 throttle rules which may match a profile,
     each will record its own request counts for that profile, i.e. the limits are additive.
+
+    Rules with the same persistent db, shared memory name or mmap file use one connection
+    or table between them.
     """
 
     @staticmethod
@@ -224,6 +1096,18 @@ class ProfileThrottleRule(RulePlugin):
         return self._approve_profile_request(request.profile.profile_id)
 
     def _approve_profile_request(self, profile_id):
+        if self.db.atomic:
+            # quota is reserved in _use_quota
+            within = self._within_quota(
+                self.db.get(self.rule_id, profile_id, lock=False)
+            )
+            log.debug(
+                "ProfileThrottleRule._approve_profile_request rule_id=%s within=%s atomic=True",
+                self.rule_id,
+                within,
+            )
+            return within
+
         pc = self.db.get(self.rule_id, profile_id, lock=True)
         if pc is None:
             log.warning(
@@ -247,16 +1131,34 @@ class ProfileThrottleRule(RulePlugin):
     def use_quota(self, request: ApprovalRequest):
         return self._use_quota(request.profile.profile_id)
 
+    async def approve_request_async(self, request: ApprovalRequest):
+        """Same as approve_request, db I/O runs in a thread pool."""
+        return await self.db.aio.run(self.approve_request, request)
+
+    async def use_quota_async(self, request: ApprovalRequest):
+        """Same as use_quota, db I/O runs in a thread pool."""
+        return await self.db.aio.run(self.use_quota, request)
+
     def _use_quota(self, profile_id):
-        pc = self.db.get(self.rule_id, profile_id, lock=True)
+        if self.db.atomic:
+            if not self.db.reserve(
+                self.rule_id, profile_id, self.per_hour, self.per_day
+            ):
+                log.warning(
+                    "ProfileThrottleRule._use_quota rule_id=%s over quota", self.rule_id
+                )
+                raise RuntimeError("Profile went over quota since approval")
+            return
+
+        # the current counts, leased by us since approval, or not leased
+        pc = self.db.increment(self.rule_id, profile_id, None)
         if pc is None:
             log.warning(
-                "ProfileThrottleRule._approve_profile_request rule_id=%s is_locked=True",
+                "ProfileThrottleRule._use_quota rule_id=%s is_locked=True",
                 self.rule_id,
             )
             # There should be a more descriptive error in atakama_sdk that we can use here.
             raise RuntimeError("Profile Row is being handled by another process")
-        pc = self.db.increment(self.rule_id, profile_id, pc)
         log.debug(
             "ProfileThrottleRule._use_quota rule_id=%s now day_cnt=%i hour_cnt=%i",
             self.rule_id,
@@ -271,10 +1173,54 @@ class ProfileThrottleRule(RulePlugin):
             return True
         return False
 
+    @staticmethod
+    def reserve_quotas(
+        rules: Iterable["ProfileThrottleRule"], request: ApprovalRequest
+    ) -> bool:
+        """Checks and uses the quotas of several rules for a request, as a RuleSet would.
+
+        RuleSets don't call this, callers that want it call it instead of the rules'
+        approve_request and use_quota.
+
+        Atomic rules with columns or redis that share a db are reserved together, all or
+        none of them.  Others are approved first, and only use their quotas once all the
+        batches are reserved.  Returns False, having used no quota, if any rule is over
+        quota.  As with a RuleSet, rows approved by other rules stay leased until expiry
+        if a later rule refuses.
+        """
+        profile_id = request.profile.profile_id
+        batches: Dict[int, list] = {}
+        approved = []
+        for rule in rules:
+            if rule.db.batches:
+                batches.setdefault(id(rule.db.db), []).append(rule)
+                continue
+            if not rule.approve_request(request):
+                return False
+            approved.append(rule)
+        reserved = []
+        for batch in batches.values():
+            reservations = [
+                (rule.rule_id, profile_id, rule.per_hour, rule.per_day)
+                for rule in batch
+            ]
+            if not batch[0].db.reserve_many(reservations):
+                log.debug(
+                    "ProfileThrottleRule.reserve_quotas rule_ids=%s over quota",
+                    [rule.rule_id for rule in batch],
+                )
+                for db, keys in reserved:
+                    db.release_many(keys)
+                return False
+            reserved.append(
+                (batch[0].db, [(rid, pid) for rid, pid, _, _ in reservations])
+            )
+        for rule in approved:
+            rule.use_quota(request)
+        return True
+
     def _within_quota(self, pc):
-        return (self.per_day == INFINITE or pc.day_cnt < self.per_day) and (
-            self.per_hour == INFINITE or pc.hour_cnt < self.per_hour
-        )
+        return pc.within_quota(self.per_hour, self.per_day)
 
     def clear_quota(self, profile: ProfileInfo) -> None:
         self.db.clear(self.rule_id, profile.profile_id)
@@ -1,12 +1,95 @@
 # SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
 # SPDX-License-Identifier: LGPL-3.0-or-later
 
-from collections import defaultdict
-from typing import Optional, Dict, List, Tuple, Set
+import logging
+import mmap
+import os
+import time
+from typing import Optional, Dict, List, Set, Iterable, Union
 
 from atakama import RulePlugin, ApprovalRequest
 
+log = logging.getLogger(__name__)
+
 MINIMUM_WORD_COUNT = 4
+PROFILE_ID_SIZE = 16
+
+# key marking the end of a phrase in the word trie, words are strs
+_END = None
+
+
+class ProfileIdFile:
+    """Sorted profile ids, all size bytes long, in a memory mapped file.
+
+    Ids are found by bisection, so large lists cost no parsing or memory per id.  The
+    file is checked for changes at most every check_secs, and mapped again if replaced.
+    """
+
+    def __init__(self, path: str, size=PROFILE_ID_SIZE, check_secs=1.0):
+        assert size > 0, "size must be positive"
+        self.path = path
+        self.size = size
+        self.check_secs = check_secs
+        self.__stat = None
+        self.__data: Union[bytes, mmap.mmap] = b""
+        self.__checked = time.monotonic()
+        self.__load(os.stat(path))
+
+    def __load(self, stat: os.stat_result):
+        if stat.st_size % self.size:
+            raise ValueError(
+                "%s is not a list of %i byte profile ids" % (self.path, self.size)
+            )
+        with open(self.path, "rb") as fh:
+            # empty files can't be mapped
+            data = (
+                mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                if stat.st_size
+                else b""
+            )
+        # searches in progress keep the old map until they are done
+        self.__data = data
+        self.__stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        log.debug("loaded %i profile ids from %s", len(self), self.path)
+
+    def __check(self):
+        now = time.monotonic()
+        if now - self.__checked < self.check_secs:
+            return
+        self.__checked = now
+        try:
+            stat = os.stat(self.path)
+            if (stat.st_ino, stat.st_size, stat.st_mtime_ns) != self.__stat:
+                self.__load(stat)
+        except (OSError, ValueError) as ex:
+            log.error("keeping old profile ids, can't load %s: %s", self.path, ex)
+
+    def __contains__(self, profile_id: bytes) -> bool:
+        self.__check()
+        if len(profile_id) != self.size:
+            return False
+        data, size = self.__data, self.size
+        lo, hi = 0, len(data) // size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[mid * size : (mid + 1) * size] < profile_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return data[lo * size : (lo + 1) * size] == profile_id
+
+    def __len__(self):
+        return len(self.__data) // self.size
+
+    @staticmethod
+    def write(path: str, profile_ids: Iterable[bytes], size=PROFILE_ID_SIZE):
+        """Writes ids to a file that can be loaded, replacing it in one step."""
+        ids = sorted(set(profile_ids))
+        assert all(len(pid) == size for pid in ids), "ids must be %i bytes" % size
+        tmp = "%s.%i.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as fh:
+            fh.write(b"".join(ids))
+        os.replace(tmp, path)
 
 
 class ProfileIdRule(RulePlugin):
@@ -17,6 +100,10 @@ class ProfileIdRule(RulePlugin):
      - profile_ids:
         - profile_id_in_hex
         - profile words space delimited
+     - profile_ids_file: path, or list of paths, of files of sorted binary profile ids,
+       as written by ProfileIdFile.write.  For large lists, changes are picked up
+       without a restart.
+     - profile_ids_size: bytes in each id in the files, default 16
 
     ```
     Example:
@@ -33,14 +120,26 @@ class ProfileIdRule(RulePlugin):
 
     def __init__(self, args):
         self.__pids: Set[bytes] = set()
-        self.__wkey: Dict[int, Set[Tuple]] = defaultdict(set)
-        for pid in args["profile_ids"]:
+        # word -> next word -> ..., so matching is one walk over the profile's words
+        self.__words: Dict[Optional[str], dict] = {}
+        files = args.get("profile_ids_file") or []
+        if isinstance(files, str):
+            files = [files]
+        size = args.get("profile_ids_size", PROFILE_ID_SIZE)
+        self.__files = [ProfileIdFile(path, size) for path in files]
+        assert (
+            files or "profile_ids" in args
+        ), "profile_ids or profile_ids_file required"
+        for pid in args.get("profile_ids", []):
             if " " in pid:
                 words = tuple(w.strip() for w in pid.split(" "))
                 assert (
                     len(words) >= MINIMUM_WORD_COUNT
                 ), "profile id word match must use at least 4 words"
-                self.__wkey[len(words)].add(words)
+                node = self.__words
+                for word in words:
+                    node = node.setdefault(word, {})
+                node[_END] = {}
             else:
                 pid = bytes.fromhex(pid)
                 self.__pids.add(pid)
@@ -50,12 +149,19 @@ class ProfileIdRule(RulePlugin):
     def approve_request(self, request: ApprovalRequest) -> Optional[bool]:
         if request.profile.profile_id in self.__pids:
             return True
+        if any(request.profile.profile_id in ids for ids in self.__files):
+            return True
         if self._word_match(request.profile.profile_words):
             return True
         return False
 
     def _word_match(self, words: List[str]) -> bool:
-        for wlen, wset in self.__wkey.items():
-            if tuple(words[0:wlen]) in wset:
+        """True if the words start with any of the phrases."""
+        node = self.__words
+        for word in words:
+            node = node.get(word)
+            if node is None:
+                return False
+            if _END in node:
                 return True
         return False
@@ -0,0 +1,213 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import logging
+import typing
+
+from policy_basics.simple_db import AbstractDb, DbVal
+
+__autodoc__ = False
+
+log = logging.getLogger(__name__)
+
+HOUR_SECS = 3600
+DAY_SECS = 86400
+
+
+class RedisDb(AbstractDb):
+    """Db on a redis server, so keyservers on several hosts share values.
+
+    Keys are strs, prefixed with prefix on the server.  With ttl_secs, keys expire that
+    long after they are set.  Strs and ints are kept apart, so values read back with the
+    type they were set with.
+
+    Also keeps hour and day counters, with a check-and-increment that needs no scripts:
+    counters are incremented in one pipeline, and decremented again if over the limits.
+    While over, other requests can be refused early, but the limits are never passed.
+
+    Requires the redis package.
+    """
+
+    # strs are stored after this, ints as is, so counters can be read as ints
+    STR_MARK = b"s"
+
+    def __init__(self, uri, *, prefix="policy_basics:", ttl_secs=None):
+        # pylint: disable=import-outside-toplevel
+        import redis
+
+        self.uri = uri
+        self.prefix = prefix
+        self.ttl_secs = ttl_secs
+        self.client = redis.Redis.from_url(uri)
+        self.__watch_error = redis.WatchError
+        # fail early if the server is not there
+        self.client.ping()
+
+    def __key(self, key) -> str:
+        return self.prefix + key
+
+    def __encode(self, value: DbVal) -> bytes:
+        if isinstance(value, str):
+            return self.STR_MARK + value.encode()
+        return b"%i" % value
+
+    def __decode(self, data: typing.Optional[bytes]) -> DbVal:
+        if data is None:
+            return None
+        if data.startswith(self.STR_MARK):
+            return data[len(self.STR_MARK) :].decode()
+        return int(data)
+
+    def set(self, key, value: DbVal):
+        self.client.set(self.__key(key), self.__encode(value), ex=self.ttl_secs)
+
+    def set_many(self, items):
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in items:
+            pipe.set(self.__key(key), self.__encode(value), ex=self.ttl_secs)
+        pipe.execute()
+
+    def get(self, key) -> DbVal:
+        return self.__decode(self.client.get(self.__key(key)))
+
+    def remove(self, key):
+        self.client.delete(self.__key(key))
+
+    def remove_if(self, key, value: DbVal) -> bool:
+        rkey = self.__key(key)
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(rkey)
+                if pipe.get(rkey) != self.__encode(value):
+                    return False
+                pipe.multi()
+                pipe.delete(rkey)
+                pipe.execute()
+            except self.__watch_error:
+                # changed since read
+                return False
+        return True
+
+    def set_if(self, key, value: DbVal, expected: DbVal) -> bool:
+        rkey = self.__key(key)
+        if expected is None:
+            return bool(
+                self.client.set(rkey, self.__encode(value), ex=self.ttl_secs, nx=True)
+            )
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(rkey)
+                if pipe.get(rkey) != self.__encode(expected):
+                    return False
+                pipe.multi()
+                pipe.set(rkey, self.__encode(value), ex=self.ttl_secs)
+                pipe.execute()
+            except self.__watch_error:
+                return False
+        return True
+
+    def __scan(self) -> typing.Iterator[typing.List[bytes]]:
+        """Yields the server's keys with our prefix, a page at a time."""
+        page = []
+        for rkey in self.client.scan_iter(match=self.prefix + "*", count=1000):
+            page.append(rkey)
+            if len(page) >= 1000:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def items(self) -> typing.Iterator[typing.Tuple[str, DbVal]]:
+        for page in self.__scan():
+            for rkey, data in zip(page, self.client.mget(page)):
+                if data is not None:
+                    yield rkey.decode()[len(self.prefix) :], self.__decode(data)
+
+    def clear(self):
+        for page in self.__scan():
+            self.client.delete(*page)
+
+    def __counter_keys(self, key, hour_start, day_start) -> typing.Tuple[str, str]:
+        return (
+            self.__key("%s:h:%i" % (key, hour_start)),
+            self.__key("%s:d:%i" % (key, day_start)),
+        )
+
+    def counts(
+        self, key, *, hour_start: float, day_start: float
+    ) -> typing.Tuple[int, int]:
+        """Hour and day counts for the windows starting at hour_start and day_start."""
+        hour, day = self.client.mget(self.__counter_keys(key, hour_start, day_start))
+        return int(hour or 0), int(day or 0)
+
+    def clear_counts(self, key, *, hour_start: float, day_start: float):
+        """Removes the counts, older windows' counts expire on their own."""
+        self.client.delete(*self.__counter_keys(key, hour_start, day_start))
+
+    def reserve(  # pylint: disable=too-many-arguments
+        self, key, now: float, *, hour_start: float, day_start: float, per_hour, per_day
+    ) -> bool:
+        """Increment the counts if they are below the limits, see CounterDb.reserve."""
+        return self.reserve_many(
+            [(key, per_hour, per_day)], now, hour_start=hour_start, day_start=day_start
+        )
+
+    def reserve_many(
+        self,
+        reservations: typing.Sequence[typing.Tuple[typing.Any, int, int]],
+        now: float,
+        *,
+        hour_start: float,
+        day_start: float,
+    ) -> bool:
+        """Reserve for each (key, per_hour, per_day), in one round trip if within limits.
+
+        Returns True if all were reserved, False and changes nothing if any are over limits.
+        """
+        # windows are kept until the next one ends, relative to now, in case of clock skew
+        hour_ttl = max(1, int(hour_start + 2 * HOUR_SECS - now))
+        day_ttl = max(1, int(day_start + 2 * DAY_SECS - now))
+        keys = [
+            self.__counter_keys(key, hour_start, day_start)
+            for key, _, _ in reservations
+        ]
+        pipe = self.client.pipeline(transaction=False)
+        for hour_key, day_key in keys:
+            pipe.incr(hour_key)
+            pipe.expire(hour_key, hour_ttl)
+            pipe.incr(day_key)
+            pipe.expire(day_key, day_ttl)
+        results = pipe.execute()
+        over = any(
+            0 <= per_hour < hour_cnt or 0 <= per_day < day_cnt
+            for (_, per_hour, per_day), hour_cnt, day_cnt in zip(
+                reservations, results[0::4], results[2::4]
+            )
+        )
+        if not over:
+            return True
+        self.__release(keys)
+        return False
+
+    def release_many(
+        self, keys: typing.Iterable[typing.Any], *, hour_start: float, day_start: float
+    ):
+        """Takes back a reservation of each key."""
+        self.__release(
+            [self.__counter_keys(key, hour_start, day_start) for key in keys]
+        )
+
+    def __release(self, keys: typing.Sequence[typing.Tuple[str, str]]):
+        pipe = self.client.pipeline(transaction=False)
+        for hour_key, day_key in keys:
+            pipe.decr(hour_key)
+            pipe.decr(day_key)
+        counter_keys = [k for pair in keys for k in pair]
+        # counters that had expired, or are of a new window, go back to zero
+        for rkey, cnt in zip(counter_keys, pipe.execute()):
+            if cnt < 0:
+                pipe.incr(rkey)
+        pipe.execute()
+
+    def close(self):
+        self.client.close()
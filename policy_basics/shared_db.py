@@ -0,0 +1,568 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import abc
+import array
+import contextlib
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import typing
+import zlib
+
+from policy_basics.simple_db import UpdateDb
+
+__autodoc__ = False
+
+log = logging.getLogger(__name__)
+
+
+class _SlotTable(UpdateDb):  # pylint: disable=too-many-instance-attributes
+    """Fixed size hash table in a buffer that processes share, see SharedMemoryDb.
+
+    Starts with a header of the format version and layout, and its checksum.  Each slot
+    has a checksum of its key and value, a slot that doesn't match is read as empty.
+
+    Subclasses open the buffer, and a file to lock.
+    """
+
+    # other processes hold the file locks, throttles wait out leases, and mmap files sync
+    blocking = True
+
+    MAGIC = b""
+    _buf: typing.Any = None
+    VERSION = 1
+    # magic, version, slots, stripes, key size, value size, checksum of the rest
+    _HEADER = struct.Struct("<8sIIIIII")
+    _EMPTY, _USED, _REMOVED = 0, 1, 2
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self, lock_fd: int, *, slots, stripes, key_size, value_size
+    ):
+        # pylint: disable=import-outside-toplevel
+        import fcntl
+
+        assert 1 <= stripes <= slots, "slots must be at least stripes, at least 1"
+        assert key_size < 256 and value_size < 256, "sizes must be under 256 bytes"
+
+        self.__fcntl = fcntl
+        self.__lock_fd = lock_fd
+        layout = (self.VERSION, slots, stripes, key_size, value_size)
+        size = self._HEADER.size + slots * self.__slot_struct(key_size, value_size).size
+        with self.__file_lock(0):
+            self._buf, created = self._open(size)
+            if created:
+                self.__write_header(layout)
+                self._written()
+            magic, *layout, check = self._HEADER.unpack_from(self._buf)
+            if magic != self.MAGIC or check != zlib.crc32(bytes(self.__layout_bytes)):
+                raise ValueError("%s has no valid header" % self.name)
+            if layout[0] != self.VERSION:
+                raise ValueError("%s is version %i" % (self.name, layout[0]))
+
+        _, slots, stripes, key_size, value_size = layout
+        need = self._HEADER.size + slots * self.__slot_struct(key_size, value_size).size
+        if len(self._buf) < need:
+            # truncated by a crash or a partial copy
+            raise ValueError(
+                "%s is %i bytes, its layout needs %i"
+                % (self.name, len(self._buf), need)
+            )
+        self.stripe_slots = slots // stripes
+        self.key_size = key_size
+        self.value_size = value_size
+        self.__slot = self.__slot_struct(key_size, value_size)
+        self.__tail = struct.Struct(self.__slot.format.replace("<BI", "<"))
+        self.__locks = [threading.Lock() for _ in range(stripes)]
+
+    @property
+    @abc.abstractmethod
+    def name(self) -> str:
+        ...
+
+    @abc.abstractmethod
+    def _open(self, size) -> typing.Tuple[typing.Any, bool]:
+        """Returns the buffer, and whether it's new, called with the setup lock held."""
+
+    def _written(self):
+        """Called after each change."""
+
+    @property
+    def __layout_bytes(self):
+        return self._buf[len(self.MAGIC) : self._HEADER.size - 4]
+
+    def __write_header(self, layout):
+        self._HEADER.pack_into(self._buf, 0, self.MAGIC, *layout, 0)
+        struct.pack_into(
+            "<I",
+            self._buf,
+            self._HEADER.size - 4,
+            zlib.crc32(bytes(self.__layout_bytes)),
+        )
+
+    @staticmethod
+    def __slot_struct(key_size, value_size) -> struct.Struct:
+        # state, checksum of the rest, key length, key, value length, value
+        return struct.Struct("<BIB%isB%is" % (key_size, value_size))
+
+    @contextlib.contextmanager
+    def __file_lock(self, offset):
+        self.__fcntl.lockf(self.__lock_fd, self.__fcntl.LOCK_EX, 1, offset)
+        try:
+            yield
+        finally:
+            self.__fcntl.lockf(self.__lock_fd, self.__fcntl.LOCK_UN, 1, offset)
+
+    @contextlib.contextmanager
+    def __locked(self, stripe):
+        # byte 0 of the lock file is for setting up the table
+        with self.__locks[stripe], self.__file_lock(stripe + 1):
+            yield
+
+    def __key(self, key) -> bytes:
+        if isinstance(key, str):
+            key = key.encode()
+        if len(key) > self.key_size:
+            key = hashlib.blake2b(key, digest_size=self.key_size).digest()
+        return key
+
+    def __home(self, key: bytes) -> typing.Tuple[int, int]:
+        """Stripe and first slot to look in, the same in every process."""
+        hsh = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+        stripe = hsh % len(self.__locks)
+        return stripe, (hsh // len(self.__locks)) % self.stripe_slots
+
+    def __offset(self, index) -> int:
+        return self._HEADER.size + index * self.__slot.size
+
+    def __probe(self, stripe, home) -> typing.Iterator[int]:
+        first = stripe * self.stripe_slots
+        for i in range(self.stripe_slots):
+            yield first + (home + i) % self.stripe_slots
+
+    def __find(
+        self, key: bytes, stripe, home
+    ) -> typing.Tuple[typing.Optional[int], typing.Optional[int]]:
+        """Returns the key's slot, if any, and the first free slot for it, if any."""
+        buf = self._buf
+        free = None
+        for index in self.__probe(stripe, home):
+            off = self.__offset(index)
+            state = buf[off]
+            if state == self._EMPTY:
+                return None, index if free is None else free
+            if state == self._REMOVED:
+                if free is None:
+                    free = index
+            elif buf[off + 6 : off + 6 + buf[off + 5]] == key:
+                return index, free
+        return None, free
+
+    def __read(self, index) -> typing.Optional[bytes]:
+        """The slot's value, None if the slot doesn't match its checksum."""
+        off = self.__offset(index)
+        _, check, _, _, vlen, value = self.__slot.unpack_from(self._buf, off)
+        if check != zlib.crc32(self._buf[off + 5 : off + self.__slot.size]):
+            log.warning("%s: ignoring damaged slot %i", self.name, index)
+            return None
+        return value[:vlen]
+
+    def __write(self, index, key: bytes, value: bytes):
+        if len(value) > self.value_size:
+            raise ValueError("value longer than %i bytes" % self.value_size)
+        off = self.__offset(index)
+        tail = self.__tail.pack(len(key), key, len(value), value)
+        # a slot left half written doesn't match its checksum, but is still in use, so
+        # keys after it can be found
+        self._buf[off + 5 : off + self.__slot.size] = tail
+        struct.pack_into("<BI", self._buf, off, self._USED, zlib.crc32(tail))
+
+    def __remove(self, index, stripe):
+        buf = self._buf
+        first = stripe * self.stripe_slots
+
+        def step(index, by):
+            return first + (index - first + by) % self.stripe_slots
+
+        buf[self.__offset(index)] = self._REMOVED
+        # removed slots before an empty one are on no key's path, so can be empty too
+        if buf[self.__offset(step(index, 1))] != self._EMPTY:
+            return
+        while buf[self.__offset(index)] == self._REMOVED:
+            buf[self.__offset(index)] = self._EMPTY
+            index = step(index, -1)
+
+    def __put(self, key: bytes, value: bytes, found, free):
+        if found is None:
+            if free is None:
+                raise RuntimeError("%s is full" % self.name)
+            found = free
+        self.__write(found, key, value)
+
+    def set(self, key, value: bytes):
+        key = self.__key(key)
+        stripe, home = self.__home(key)
+        with self.__locked(stripe):
+            self.__put(key, value, *self.__find(key, stripe, home))
+        self._written()
+
+    def get(self, key) -> typing.Optional[bytes]:
+        key = self.__key(key)
+        stripe, home = self.__home(key)
+        with self.__locked(stripe):
+            found, _ = self.__find(key, stripe, home)
+            return None if found is None else self.__read(found)
+
+    def update(self, key, func: typing.Callable[[typing.Optional[bytes]], typing.Any]):
+        """Sets the key to func(current value or None), atomically, see MemoryDb.update."""
+        key = self.__key(key)
+        stripe, home = self.__home(key)
+        with self.__locked(stripe):
+            found, free = self.__find(key, stripe, home)
+            value = func(None if found is None else self.__read(found))
+            if value is None:
+                if found is not None:
+                    self.__remove(found, stripe)
+            else:
+                self.__put(key, value, found, free)
+        self._written()
+        return value
+
+    def clear(self):
+        for stripe in range(len(self.__locks)):
+            start = self.__offset(stripe * self.stripe_slots)
+            end = self.__offset((stripe + 1) * self.stripe_slots)
+            with self.__locked(stripe):
+                self._buf[start:end] = bytes(end - start)
+        self._written()
+
+    def items(self) -> typing.List[typing.Tuple[bytes, bytes]]:
+        buf = self._buf
+        items = []
+        for stripe in range(len(self.__locks)):
+            with self.__locked(stripe):
+                for index in range(
+                    stripe * self.stripe_slots, (stripe + 1) * self.stripe_slots
+                ):
+                    off = self.__offset(index)
+                    if buf[off] == self._USED:
+                        value = self.__read(index)
+                        if value is not None:
+                            key = bytes(buf[off + 6 : off + 6 + buf[off + 5]])
+                            items.append((key, value))
+        return items
+
+    def __len__(self):
+        buf = self._buf
+        return sum(
+            buf[self.__offset(index)] == self._USED
+            for index in range(len(self.__locks) * self.stripe_slots)
+        )
+
+
+class SharedMemoryDb(_SlotTable):
+    """Fixed size hash table in shared memory, for processes on one host to share values.
+
+    Processes that open the same name use the same table.  It lasts until unlink() is
+    called, or the host restarts.  POSIX and python 3.8 or later only.
+
+    The table has slots for up to that many keys, split into stripes by hash.  Each stripe
+    is an open addressing table of its own, locked between threads with a lock, and between
+    processes with a lock on a byte of a file in lock_dir.  A full stripe refuses new keys.
+
+    Keys are bytes or str, hashed if longer than key_size.  Values are bytes of up to
+    value_size.  items() yields the keys as bytes.
+
+    The first process sets the table layout, others use it.
+    """
+
+    MAGIC = b"pbshm\x00\x00\x01"
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        name: str,
+        *,
+        slots=100000,
+        stripes=16,
+        key_size=64,
+        value_size=40,
+        lock_dir=None,
+    ):
+        if sys.version_info < (3, 8):
+            # multiprocessing.shared_memory is new in 3.8
+            raise RuntimeError("SharedMemoryDb requires python 3.8 or later")
+        self.__name = name
+        self.__shm = None
+        lock_path = os.path.join(lock_dir or tempfile.gettempdir(), name + ".lock")
+        self.__lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            super().__init__(
+                self.__lock_fd,
+                slots=slots,
+                stripes=stripes,
+                key_size=key_size,
+                value_size=value_size,
+            )
+        except Exception:
+            if self.__shm:
+                self.__shm.close()
+            os.close(self.__lock_fd)
+            raise
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    def _open(self, size):
+        # pylint: disable=import-outside-toplevel,protected-access
+        from multiprocessing import shared_memory, resource_tracker
+
+        created = True
+        try:
+            self.__shm = shared_memory.SharedMemory(self.name, create=True, size=size)
+        except FileExistsError:
+            self.__shm = shared_memory.SharedMemory(self.name)
+            created = False
+        if os.name == "posix":
+            # the table outlives this process, the tracker would remove it at exit
+            resource_tracker.unregister(self.__shm._name, "shared_memory")
+        return self.__shm.buf, created
+
+    def close(self):
+        self._buf = None
+        self.__shm.close()
+        os.close(self.__lock_fd)
+
+    def unlink(self):
+        """Removes the table, processes that have it open can still use it."""
+        if os.name == "posix":
+            # pylint: disable=import-outside-toplevel,protected-access
+            from multiprocessing import resource_tracker
+
+            # unlink tells the tracker it's gone, which was told to forget it
+            resource_tracker.register(self.__shm._name, "shared_memory")
+        self.__shm.unlink()
+
+
+class MmapDb(_SlotTable):
+    """Fixed size hash table in a memory mapped file, see SharedMemoryDb.
+
+    Values last across restarts, and processes that open the same file share them.
+
+    Changes are in the file when made, the OS writes them to disk when it likes.  With
+    sync_secs, they are also flushed to disk after a change, at most that often.
+    Slots that were half written to disk at a crash are read as empty.
+
+    A file with an invalid header, or shorter than its layout, raises ValueError.
+    """
+
+    MAGIC = b"pbmmap\x00\x01"
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        path,
+        *,
+        slots=100000,
+        stripes=16,
+        key_size=64,
+        value_size=40,
+        sync_secs=None,
+    ):
+        self.path = str(path)
+        self.sync_secs = sync_secs
+        self.__mmap = None
+        self.__next_sync = 0.0
+        self.__fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            super().__init__(
+                self.__fd,
+                slots=slots,
+                stripes=stripes,
+                key_size=key_size,
+                value_size=value_size,
+            )
+        except Exception:
+            self.__close()
+            raise
+
+    @property
+    def name(self) -> str:
+        return self.path
+
+    def _open(self, size):
+        created = os.fstat(self.__fd).st_size == 0
+        if created:
+            os.ftruncate(self.__fd, size)
+        elif os.fstat(self.__fd).st_size < self._HEADER.size:
+            raise ValueError("%s is too short" % self.path)
+        self.__mmap = mmap.mmap(self.__fd, 0)
+        return memoryview(self.__mmap), created
+
+    def _written(self):
+        if self.sync_secs is not None and time.monotonic() >= self.__next_sync:
+            self.flush()
+
+    def flush(self):
+        """Writes changes to disk."""
+        self.__next_sync = time.monotonic() + (self.sync_secs or 0)
+        self.__mmap.flush()
+
+    def __close(self):
+        if self._buf is not None:
+            self._buf.release()
+            self._buf = None
+        if self.__mmap:
+            self.__mmap.close()
+        os.close(self.__fd)
+
+    def close(self):
+        self.flush()
+        self.__close()
+
+
+class PackedMemoryDb(UpdateDb):  # pylint: disable=too-many-instance-attributes
+    """In memory db of fixed size bytes values, in arrays allocated up front.
+
+    Each key takes KEY_SIZE + 4 + value_size bytes, instead of the hundred or more of a
+    dict entry and its key and value objects.  Keys are kept as their KEY_SIZE byte
+    hash(), unless already bytes that long, so items() yields them as those bytes.
+
+    Slots are split by hash into buckets of up to WAYS.  A new key takes a free slot in its
+    bucket, or the one set longest ago, so past max_entries, about the least recently set
+    keys are dropped.  With ttl_secs, keys not set for that long are gone.
+    """
+
+    blocking = False
+    KEY_SIZE = 8
+    WAYS = 8
+
+    def __init__(self, value_size: int, *, max_entries: int, ttl_secs=None, stripes=16):
+        assert max_entries >= 1, "max_entries must be at least 1"
+        self.value_size = value_size
+        self.max_entries = max_entries
+        self.ttl_secs = ttl_secs
+        self.__ways = min(self.WAYS, max_entries)
+        self.__buckets = max_entries // self.__ways
+        slots = self.__buckets * self.__ways
+        # each slot's key then value, and when it was set, in seconds after the table
+        # was made, 0 if free
+        self.__size = self.KEY_SIZE + value_size
+        self.__slots = bytearray(slots * self.__size)
+        self.__view = memoryview(self.__slots)
+        self.__stamps = array.array("f", bytes(slots * 4))
+        # stamps are never 0
+        self.__start = time.monotonic() - 1
+        self.__locks = [threading.Lock() for _ in range(min(stripes, self.__buckets))]
+        self.__mask = (1 << 8 * self.KEY_SIZE) - 1
+
+    def __key(self, key) -> typing.Tuple[bytes, threading.Lock, int]:
+        """The key as kept, and the lock and first slot of its bucket."""
+        if isinstance(key, bytes) and len(key) == self.KEY_SIZE:
+            num = int.from_bytes(key, "little")
+        else:
+            # only this process uses the table, so its hash() will do
+            num = hash(key) & self.__mask
+            key = num.to_bytes(self.KEY_SIZE, "little")
+        bucket = num % self.__buckets
+        return key, self.__locks[bucket % len(self.__locks)], bucket * self.__ways
+
+    def __live(self, index: int, now: float) -> bool:
+        stamp = self.__stamps[index]
+        return stamp != 0 and (self.ttl_secs is None or now - stamp < self.ttl_secs)
+
+    def __find(self, key: bytes, first: int, now: float) -> typing.Optional[int]:
+        """The key's slot, if it has a live one."""
+        size = self.__size
+        start = first * size
+        end = start + self.__ways * size
+        pos = self.__slots.find(key, start, end)
+        while pos >= 0:
+            # keys are at the start of slots, not in values
+            if (pos - start) % size == 0 and self.__live(pos // size, now):
+                return pos // size
+            pos = self.__slots.find(key, pos + 1, end)
+        return None
+
+    def __victim(self, first: int, now: float) -> int:
+        """A free slot in the bucket, or the one set longest ago."""
+        stamps = self.__stamps
+        victim = first
+        for index in range(first, first + self.__ways):
+            if not self.__live(index, now):
+                return index
+            if stamps[index] < stamps[victim]:
+                victim = index
+        return victim
+
+    def __read(self, index) -> bytes:
+        off = index * self.__size
+        return self.__view[off + self.KEY_SIZE : off + self.__size].tobytes()
+
+    def __write(self, index, key: bytes, value: bytes, now: float):
+        if len(value) != self.value_size:
+            raise ValueError("value is not %i bytes" % self.value_size)
+        off = index * self.__size
+        self.__slots[off : off + self.__size] = key + value
+        self.__stamps[index] = now
+
+    def set(self, key, value: bytes):
+        key, lock, first = self.__key(key)
+        with lock:
+            now = time.monotonic() - self.__start
+            found = self.__find(key, first, now)
+            if found is None:
+                found = self.__victim(first, now)
+            self.__write(found, key, value, now)
+
+    def get(self, key) -> typing.Optional[bytes]:
+        key, lock, first = self.__key(key)
+        with lock:
+            found = self.__find(key, first, time.monotonic() - self.__start)
+            return None if found is None else self.__read(found)
+
+    def update(self, key, func: typing.Callable[[typing.Optional[bytes]], typing.Any]):
+        """Sets the key to func(current value or None), atomically, see MemoryDb.update."""
+        key, lock, first = self.__key(key)
+        with lock:
+            now = time.monotonic() - self.__start
+            found = self.__find(key, first, now)
+            value = func(None if found is None else self.__read(found))
+            if value is None:
+                if found is not None:
+                    self.__stamps[found] = 0
+            else:
+                if found is None:
+                    found = self.__victim(first, now)
+                self.__write(found, key, value, now)
+            return value
+
+    def clear(self):
+        for lock in self.__locks:
+            lock.acquire()
+        try:
+            self.__stamps[:] = array.array("f", bytes(len(self.__stamps) * 4))
+        finally:
+            for lock in self.__locks:
+                lock.release()
+
+    def items(self) -> typing.List[typing.Tuple[bytes, bytes]]:
+        items = []
+        for bucket in range(self.__buckets):
+            first = bucket * self.__ways
+            with self.__locks[bucket % len(self.__locks)]:
+                now = time.monotonic() - self.__start
+                for index in range(first, first + self.__ways):
+                    if self.__live(index, now):
+                        off = index * self.__size
+                        key = self.__view[off : off + self.KEY_SIZE].tobytes()
+                        items.append((key, self.__read(index)))
+        return items
+
+    def __len__(self):
+        return len(self.items())
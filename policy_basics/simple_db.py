@@ -2,19 +2,33 @@
 # SPDX-License-Identifier: LGPL-3.0-or-later
 
 import abc
+import asyncio
+import atexit
+import contextlib
+import functools
+import logging
+import queue
+import threading
+import time
 import typing
+import weakref
 
-import notanorm
+if typing.TYPE_CHECKING:
+    import notanorm
 
 DbVal = typing.Union[str, int, None]
 
 __autodoc__ = False
 
+log = logging.getLogger(__name__)
+
 
 class AbstractDb(abc.ABC):
     """Simple abstract get/set class."""
 
     _connected = False
+    # calls may wait on I/O, so async callers run them in a thread pool
+    blocking = True
 
     def connect(self):
         if not self._connected:
@@ -40,89 +54,848 @@ class AbstractDb(abc.ABC):
     def remove(self, key):
         ...
 
+    def set_many(self, items: typing.Iterable[typing.Tuple[typing.Any, DbVal]]):
+        for key, value in items:
+            self.set(key, value)
+
+    @abc.abstractmethod
+    def items(self) -> typing.Iterator[typing.Tuple[typing.Any, DbVal]]:
+        ...
+
+    def remove_if(self, key, value: DbVal) -> bool:
+        """Removes the key if it still has the value.  Returns True if removed."""
+        if self.get(key) != value:
+            return False
+        self.remove(key)
+        return True
+
+    def set_if(self, key, value: DbVal, expected: DbVal) -> bool:
+        """Sets the key if it still has the expected value, None for no value.
+
+        Returns True if set.  Not atomic here, dbs shared with others override this.
+        """
+        if self.get(key) != expected:
+            return False
+        self.set(key, value)
+        return True
+
+    def close(self):
+        ...
+
+
+class UpdateDb(AbstractDb):
+    """A db with an atomic update, that removes and compares and sets with it."""
+
+    @abc.abstractmethod
+    def update(self, key, func: typing.Callable[[typing.Any], typing.Any]):
+        """Sets the key to func(current value or None), atomically, see MemoryDb.update."""
+
+    def remove(self, key):
+        self.update(key, lambda value: None)
+
+    def remove_if(self, key, value) -> bool:
+        removed = False
+
+        def remove(current):
+            nonlocal removed
+            removed = current == value
+            return None if removed else current
+
+        self.update(key, remove)
+        return removed
+
+    def set_if(self, key, value, expected) -> bool:
+        swapped = False
+
+        def swap(current):
+            nonlocal swapped
+            swapped = current == expected
+            return value if swapped else current
+
+        self.update(key, swap)
+        return swapped
 
-class UriDb(AbstractDb):
-    """File based db."""
+
+class UriDb(AbstractDb):  # pylint: disable=too-many-instance-attributes
+    """File based db.
+
+    Up to pool_size connections are opened, as needed, so several threads can use the db at once.
+    Connections idle for more than health_check_secs are checked before use, and replaced if
+    they fail.
+    """
 
     TABLE_NAME = "vals"
     TEST_KEY = "^ufhvG6xWsMtTBkHhQQ+cZg!"
 
-    def __init__(self, path=None, *, uri=None, table=TABLE_NAME):
+    def __init__(
+        self, path=None, *, uri=None, table=None, pool_size=1, health_check_secs=30.0
+    ):
         assert not (path and uri), "one of path or uri, not both"
+        assert pool_size >= 1, "pool_size must be at least 1"
 
         if path:
             uri = "sqlite:" + str(path)
 
         self.uri = uri
-        self.table = table
+        self.table = table or self.TABLE_NAME
         self.db = None
+        self.pool_size = pool_size
+        self.health_check_secs = health_check_secs
+        # (connection, last used) of idle connections
+        self.__pool: "queue.LifoQueue[typing.Tuple[notanorm.DbBase, float]]" = (
+            queue.LifoQueue()
+        )
+        self.__pool_lock = threading.Lock()
+        self.__num_conns = 0
+        self.__local = threading.local()
 
         self.connect()
 
     def _connect(self):
         self.db = None
+        self.db = self.__open()
         try:
-            self.db = notanorm.open_db(self.uri)
+            self._create_table()
+            self._check_ok()
+        except Exception:
+            # close db if we fail to verify that it works
+            if self.db:
+                self.db.close()
+            raise
+        self.__num_conns = 1
+        self.__pool.put((self.db, time.monotonic()))
 
-            if self.db.uri_name == "sqlite":
-                self.db.execute("PRAGMA journal_mode=WAL;")
-                self.db.execute("PRAGMA synchronous=NORMAL;")
+    @staticmethod
+    def _setup(db: "notanorm.DbBase"):
+        # session settings, also used as a health check, since notanorm reconnects if dropped
+        if db.uri_name == "sqlite":
+            db.execute("PRAGMA journal_mode=WAL;")
+            db.execute("PRAGMA synchronous=NORMAL;")
 
-            if self.db.uri_name == "mysql":
-                self.db.execute("SET sql_mode='strict_trans_tables';")
+        if db.uri_name == "mysql":
+            db.execute("SET sql_mode='strict_trans_tables';")
 
-            self.db.execute_ddl(
-                "create table %s (key varchar(128) primary key, val text, ival integer)"
-                % self.table,
-                "mysql",
-            )
+    def __open(self) -> "notanorm.DbBase":
+        # notanorm, sqlglot and the db drivers are slow to import, only do so when used
+        import notanorm  # pylint: disable=import-outside-toplevel,redefined-outer-name
 
-            self.__check_ok()
+        db = notanorm.open_db(self.uri)
+        try:
+            self._setup(db)
         except Exception:
-            # close db if we fail to verify that it works
-            if self.db:
-                self.db.close()
+            db.close()
             raise
+        return db
 
-    def __check_ok(self):
+    def __checkout(self) -> "notanorm.DbBase":
+        try:
+            db, last_used = self.__pool.get_nowait()
+        except queue.Empty:
+            with self.__pool_lock:
+                grow = self.__num_conns < self.pool_size
+                if grow:
+                    self.__num_conns += 1
+            if not grow:
+                db, last_used = self.__pool.get()
+            else:
+                try:
+                    return self.__open()
+                except Exception:
+                    with self.__pool_lock:
+                        self.__num_conns -= 1
+                    raise
+
+        if db.closed or time.monotonic() - last_used > self.health_check_secs:
+            try:
+                if db.closed:
+                    raise ConnectionError("db connection closed")
+                self._setup(db)
+            except Exception as ex:  # pylint: disable=broad-except
+                log.warning("replacing failed db connection: %s", repr(ex))
+                try:
+                    db.close()
+                except Exception:  # pylint: disable=broad-except
+                    pass
+                try:
+                    new_db = self.__open()
+                except Exception:
+                    with self.__pool_lock:
+                        self.__num_conns -= 1
+                    raise
+                if db is self.db:
+                    self.db = new_db
+                db = new_db
+        return db
+
+    @contextlib.contextmanager
+    def _conn(self) -> typing.Iterator["notanorm.DbBase"]:
+        """Use a connection from the pool, nested calls in a thread use the same connection."""
+        db = getattr(self.__local, "db", None)
+        if db is not None:
+            yield db
+            return
+        db = self.__checkout()
+        self.__local.db = db
+        try:
+            yield db
+        finally:
+            self.__local.db = None
+            self.__pool.put((db, time.monotonic()))
+
+    def _create_table(self):
+        self.db.execute_ddl(
+            "create table %s (key varchar(128) primary key, val text, ival integer)"
+            % self.table,
+            "mysql",
+        )
+
+    def _check_ok(self):
         self.db.upsert(self.table, key=UriDb.TEST_KEY, ival=44)
         assert self.db.select_one(self.table, key=UriDb.TEST_KEY).ival == 44
         self.db.delete(self.table, key=UriDb.TEST_KEY)
 
     def set(self, key, value: DbVal):
-        # for speed, we do an unidiomatic type check
+        with self._conn() as db:
+            # for speed, we do an unidiomatic type check
+            if type(value) is str:  # pylint: disable=unidiomatic-typecheck
+                db.upsert(self.table, key=key, val=value, ival=None)
+            else:
+                db.upsert(self.table, key=key, ival=value, val=None)
+
+    @staticmethod
+    def __columns(value: DbVal) -> dict:
         if type(value) is str:  # pylint: disable=unidiomatic-typecheck
-            self.db.upsert(self.table, key=key, val=value, ival=None)
-        else:
-            self.db.upsert(self.table, key=key, ival=value, val=None)
+            return {"val": value, "ival": None}
+        return {"val": None, "ival": value}
+
+    def set_if(self, key, value: DbVal, expected: DbVal) -> bool:
+        with self._conn() as db:
+            if expected is None:
+                cur = db.upsert(self.table, key=key, _insert_only=self.__columns(value))
+            else:
+                where = {"key": key, **self.__columns(expected)}
+                cur = db.update(self.table, where, **self.__columns(value))
+        return cur.rowcount == 1
 
     def get(self, key) -> DbVal:
-        ret = self.db.select_one(self.table, key=key)
+        with self._conn() as db:
+            ret = db.select_one(self.table, key=key)
         if ret is None:
             return None
         return ret.ival if ret.val is None else ret.val
 
     def clear(self):
-        self.db.delete_all(self.table)
+        with self._conn() as db:
+            db.delete_all(self.table)
 
     def remove(self, key):
-        self.db.delete(self.table, key=key)
+        with self._conn() as db:
+            db.delete(self.table, key=key)
+
+    def set_many(self, items):
+        # one transaction, so one commit/sync
+        with self._conn() as db, db.transaction():
+            super().set_many(items)
+
+    def items(self, page=1000):
+        """Yields all keys and values, selected page rows at a time."""
+        import notanorm  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+        last = None
+        while True:
+            where = {} if last is None else {"key": notanorm.Op(">", last)}
+            with self._conn() as db:
+                rows = db.select(
+                    self.table,
+                    ["key", "val", "ival"],
+                    _order_by="key",
+                    _limit=page,
+                    **where,
+                )
+            for row in rows:
+                yield row.key, row.ival if row.val is None else row.val
+            if len(rows) < page:
+                return
+            last = rows[-1].key
+
+    def remove_if(self, key, value: DbVal) -> bool:
+        with self._conn() as db:
+            if type(value) is str:  # pylint: disable=unidiomatic-typecheck
+                cur = db.delete(self.table, key=key, val=value)
+            else:
+                cur = db.delete(self.table, key=key, val=None, ival=value)
+        return cur.rowcount == 1
+
+    def close(self):
+        while True:
+            try:
+                db, _ = self.__pool.get_nowait()
+            except queue.Empty:
+                break
+            db.close()
+        self.db.close()
+
+
+class _Shard:
+    """Keys of a MemoryDb with the same hash stripe, and their lock.
+
+    With gen_size, keys are kept in two generations of up to that many.  When the new
+    generation is full, the old one is dropped and the new one becomes old, keys used
+    in the old generation move to the new one.
+    """
+
+    __slots__ = ("lock", "new", "old", "gen_size")
+
+    def __init__(self, gen_size: typing.Optional[int]):
+        self.lock = threading.Lock()
+        self.new: typing.Dict[typing.Any, typing.Any] = {}
+        self.old: typing.Dict[typing.Any, typing.Any] = {}
+        self.gen_size = gen_size
+
+    def put(self, key, value):
+        self.new[key] = value
+        if self.gen_size and len(self.new) >= self.gen_size:
+            self.old = self.new
+            self.new = {}
+
+    def get(self, key):
+        value = self.new.get(key)
+        if value is None:
+            value = self.old.pop(key, None)
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def pop(self, key):
+        self.new.pop(key, None)
+        self.old.pop(key, None)
 
 
 class MemoryDb(AbstractDb):
-    """In memory db."""
+    """In memory db.
+
+    Keys are split into stripes by hash, each with its own lock, so threads using
+    different keys rarely wait on each other.
+
+    With max_entries, the least recently used keys in a stripe are dropped, about half of
+    its share at a time, with no per key bookkeeping.
+
+    With ttl_secs, keys not set for that long are gone.
+    """
+
+    blocking = False
+
+    def __init__(self, *, max_entries=None, ttl_secs=None, stripes=16):
+        assert max_entries is None or max_entries >= 2, "max_entries must be at least 2"
+        assert stripes >= 1, "stripes must be at least 1"
+        self.max_entries = max_entries
+        self.ttl_secs = ttl_secs
+        gen_size = None
+        if max_entries:
+            # each stripe gets two generations of at least two keys, if possible
+            stripes = max(1, min(stripes, max_entries // 4))
+            gen_size = max_entries // stripes // 2
+        # values are (value, expiry time) if there's a ttl
+        self.__shards = [_Shard(gen_size) for _ in range(stripes)]
+
+    def __shard(self, key) -> _Shard:
+        return self.__shards[hash(key) % len(self.__shards)]
+
+    def __unwrap(self, shard: _Shard, key, value):
+        if value is None or self.ttl_secs is None:
+            return value
+        value, expires = value
+        if expires <= time.monotonic():
+            shard.pop(key)
+            return None
+        return value
 
-    def __init__(self):
-        self.db = {}
+    def __wrap(self, value):
+        if self.ttl_secs is None:
+            return value
+        return value, time.monotonic() + self.ttl_secs
 
     def set(self, key, value):
-        self.db[key] = value
+        shard = self.__shard(key)
+        value = self.__wrap(value)
+        with shard.lock:
+            shard.old.pop(key, None)
+            shard.put(key, value)
 
     def get(self, key):
-        return self.db.get(key, None)
+        shard = self.__shard(key)
+        with shard.lock:
+            return self.__unwrap(shard, key, shard.get(key))
+
+    def update(self, key, func: typing.Callable[[typing.Any], typing.Any]):
+        """Sets the key to func(current value or None), atomically.
+
+        func is called with the key's stripe locked, so must be quick, and not use the db.
+        If it returns None, the key is removed.  Returns what func returned.
+        """
+        shard = self.__shard(key)
+        with shard.lock:
+            value = func(self.__unwrap(shard, key, shard.get(key)))
+            shard.old.pop(key, None)
+            if value is None:
+                shard.new.pop(key, None)
+            else:
+                shard.put(key, self.__wrap(value))
+            return value
 
     def clear(self):
-        self.db = {}
+        for shard in self.__shards:
+            with shard.lock:
+                shard.new = {}
+                shard.old = {}
 
     def remove(self, key):
-        self.db.pop(key, None)
+        shard = self.__shard(key)
+        with shard.lock:
+            shard.pop(key)
+
+    def remove_if(self, key, value) -> bool:
+        shard = self.__shard(key)
+        with shard.lock:
+            if self.__unwrap(shard, key, shard.get(key)) != value:
+                return False
+            shard.pop(key)
+            return True
+
+    def items(self):
+        items = []
+        for shard in self.__shards:
+            with shard.lock:
+                items += shard.old.items()
+                items += shard.new.items()
+        if self.ttl_secs is None:
+            return items
+        now = time.monotonic()
+        return [(k, v) for k, (v, expires) in items if expires > now]
+
+    def __len__(self):
+        return sum(len(shard.new) + len(shard.old) for shard in self.__shards)
+
+
+class AsyncDb:
+    """Async access to an AbstractDb.
+
+    Calls to a blocking db run in a thread pool, the event loop's default executor
+    unless one is given.  Calls to a non-blocking db run inline.
+    """
+
+    def __init__(self, db: AbstractDb, executor=None):
+        self.db = db
+        self.executor = executor
+
+    async def run(self, func, *args):
+        """Calls func(*args), in the thread pool if the db is blocking."""
+        if not self.db.blocking:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def set(self, key, value: DbVal):
+        await self.run(self.db.set, key, value)
+
+    async def get(self, key) -> typing.Optional[DbVal]:
+        return await self.run(self.db.get, key)
+
+    async def clear(self):
+        await self.run(self.db.clear)
+
+    async def remove(self, key):
+        await self.run(self.db.remove, key)
+
+    async def set_many(self, items: typing.Iterable[typing.Tuple[typing.Any, DbVal]]):
+        await self.run(self.db.set_many, list(items))
+
+
+class _OverLimits(Exception):
+    """Rolls back a reservation."""
+
+
+class CounterDb(UriDb):
+    """File based db of hour and day counters, with an atomic check-and-increment.
+
+    Keys are (rule_id, profile_id) tuples, values are dicts of the COLUMNS.  ver is
+    the row's version, for compare-and-swap with set_if.
+    """
+
+    TABLE_NAME = "throttle"
+    TEST_KEY = ("", UriDb.TEST_KEY)
+    COLUMNS = ["ts", "hour_cnt", "day_cnt", "lk", "ver"]
+
+    def _create_table(self):
+        self.db.execute_ddl(
+            "create table %s (rule_id varchar(128) not null, profile_id varchar(64) not null, "
+            "ts double, hour_cnt integer not null default 0, day_cnt integer not null default 0, "
+            "lk varchar(32), ver integer not null default 0, primary key (rule_id, profile_id)); "
+            "create index %s_ts on %s (ts)" % (self.table, self.table, self.table),
+            "mysql",
+        )
+
+    def _check_ok(self):
+        # on the connection being checked, the pool is still empty
+        rule_id, profile_id = CounterDb.TEST_KEY
+        key = {"rule_id": rule_id, "profile_id": profile_id}
+        self.db.upsert(self.table, **key, ts=0, hour_cnt=44, day_cnt=0)
+        assert self.db.select_one(self.table, **key).hour_cnt == 44
+        self.db.delete(self.table, **key)
+
+    def set(self, key, value: dict):
+        rule_id, profile_id = key
+        with self._conn() as db:
+            db.upsert(self.table, rule_id=rule_id, profile_id=profile_id, **value)
+
+    def get(self, key) -> typing.Optional[dict]:
+        rule_id, profile_id = key
+        with self._conn() as db:
+            ret = db.select_one(
+                self.table, self.COLUMNS, rule_id=rule_id, profile_id=profile_id
+            )
+        return ret and dict(ret.items())
+
+    def insert_missing(self, key, value: dict) -> bool:
+        """Insert the row, unless there already is one.  Returns True if inserted."""
+        rule_id, profile_id = key
+        with self._conn() as db:
+            cur = db.upsert(
+                self.table, rule_id=rule_id, profile_id=profile_id, _insert_only=value
+            )
+        return cur.rowcount == 1
+
+    def remove(self, key):
+        rule_id, profile_id = key
+        with self._conn() as db:
+            db.delete(self.table, rule_id=rule_id, profile_id=profile_id)
+
+    def set_if(self, key, value: dict, expected: typing.Optional[dict]) -> bool:
+        """Sets the row if its version is still the expected row's, None for no row.
+
+        Returns True if set.  Writers should change the version on every set.
+        """
+        if expected is None:
+            return self.insert_missing(key, value)
+        rule_id, profile_id = key
+        where = {"rule_id": rule_id, "profile_id": profile_id, "ver": expected["ver"]}
+        with self._conn() as db:
+            return db.update(self.table, where, **value).rowcount == 1
+
+    def sweep(self, cutoff: float, max_rows: typing.Optional[int] = None) -> int:
+        """Removes rows last written before cutoff, oldest first.  Returns the number removed."""
+        import notanorm  # pylint: disable=import-outside-toplevel,redefined-outer-name
+
+        with self._conn() as db:
+            rows = db.select(
+                self.table,
+                ["rule_id", "profile_id"],
+                ts=notanorm.Op("<", cutoff),
+                _order_by="ts",
+                _limit=max_rows,
+            )
+            removed = 0
+            with db.transaction():
+                for row in rows:
+                    # unless written since the select
+                    removed += db.delete(
+                        self.table,
+                        rule_id=row.rule_id,
+                        profile_id=row.profile_id,
+                        ts=notanorm.Op("<", cutoff),
+                    ).rowcount
+        return removed
+
+    def trim(self, max_rows: int) -> int:
+        """Removes the least recently written rows past max_rows.  Returns the number removed."""
+        with self._conn() as db:
+            excess = db.count(self.table) - max_rows
+            if excess <= 0:
+                return 0
+            rows = db.select(
+                self.table,
+                ["rule_id", "profile_id", "ts"],
+                _order_by="ts",
+                _limit=excess,
+            )
+            removed = 0
+            with db.transaction():
+                for row in rows:
+                    # unless written since the select
+                    removed += db.delete(
+                        self.table,
+                        rule_id=row.rule_id,
+                        profile_id=row.profile_id,
+                        ts=row.ts,
+                    ).rowcount
+        return removed
+
+    def reserve(  # pylint: disable=too-many-arguments
+        self, key, now: float, *, hour_start: float, day_start: float, per_hour, per_day
+    ) -> bool:
+        """Increment the counts if they are below the limits, in one statement.
+
+        Counts from before hour_start or day_start are treated as zero, limits < 0 are unlimited.
+
+        Returns True if the counts were incremented.
+        """
+        rule_id, profile_id = key
+        ph = self.db.placeholder
+        hour = f"(case when ts >= {ph} then hour_cnt else 0 end)"
+        day = f"(case when ts >= {ph} then day_cnt else 0 end)"
+        # mysql assigns left to right, so ts must be last
+        sql = (
+            f"update {self.table} set hour_cnt = {hour} + 1, day_cnt = {day} + 1, "
+            f"ver = ver + 1, ts = {ph} "
+            f"where rule_id = {ph} and profile_id = {ph} "
+            f"and ({ph} < 0 or {hour} < {ph}) and ({ph} < 0 or {day} < {ph})"
+        )
+        params = (
+            hour_start,
+            day_start,
+            now,
+            rule_id,
+            profile_id,
+            per_hour,
+            hour_start,
+            per_hour,
+            per_day,
+            day_start,
+            per_day,
+        )
+        with self._conn() as db:
+            if db.execute(sql, params).rowcount:
+                return True
+            if per_hour == 0 or per_day == 0:
+                return False
+            # no row yet, insert unless someone else just did
+            if self.insert_missing(key, {"ts": now, "hour_cnt": 1, "day_cnt": 1}):
+                return True
+            return bool(db.execute(sql, params).rowcount)
+
+    def reserve_many(
+        self,
+        reservations: typing.Sequence[typing.Tuple[typing.Any, int, int]],
+        now: float,
+        *,
+        hour_start: float,
+        day_start: float,
+    ) -> bool:
+        """Reserve for each (key, per_hour, per_day) in one transaction, see reserve.
+
+        Returns True if all were reserved, False and changes nothing if any are over limits.
+        """
+        with self._conn() as db:
+            try:
+                with db.transaction():
+                    for key, per_hour, per_day in reservations:
+                        if not self.reserve(
+                            key,
+                            now,
+                            hour_start=hour_start,
+                            day_start=day_start,
+                            per_hour=per_hour,
+                            per_day=per_day,
+                        ):
+                            raise _OverLimits
+            except _OverLimits:
+                return False
+        return True
+
+    def release_many(
+        self, keys: typing.Iterable[typing.Any], *, hour_start: float, day_start: float
+    ):
+        """Takes back a reservation of each key, in one transaction.
+
+        Counts from before hour_start or day_start, which have already reset, are left.
+        """
+        ph = self.db.placeholder
+        hour = f"(case when ts >= {ph} and hour_cnt > 0 then hour_cnt - 1 else hour_cnt end)"
+        day = (
+            f"(case when ts >= {ph} and day_cnt > 0 then day_cnt - 1 else day_cnt end)"
+        )
+        sql = (
+            f"update {self.table} set hour_cnt = {hour}, day_cnt = {day}, ver = ver + 1 "
+            f"where rule_id = {ph} and profile_id = {ph}"
+        )
+        with self._conn() as db, db.transaction():
+            for rule_id, profile_id in keys:
+                db.execute(sql, (hour_start, day_start, rule_id, profile_id))
+
+
+_write_behind_dbs: "weakref.WeakSet[WriteBehindDb]" = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_write_behind():
+    for db in list(_write_behind_dbs):
+        db.flush()
+
+
+class WriteBehindDb(AbstractDb):  # pylint: disable=too-many-instance-attributes
+    """Serves values from memory, writes to a backing db in batches.
+
+    Changes are written after max_staleness seconds, or after flush_count changes.
+    Values cached from the backing db are re-read after max_staleness seconds.
+
+    Only one process should write to the backing db.  Closing closes the backing db too,
+    unless close_backing is False.
+    """
+
+    _REMOVED = object()
+
+    def __init__(
+        self,
+        backing: AbstractDb,
+        *,
+        max_staleness=1.0,
+        flush_count=100,
+        close_backing=True,
+    ):
+        self.backing = backing
+        self.close_backing = close_backing
+        self.max_staleness = max_staleness
+        self.flush_count = flush_count
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__swap_lock = threading.Lock()
+        # key -> (value, time read)
+        self.__cache: typing.Dict[typing.Any, typing.Tuple[typing.Any, float]] = {}
+        self.__dirty: typing.Dict[typing.Any, typing.Any] = {}
+        # changes being written, read from here until they are
+        self.__flushing: typing.Dict[typing.Any, typing.Any] = {}
+        self.__timer: typing.Optional[threading.Timer] = None
+        self.__changes = 0
+        _write_behind_dbs.add(self)
+
+    def get(self, key):
+        with self.__lock:
+            for changes in (self.__dirty, self.__flushing):
+                if key in changes:
+                    value = changes[key]
+                    return None if value is self._REMOVED else value
+            ent = self.__cache.get(key)
+            if ent and time.monotonic() - ent[1] < self.max_staleness:
+                return ent[0]
+            changes = self.__changes
+        value = self.backing.get(key)
+        with self.__lock:
+            # don't cache if it may have changed while reading
+            if changes == self.__changes:
+                self.__cache[key] = (value, time.monotonic())
+        return value
+
+    def set(self, key, value):
+        self.__change(key, value)
+
+    def remove(self, key):
+        self.__change(key, self._REMOVED)
+
+    def __change(self, key, value):
+        with self.__lock:
+            self.__dirty[key] = value
+            self.__changes += 1
+            self.__cache.pop(key, None)
+            flush_now = len(self.__dirty) >= self.flush_count
+            if not flush_now:
+                self.__start_timer()
+        if flush_now:
+            self.flush()
+
+    def __start_timer(self):
+        # called with the lock held
+        if not self.__timer:
+            self.__timer = threading.Timer(self.max_staleness, self.__timed_flush)
+            self.__timer.daemon = True
+            self.__timer.start()
+
+    def items(self):
+        self.flush()
+        return self.backing.items()
+
+    def remove_if(self, key, value) -> bool:
+        with self.__lock:
+            if key in self.__dirty or key in self.__flushing:
+                return False
+            self.__cache.pop(key, None)
+            self.__changes += 1
+        return self.backing.remove_if(key, value)
+
+    def set_if(self, key, value, expected) -> bool:
+        # only this process writes, so checking what it would read is enough
+        with self.__swap_lock:
+            if self.get(key) != expected:
+                return False
+            self.set(key, value)
+            return True
+
+    def sweep(self, cutoff: float, max_rows: typing.Optional[int] = None) -> int:
+        """Removes old rows from a backing db with a sweep method, see CounterDb.sweep."""
+        self.flush()
+        with self.__lock:
+            self.__cache = {}
+            self.__changes += 1
+        return self.backing.sweep(cutoff, max_rows)
+
+    def trim(self, max_rows: int) -> int:
+        """Removes rows past max_rows from a backing db with a trim method, see CounterDb.trim."""
+        self.flush()
+        with self.__lock:
+            self.__cache = {}
+            self.__changes += 1
+        return self.backing.trim(max_rows)
+
+    def clear(self):
+        with self.__flush_lock, self.__lock:
+            self.__dirty = {}
+            self.__cache = {}
+            self.__changes += 1
+            self.backing.clear()
+
+    def __timed_flush(self):
+        try:
+            self.flush()
+        except Exception:  # pylint: disable=broad-except
+            # already logged, changes are kept for the next flush
+            pass
+
+    def flush(self):
+        """Write all changes to the backing db."""
+        with self.__flush_lock:
+            with self.__lock:
+                dirty, self.__dirty = self.__dirty, {}
+                self.__flushing = dirty
+                if self.__timer:
+                    self.__timer.cancel()
+                    self.__timer = None
+            if not dirty:
+                return
+            try:
+                self.backing.set_many(
+                    (k, v) for k, v in dirty.items() if v is not self._REMOVED
+                )
+                for key, value in dirty.items():
+                    if value is self._REMOVED:
+                        self.backing.remove(key)
+            except Exception as ex:
+                log.error("write behind flush failed: %s", repr(ex))
+                with self.__lock:
+                    # keep unwritten changes, unless there are newer ones
+                    for key, value in dirty.items():
+                        self.__dirty.setdefault(key, value)
+                    self.__flushing = {}
+                    self.__start_timer()
+                raise
+            with self.__lock:
+                # the backing db now has these, and reads started before may not
+                now = time.monotonic()
+                for key, value in dirty.items():
+                    self.__cache[key] = (None if value is self._REMOVED else value, now)
+                self.__flushing = {}
+                self.__changes += 1
+
+    def close(self):
+        self.flush()
+        _write_behind_dbs.discard(self)
+        if self.close_backing:
+            self.backing.close()
@@ -1,11 +1,16 @@
 # SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
 # SPDX-License-Identifier: LGPL-3.0-or-later
 
+import bisect
+import functools
 import logging
-from typing import Optional, Set, Iterable
-from datetime import date, time, datetime
+import os
+import re
+import threading
+import time as _time
+from typing import Dict, Optional, Set, Iterable, Iterator, List, Tuple, Union
+from datetime import date, time, datetime, timedelta, timezone, tzinfo
 
-import dateutil.parser
 from atakama import RulePlugin, ApprovalRequest
 
 log = logging.getLogger(__name__)
@@ -14,7 +19,205 @@ log.setLevel(logging.INFO)
 LOCAL_TIMEZONE = datetime.now().astimezone().tzinfo
 
 
-class TimeArgs:
+class DateSet:
+    """Set of dates, kept as a bitset of day ordinals."""
+
+    def __init__(self, dates: Iterable[date]):
+        ordinals = sorted({day.toordinal() for day in dates})
+        self.first = ordinals[0] if ordinals else 0
+        bits = bytearray((ordinals[-1] - self.first) // 8 + 1 if ordinals else 0)
+        for ordinal in ordinals:
+            i = ordinal - self.first
+            bits[i >> 3] |= 1 << (i & 7)
+        self.bits = bytes(bits)
+        self.count = len(ordinals)
+
+    def __contains__(self, day: date) -> bool:
+        i = day.toordinal() - self.first
+        return 0 <= i < len(self.bits) * 8 and bool(self.bits[i >> 3] >> (i & 7) & 1)
+
+    def __iter__(self) -> Iterator[date]:
+        for i in range(len(self.bits) * 8):
+            if self.bits[i >> 3] >> (i & 7) & 1:
+                yield date.fromordinal(self.first + i)
+
+    def __len__(self):
+        return self.count
+
+
+def _parse_any(text: str) -> datetime:
+    # dateutil is slow to import, and only needed for the less usual formats
+    import dateutil.parser  # pylint: disable=import-outside-toplevel
+
+    return dateutil.parser.parse(text)
+
+
+def _parse_date(text: str) -> date:
+    # the usual fixed formats without dateutil: 2022-03-07 and 20220307
+    if len(text) == 10 and text[4] == "-" and text[7] == "-":
+        return date(int(text[:4]), int(text[5:7]), int(text[8:]))
+    if len(text) == 8 and text.isdigit():
+        return date(int(text[:4]), int(text[4:6]), int(text[6:]))
+    return _parse_any(text).date()
+
+
+# hh:mm[:ss], am or pm, and utc or an offset, the formats used in policies
+_TIME_RE = re.compile(
+    r"(\d{1,2}):(\d\d)(?::(\d\d))?\s*(?:([ap])\.?m\.?)?"
+    r"\s*(?:(z|utc|gmt)|([+-])(\d\d):?(\d\d))?",
+    re.IGNORECASE,
+)
+
+
+def _parse_fixed_time(text: str) -> Optional[time]:
+    """Times in the usual formats without dateutil, None for others."""
+    match = _TIME_RE.fullmatch(text.strip())
+    if not match:
+        return None
+    hour, minute, second, ampm, utc, sign, off_hour, off_min = match.groups()
+    hour, minute, second = int(hour), int(minute), int(second or 0)
+    if ampm:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if ampm.lower() == "p" else 0)
+    if hour > 23 or minute > 59 or second > 59:
+        return None
+    tz = None
+    if utc:
+        tz = timezone.utc
+    elif sign:
+        offset = timedelta(hours=int(off_hour), minutes=int(off_min))
+        if offset >= timedelta(days=1):
+            return None
+        tz = timezone(-offset if sign == "-" else offset)
+    return time(hour, minute, second, tzinfo=tz)
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_time(text: str) -> time:
+    # rules often repeat the same times, and the results are immutable
+    timetz = _parse_fixed_time(text)
+    if timetz is None:
+        timetz = _parse_any(text).timetz()
+    if not timetz.tzinfo:
+        timetz = timetz.replace(tzinfo=LOCAL_TIMEZONE)
+    return timetz
+
+
+_parse_cached_date = functools.lru_cache(maxsize=4096)(_parse_date)
+
+
+# recurring events without an end are expanded this far ahead of loading the file
+_RECUR_DAYS = 10 * 366
+
+
+def _ics_lines(lines: Iterable[str]) -> Iterator[str]:
+    """Unfolds long lines, continued on lines starting with a space or tab."""
+    prev = None
+    for line in lines:
+        if prev is not None and line[:1] in (" ", "\t"):
+            prev += line[1:]
+            continue
+        if prev is not None:
+            yield prev
+        prev = line
+    if prev is not None:
+        yield prev
+
+
+def _recurrences(start: date, rule: str) -> Iterator[date]:
+    """Days an RRULE repeats an event starting on start, the first is start."""
+    # dateutil is slow to import, and only needed for recurring events
+    import dateutil.rrule  # pylint: disable=import-outside-toplevel
+
+    # only days are used, and a naive start can't have a utc end
+    rule = re.sub(r"(UNTIL=\d{8})[^;]*", r"\1", rule, flags=re.IGNORECASE)
+    first = datetime.combine(start, time())
+    horizon = datetime.combine(date.today(), time()) + timedelta(days=_RECUR_DAYS)
+    try:
+        recur = dateutil.rrule.rrulestr(rule, dtstart=first)
+    except ValueError as ex:
+        raise ValueError("invalid RRULE %r: %s" % (rule, ex)) from None
+    for when in recur:
+        if when > horizon:
+            return
+        yield when.date()
+
+
+def _ics_dates(lines: Iterable[str]) -> Iterator[date]:
+    """Days of each event, from its DTSTART up to its DTEND, as written.
+
+    Recurring events use the days of each RRULE and RDATE occurrence, except EXDATEs.
+    """
+    start = end = rule = None
+    extra: Set[date] = set()
+    excluded: Set[date] = set()
+    # components, only properties directly in a VEVENT are its own, not a VTIMEZONE's
+    nested: List[str] = []
+    for line in _ics_lines(lines):
+        name, _, value = line.strip().partition(":")
+        prop = name.split(";", 1)[0].upper()
+        if prop == "BEGIN":
+            nested.append(value.upper())
+            if nested[-1] == "VEVENT":
+                start = end = rule = None
+                extra = set()
+                excluded = set()
+        elif prop == "END":
+            if nested and nested.pop() == "VEVENT" and start:
+                starts = set(_recurrences(start, rule)) if rule else {start}
+                length = max(((end or start) - start).days, 1)
+                for first in sorted((starts | extra) - excluded):
+                    for days in range(length):
+                        yield first + timedelta(days=days)
+        elif not nested or nested[-1] != "VEVENT":
+            continue
+        elif prop == "DTSTART":
+            start = _parse_date(value[:8])
+        elif prop == "DTEND":
+            # dates end the day before, times on the day
+            end = _parse_date(value[:8]) + timedelta(days=value[9:].strip("0Z") != "")
+        elif prop == "RRULE":
+            rule = value
+        elif prop in ("RDATE", "EXDATE"):
+            # dates, times or periods, only the days are used
+            days = {_parse_date(val.strip()[:8]) for val in value.split(",")}
+            (extra if prop == "RDATE" else excluded).update(days)
+
+
+# path -> (mtime, dates), so rules using the same file share its dates
+_calendars: Dict[str, Tuple[float, DateSet]] = {}
+_calendars_lock = threading.Lock()
+
+
+def load_calendar(path: str) -> DateSet:
+    """Dates in a calendar file, either an ICS file, or one date per line.
+
+    Lines starting with # are ignored.  Files are re-read when changed.
+    """
+    path = os.path.realpath(path)
+    mtime = os.stat(path).st_mtime
+    with _calendars_lock:
+        ent = _calendars.get(path)
+        if ent and ent[0] == mtime:
+            return ent[1]
+    with open(path, encoding="utf-8-sig") as fh:
+        lines = fh.read().splitlines()
+    if any(line.strip().upper() == "BEGIN:VCALENDAR" for line in lines[:1]):
+        dates = DateSet(_ics_dates(lines))
+    else:
+        dates = DateSet(
+            _parse_date(line.strip())
+            for line in lines
+            if line.strip() and not line.lstrip().startswith("#")
+        )
+    log.debug("loaded %i dates from %s", len(dates), path)
+    with _calendars_lock:
+        _calendars[path] = (mtime, dates)
+    return dates
+
+
+class TimeArgs:  # pylint: disable=too-many-instance-attributes
     # see https://docs.python.org/3/library/datetime.html#datetime.date.weekday
     ALL_DAYS: Set[int] = [0, 1, 2, 3, 4, 5, 6]
 
@@ -25,10 +228,17 @@ class TimeArgs:
         exclude: Iterable[date],
         time_start: Optional[time] = None,
         time_end: Optional[time] = None,
+        *,
+        time_ranges: Iterable[Tuple[time, time]] = (),
+        include_calendars: Iterable[DateSet] = (),
+        exclude_calendars: Iterable[DateSet] = (),
     ):
         self.days_of_week = set(days)
         self.include = set(include)
         self.exclude = set(exclude)
+        # shared with other rules, excludes win over includes
+        self.include_calendars = list(include_calendars)
+        self.exclude_calendars = list(exclude_calendars)
         self.time_of_day_start = time_start
         self.time_of_day_end = time_end
         assert not self.include.intersection(
@@ -37,22 +247,82 @@ class TimeArgs:
         assert bool(time_start) == bool(
             time_end
         ), "must have both time start and end, or neither"
-        assert not time_start or (
-            time_start < time_end
-        ), "time start must be less than time end"
+        # (start, end, past midnight), a range ending before it starts ends the next day
+        self.time_ranges: List[Tuple[time, time, bool]] = []
+        for start, end in ([(time_start, time_end)] if time_start else []) + list(
+            time_ranges
+        ):
+            assert start and end, "must have both time start and end"
+            assert start != end, "time start must not be time end"
+            self.time_ranges.append((start, end, end < start))
         assert all(0 <= d <= 6 for d in self.days_of_week), "invalid day of week"
+        # day start, next day start, allowed ranges, for in_range_at
+        self.__day: Tuple[float, float, Tuple[float, ...]] = (0.0, 0.0, ())
 
     def in_range(self, now: datetime):
-        if now.date() in self.exclude:
-            return False
+        """Whether now is in range, on its day in its own timezone."""
+        tz = now.tzinfo or LOCAL_TIMEZONE
+        timestamp = now.replace(tzinfo=tz).timestamp()
+        return self.__within(self.__schedule(timestamp, tz)[2], timestamp)
 
-        if now.date() not in self.include and now.weekday() not in self.days_of_week:
-            return False
+    def in_range_at(self, timestamp: float) -> bool:
+        """Same as in_range for the local time at timestamp.
 
-        if not (self.time_of_day_start and self.time_of_day_end):
-            return True
+        The allowed times are worked out once per day, after that this is a bisection of
+        the day's ranges.
+        """
+        day = self.__day
+        if not day[0] <= timestamp < day[1]:
+            day = self.__day = self.__schedule(timestamp, LOCAL_TIMEZONE)
+        return self.__within(day[2], timestamp)
 
-        return self.time_of_day_start <= now.timetz() <= self.time_of_day_end
+    @staticmethod
+    def __within(bounds: Tuple[float, ...], timestamp: float) -> bool:
+        # starts are at even indexes, and ends are in range too
+        i = bisect.bisect_right(bounds, timestamp)
+        return i % 2 == 1 or (i > 0 and bounds[i - 1] == timestamp)
+
+    def __allowed(self, day: date) -> bool:
+        if day in self.exclude or any(day in cal for cal in self.exclude_calendars):
+            return False
+        return (
+            day in self.include
+            or day.weekday() in self.days_of_week
+            or any(day in cal for cal in self.include_calendars)
+        )
+
+    def __schedule(
+        self, timestamp: float, tz: tzinfo
+    ) -> Tuple[float, float, Tuple[float, ...]]:
+        """The day of timestamp in tz, and the sorted start and end times in range on it."""
+        today = datetime.fromtimestamp(timestamp, tz).date()
+        midnight = datetime.combine(today, time(), tz)
+        day = (midnight.timestamp(), (midnight + timedelta(days=1)).timestamp())
+        ranges = []
+        if not self.time_ranges and self.__allowed(today):
+            ranges.append(day)
+        # ranges past midnight that started yesterday, and today's
+        for when in (today - timedelta(days=1), today):
+            if not self.__allowed(when):
+                continue
+            for start, end, overnight in self.time_ranges:
+                if when != today and not overnight:
+                    continue
+                # as for times, ranges in other timezones are on this day
+                begin = datetime.combine(when, start).timestamp()
+                finish = datetime.combine(
+                    when + timedelta(days=overnight), end
+                ).timestamp()
+                begin, finish = max(begin, day[0]), min(finish, day[1])
+                if begin <= finish:
+                    ranges.append((begin, finish))
+        bounds: List[float] = []
+        for begin, finish in sorted(ranges):
+            if bounds and begin <= bounds[-1]:
+                bounds[-1] = max(bounds[-1], finish)
+            else:
+                bounds += [begin, finish]
+        return (*day, tuple(bounds))
 
     @classmethod
     def from_dict(cls, args):
@@ -62,21 +332,39 @@ class TimeArgs:
             exclude=cls.strs_to_dates(args.get("exclude", set())),
             time_start=cls.str_to_time(args.get("time_start", None)),
             time_end=cls.str_to_time(args.get("time_end", None)),
+            time_ranges=[
+                (
+                    cls.str_to_time(ent.get("time_start")),
+                    cls.str_to_time(ent.get("time_end")),
+                )
+                for ent in args.get("time_ranges", [])
+            ],
+            include_calendars=cls.files_to_calendars(args.get("include_file")),
+            exclude_calendars=cls.files_to_calendars(args.get("exclude_file")),
         )
 
+    @staticmethod
+    def files_to_calendars(paths: Union[str, Iterable[str], None]) -> List[DateSet]:
+        if isinstance(paths, str):
+            paths = [paths]
+        return [load_calendar(path) for path in paths or []]
+
     @staticmethod
     def strs_to_dates(strs: Iterable[str]):
+        """Dates, yyyy-mm-dd is parsed directly, anything else by dateutil."""
         assert not isinstance(strs, str), "input must be iterable of str"
-        return [dateutil.parser.parse(s).date() for s in strs]
+        return [_parse_cached_date(s) for s in strs]
 
     @staticmethod
     def str_to_time(tim: Optional[str]):
+        """Time of day, in the local timezone if none is given.
+
+        hh:mm, with optional seconds, am or pm, and utc or an offset, is parsed directly,
+        anything else by dateutil.
+        """
         if not tim:
             return None
-        timetz = dateutil.parser.parse(tim).timetz()
-        if not timetz.tzinfo:
-            timetz = timetz.replace(tzinfo=LOCAL_TIMEZONE)
-        return timetz
+        return _parse_time(tim)
 
 
 class TimeRangeRule(RulePlugin):
@@ -85,10 +373,17 @@ class TimeRangeRule(RulePlugin):
 
     YML Arguments:
      - time_start: time start (hh:mm)
-     - time_end: time end (hh:mm)
+     - time_end: time end (hh:mm), before time start for a range past midnight, which
+       ends the next day
+     - time_ranges: list of more ranges, each with a time_start and time_end
      - days: list of days of the week, monday=0, default is 0-6
      - include: list of specific dates to include
      - exclude: list of specific dates to exclude
+     - include_file: calendar file, or list of them, of dates to include
+     - exclude_file: calendar file, or list of them, of dates to exclude, even if
+       included.  Calendar files are ICS files, using the dates of each event, or have
+       a date (yyyy-mm-dd) per line.  Events that recur without an end are used for
+       the next 10 years.  Rules using the same file share one copy of it.
 
     ```
     Example:
@@ -97,6 +392,19 @@ class TimeRangeRule(RulePlugin):
           time_end: 5:00pm
           exclude: 2022-06-01
     ```
+
+    Days, includes and excludes are the days that ranges start on.
+
+    ```
+    Example:
+        - rule: time-range-rule
+          days: [0, 1, 2, 3, 4]
+          time_ranges:
+            - time_start: 6:00am
+              time_end: 10:00am
+            - time_start: 10:00pm
+              time_end: 2:00am
+    ```
     """
 
     @staticmethod
@@ -108,8 +416,8 @@ class TimeRangeRule(RulePlugin):
         self.times = TimeArgs.from_dict(args)
 
     def approve_request(self, request: ApprovalRequest) -> Optional[bool]:
-        now = datetime.now(tz=LOCAL_TIMEZONE)
-        res = self.times.in_range(now)
+        now = _time.time()
+        res = self.times.in_range_at(now)
         log.debug(
             "TimeRangeRule.approve_request rule_id=%s now=%s res=%s",
             self.rule_id,
@@ -0,0 +1,109 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import asyncio
+import threading
+
+import atakama
+from atakama import ProfileInfo, ApprovalRequest, RequestType
+
+from policy_basics.async_rules import approve_engine
+from policy_basics.per_profile_throttle import ProfileThrottleRule
+from policy_basics.shared_db import MmapDb
+from policy_basics.simple_db import AsyncDb, MemoryDb, UriDb
+
+
+def make_request(pid=b"pid", request_type=RequestType.DECRYPT):
+    return ApprovalRequest(
+        request_type=request_type,
+        device_id=b"whatever",
+        profile=ProfileInfo(profile_id=pid, profile_words=[]),
+        auth_meta=None,
+        cryptographic_id=None,
+    )
+
+
+def test_async_db(tmp_path):
+    main = threading.get_ident()
+
+    def where():
+        return threading.get_ident()
+
+    async def run():
+        mem = AsyncDb(MemoryDb())
+        await mem.set("k", "v")
+        assert await mem.get("k") == "v"
+        assert await mem.run(where) == main
+
+        uri = AsyncDb(UriDb(tmp_path / "quote.db"))
+        await uri.set_many((k, "v") for k in "abc")
+        assert await uri.get("c") == "v"
+        await uri.remove("c")
+        assert await uri.get("c") is None
+        assert await uri.run(where) != main
+
+        # waits on other processes' locks
+        mapped = AsyncDb(MmapDb(tmp_path / "quote.mmap", slots=8, stripes=1))
+        assert await mapped.run(where) != main
+
+    asyncio.run(run())
+
+
+def test_throttle_async(tmp_path):
+    pr = ProfileThrottleRule(
+        {
+            "per_hour": 2,
+            "persistent": True,
+            "db-file": tmp_path / "quote.db",
+            "rule_id": "rid",
+        }
+    )
+    req = make_request()
+
+    async def run():
+        res = []
+        for _ in range(3):
+            ok = await pr.approve_request_async(req)
+            if ok:
+                await pr.use_quota_async(req)
+            res.append(ok)
+        return res
+
+    assert asyncio.run(run()) == [True, True, False]
+
+
+def test_engine_async(tmp_path):
+    cfg = {
+        "decrypt": [
+            [{"rule": "profile-id-rule", "profile_ids": [b"admin".hex()]}],
+            [
+                {"rule": "approve-rule"},
+                {
+                    "rule": "per-profile-throttle-rule",
+                    "per_day": 3,
+                    "persistent": True,
+                    "db-file": str(tmp_path / "quote.db"),
+                },
+            ],
+        ]
+    }
+    engine = atakama.RuleEngine.from_dict(cfg)
+    admin_set, throttle_set = engine.map[RequestType.DECRYPT]
+
+    async def run():
+        return await asyncio.gather(
+            *(approve_engine(engine, make_request()) for _ in range(10))
+        )
+
+    # evaluations of a rule set are serialized, so the quota isn't exceeded
+    res = asyncio.run(run())
+    assert res.count(id(throttle_set)) == 3
+    assert res.count(False) == 7
+
+    assert asyncio.run(approve_engine(engine, make_request(b"admin"))) == id(admin_set)
+    assert (
+        asyncio.run(
+            approve_engine(engine, make_request(request_type=RequestType.SEARCH))
+        )
+        is None
+    )
@@ -0,0 +1,64 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import json
+import subprocess
+import sys
+
+# slow to import, only needed by some rules
+SLOW_MODULES = ["dateutil", "notanorm", "sqlglot", "redis"]
+
+
+def imported_after(code: str):
+    """Runs code in a fresh interpreter, returns the slow modules it imported."""
+    code += (
+        "\nimport json, sys\nprint(json.dumps([m for m in %r if m in sys.modules]))"
+        % (SLOW_MODULES,)
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def import_secs(module: str) -> float:
+    """Time to import the module in a fresh interpreter, after atakama, which it needs."""
+    code = (
+        "import atakama, time\n"
+        "start = time.perf_counter()\n"
+        "import %s\n"
+        "print(time.perf_counter() - start)" % module
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return float(out.splitlines()[-1])
+
+
+def test_import_time():
+    # about 0.1s here, the limit leaves room for slow machines
+    assert min(import_secs("policy_basics") for _ in range(3)) < 0.5
+    assert imported_after("import policy_basics") == []
+
+    # rules that don't need them, with usual times and dates
+    assert (
+        imported_after(
+            "from policy_basics import TimeRangeRule, ProfileThrottleRule\n"
+            "TimeRangeRule({'time_start': '9:00am', 'time_end': '17:00', "
+            "'include': ['2022-03-07'], 'rule_id': 'rid'})\n"
+            "ProfileThrottleRule({'per_day': 3, 'rule_id': 'rid'})"
+        )
+        == []
+    )
+
+    # only when used
+    assert "dateutil" in imported_after(
+        "from policy_basics import TimeRangeRule\n"
+        "TimeRangeRule({'include': ['March 7, 2022'], 'rule_id': 'rid'})"
+    )
@@ -1,6 +1,10 @@
 # SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
 # SPDX-License-Identifier: LGPL-3.0-or-later
 
+import collections
+import itertools
+import re
+
 from atakama import ApprovalRequest, MetaInfo
 
 from policy_basics.meta_str import MetaRule
@@ -166,3 +170,182 @@ def test_require_complete():
     )
     assert not pr.approve_request(meta("root/sub/path/basename.ext", complete=False))
     assert pr.approve_request(meta("root/sub/path/basename.ext", complete=True))
+
+
+def in_order(regexes, norm):
+    """The result of checking each (regex, invert) in order."""
+    should_approve = False
+    for regex, invert in regexes:
+        if invert:
+            if re.search(regex, norm):
+                break
+            should_approve = True
+        elif re.search(regex, norm):
+            should_approve = True
+            break
+    return should_approve
+
+
+def test_meta_first_match_order():
+    # combined matching must give the same answer as checking entries in order
+    ents = ["a", "!b", "!c", "c", "!a"]
+    for num in range(1, len(ents) + 1):
+        for combo in itertools.permutations(ents, num):
+            pr = MetaRule({"regexes": list(combo), "rule_id": "rid"})
+            regexes = [(e.lstrip("!"), e[0] == "!") for e in combo]
+            for norm in ("a", "b", "c", "ab", "bc", "abc", "x"):
+                assert pr.approve_request(meta(norm)) == in_order(
+                    regexes, "/" + norm
+                ), (combo, norm)
+
+
+def test_wildcard_index_order():
+    ents = ["/a/*/c", "!/a/b*", "a*/c/", "!*.txt", "b*", "/a", "!x*/c"]
+    norms = ["a/b/c", "a/bb/c/d.txt", "x/a/c/y", "q/xx/c", "a/c", "b.txt", "q/bq"]
+    for combo in itertools.permutations(ents, 4):
+        pr = MetaRule({"paths": list(combo), "rule_id": "rid"})
+        # the regexes each path would be checked with one at a time
+        regexes = [pr._MetaRule__comp_path(path) for path in combo]
+        for norm in norms:
+            assert pr.approve_request(meta(norm)) == in_order(regexes, "/" + norm), (
+                combo,
+                norm,
+            )
+
+
+class CountingPattern:
+    """A compiled regex that counts its searches."""
+
+    def __init__(self, comp, counts):
+        self.comp = comp
+        self.counts = counts
+
+    def __getattr__(self, name):
+        return getattr(self.comp, name)
+
+    def search(self, norm):
+        self.counts[self.comp.pattern] += 1
+        return self.comp.search(norm)
+
+
+def count_searches(matcher) -> collections.Counter:
+    """Counts the searches of the matcher's patterns, and of the one combining them."""
+    counts = collections.Counter()
+    entries = matcher._FirstMatch__entries
+    entries[:] = [(i, CountingPattern(comp, counts)) for i, comp in entries]
+    matcher._FirstMatch__any = CountingPattern(matcher._FirstMatch__any, counts)
+    return counts
+
+
+def test_meta_rule_scans():
+    # one search of the combined regex, hit or miss, instead of one per regex
+    regexes = ["dept%i/.*/proj%i/" % (i, i) for i in range(300)]
+    norms = ["other/x/y/file.txt"]
+    norms += ["dept%i/a/proj%i/f" % (i, i) for i in range(0, 300, 30)]
+    pr = MetaRule({"regexes": regexes, "rule_id": "rid"})
+    counts = count_searches(pr._MetaRule__matcher)
+    assert [pr.approve_request(meta(norm)) for norm in norms] == [False] + [True] * 10
+    assert sum(counts.values()) == len(norms)
+
+    # a matching inverted entry needs the first match, searched for in order on a hit
+    pr = MetaRule({"regexes": ["!secret"] + regexes, "rule_id": "rid"})
+    counts = count_searches(pr._MetaRule__matcher)
+    assert not pr.approve_request(meta("dept0/a/proj0/secret"))
+    assert sum(counts.values()) == 2
+    assert not pr.approve_request(meta("other/secret"))
+    assert sum(counts.values()) == 3
+    assert pr.approve_request(meta("dept1/a/proj1/f"))
+    assert sum(counts.values()) == 3
+
+
+def test_meta_regex_groups():
+    # backrefs can't be combined, but still work
+    pr = MetaRule({"regexes": ["(ab)\\1", "!(?i)x"], "rule_id": "rid"})
+    assert pr.approve_request(meta("ababc"))
+    assert pr.approve_request(meta("abc"))
+    assert not pr.approve_request(meta("abx"))
+
+
+def test_literal_index():
+    pr = MetaRule(
+        {
+            "paths": [
+                "/a/b",
+                "/a/b/c/d",
+                "x/y",
+                "x/y/z/",
+                "d/",
+                "f.txt",
+            ],
+            "rule_id": "rid",
+        }
+    )
+    assert pr.approve_request(meta("a/b"))
+    assert pr.approve_request(meta("a/b/c/d/e"))
+    assert pr.approve_request(meta("q/x/y"))
+    assert pr.approve_request(meta("q/x/y/z/f"))
+    assert pr.approve_request(meta("q/d/f"))
+    assert pr.approve_request(meta("f.txt", complete=False))
+    assert not pr.approve_request(meta("a/c"))
+    assert not pr.approve_request(meta("a/b", complete=False))
+    assert not pr.approve_request(meta("x/y", complete=False))
+    assert not pr.approve_request(meta("q/x/yy"))
+    assert not pr.approve_request(meta("q/d", complete=False))
+    assert not pr.approve_request(meta("f.txt/q", complete=False))
+
+    pr = MetaRule({"paths": ["/"], "rule_id": "rid"})
+    assert pr.approve_request(meta("anything"))
+    assert not pr.approve_request(meta("anything", complete=False))
+
+    # literals and wildcards keep their order
+    pr = MetaRule({"paths": ["!/tax/x", "/tax*", "!/tax", "x"], "rule_id": "rid"})
+    assert not pr.approve_request(meta("tax/x"))
+    assert pr.approve_request(meta("tax/y"))
+    assert pr.approve_request(meta("taxes/x"))
+    pr = MetaRule({"paths": ["!x", "!/tax*", "/tax"], "rule_id": "rid"})
+    assert pr.approve_request(meta("tax/y"))
+    assert not pr.approve_request(meta("tax/x"))
+    pr = MetaRule({"paths": ["!/tax*", "/tax"], "rule_id": "rid"})
+    assert not pr.approve_request(meta("tax/y"))
+    assert pr.approve_request(meta("y/tax/y"))
+
+    # non-ascii falls back to regexes
+    pr = MetaRule({"paths": ["/ÄBC"], "rule_id": "rid"})
+    assert pr.approve_request(meta("äbc/d"))
+
+
+def test_meta_cache():
+    pr = MetaRule({"paths": ["/root/sub"], "rule_id": "rid"})
+    assert pr.cache_info() is None
+
+    pr = MetaRule({"paths": ["/root/sub"], "cache_size": 2, "rule_id": "rid"})
+    assert pr.approve_request(meta("root/sub/a"))
+    assert pr.approve_request(meta("Root/Sub/a"))
+    assert not pr.approve_request(meta("root/sub/a", complete=False))
+    info = pr.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (1, 2, 2)
+
+    # oldest is evicted
+    assert not pr.approve_request(meta("root/other"))
+    assert pr.approve_request(meta("root/sub/a"))
+    info = pr.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (1, 4, 2)
+
+
+def test_match_many():
+    pr = MetaRule({"paths": ["/root/sub"], "cache_size": 10, "rule_id": "rid"})
+    assert not pr.match_many([])
+    assert pr.match_many(MetaInfo("root/sub/%i" % (i % 3), True) for i in range(1000))
+    # duplicates are only matched once
+    assert pr.cache_info().misses == 3
+
+    consumed = []
+
+    def gen():
+        for path in ("root/sub/a", "root/other", "root/sub/b"):
+            consumed.append(path)
+            yield MetaInfo(path, True)
+
+    # stops at the first rejection
+    assert not pr.match_many(gen())
+    assert consumed == ["root/sub/a", "root/other"]
@@ -1,9 +1,13 @@
 # SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
 # SPDX-License-Identifier: LGPL-3.0-or-later
 import os
+import sys
+import threading
 import time
+import tracemalloc
 import unittest.mock
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from typing import Iterator
 
 import atakama
@@ -18,7 +22,7 @@ from policy_basics.per_profile_throttle import (
     ProfileThrottleDb,
     ProfileCount,
 )
-from policy_basics.simple_db import UriDb
+from policy_basics.simple_db import UriDb, CounterDb
 
 
 def set_time(timer, iso):
@@ -153,6 +157,120 @@ def test_throttle_basic(persistent, db_uri):
         assert not pr._approve_and_use_quota(b"pid2")
 
 
+def test_throttle_atomic(db_uri):
+    args = {
+        "per_day": 3,
+        "per_hour": 2,
+        "persistent": True,
+        "atomic": True,
+        "rule_id": "rid",
+        "db-uri": db_uri,
+    }
+    pr = ProfileThrottleRule(args)
+    pr2 = ProfileThrottleRule(args)
+    pi = ProfileInfo(profile_id=b"pid", profile_words=[])
+    pr.clear_quota(pi)
+    with unittest.mock.patch("policy_basics.per_profile_throttle.Timer") as timer:
+        set_time(timer, "2022-03-09 17:00Z")
+
+        assert not pr.at_quota(pi)
+        # approval doesn't reserve, and doesn't lock out other nodes
+        assert pr._approve_profile_request(b"pid")
+        assert pr2._approve_profile_request(b"pid")
+        pr._use_quota(b"pid")
+        pr2._use_quota(b"pid")
+        assert pr.at_quota(pi)
+        assert not pr._approve_profile_request(b"pid")
+        # lost the race to another node
+        with pytest.raises(RuntimeError):
+            pr._use_quota(b"pid")
+
+        # new hour
+        set_time(timer, "2022-03-09 18:00Z")
+        assert pr._approve_and_use_quota(b"pid")
+        assert not pr2._approve_and_use_quota(b"pid")
+        assert pr.db.get("rid", b"pid", lock=False).day_cnt == 3
+
+        # new day
+        set_time(timer, "2022-03-10 00:00Z")
+        assert pr._approve_and_use_quota(b"pid")
+        assert pr.db.get("rid", b"pid", lock=False).day_cnt == 1
+
+        pr.clear_quota(pi)
+        assert pr.db.get("rid", b"pid", lock=False).day_cnt == 0
+
+    with pytest.raises(AssertionError):
+        ProfileThrottleRule({"per_day": 3, "columns": True, "rule_id": "rid"})
+
+    args["per_day"] = 0
+    pr = ProfileThrottleRule(args)
+    assert not pr._approve_and_use_quota(b"pid3")
+
+
+def test_throttle_columns(db_uri):
+    args = {"persistent": True, "columns": True, "db-uri": db_uri, "rule_id": "rid"}
+    db1 = ProfileThrottleDb(args)
+    db2 = ProfileThrottleDb(args)
+    db1.clear("rid", b"pid")
+    prof_cnt1 = db1.get("rid", b"pid", lock=True)
+    assert db2.get("rid", b"pid", lock=True) is None
+    assert db1.increment("rid", b"pid", prof_cnt1).day_cnt == 1
+    prof_cnt2 = db2.get("rid", b"pid", lock=True)
+    assert prof_cnt2.day_cnt == 1
+    assert db2.increment("rid", b"pid", prof_cnt2).day_cnt == 2
+
+    # typed columns, no json
+    assert isinstance(db1.db, CounterDb)
+    row = db1.db.get(("rid", b"pid".hex()))
+    assert (row["hour_cnt"], row["day_cnt"], row["lk"]) == (2, 2, None)
+
+    pr = ProfileThrottleRule({"per_day": 3, **args})
+    assert pr._approve_and_use_quota(b"pid")
+    assert not pr._approve_and_use_quota(b"pid")
+
+
+def test_throttle_migrate(db_uri):
+    old = ProfileThrottleDb({"persistent": True, "db-uri": db_uri, "rule_id": "rid"})
+    old.increment("rid", b"pid", old.get("rid", b"pid", lock=False))
+    old.increment("other", b"pid", old.get("other", b"pid", lock=False))
+    old.db.set(ProfileThrottleDb._get_db_key("rid", b"bad"), "junk")
+    # rules that "like" would match
+    for other in ("rxd", "R_D", "x:r_d"):
+        old.increment(other, b"pid", old.get(other, b"pid", lock=False))
+
+    args = {"persistent": True, "columns": True, "db-uri": db_uri, "rule_id": "rid"}
+    new = ProfileThrottleDb(args)
+    assert new.get("rid", b"pid", lock=False).day_cnt == 1
+    # other rules aren't moved
+    assert old.get("other", b"pid", lock=False).day_cnt == 1
+    assert old.db.get(ProfileThrottleDb._get_db_key("rid", b"pid")) is None
+    assert old.db.get(ProfileThrottleDb._get_db_key("rid", b"bad")) is None
+    assert new.migrate("rid") == 0
+    assert new.migrate("r_d") == 0
+    for other in ("rxd", "R_D", "x:r_d"):
+        assert old.get(other, b"pid", lock=False).day_cnt == 1
+
+    # with a pooled connection, not the first one directly
+    with unittest.mock.patch.object(new.db, "db", None):
+        assert new.migrate("other") == 1
+
+
+def test_throttle_migrate_table(tmp_path):
+    args = {"persistent": True, "db-file": tmp_path / "quota.db", "rule_id": "rid"}
+    old = ProfileThrottleDb({**args, "db-table": "custom"})
+    old.increment("rid", b"pid", old.get("rid", b"pid", lock=False))
+    other = ProfileThrottleDb(args)
+    other.increment("other", b"pid", other.get("other", b"pid", lock=False))
+
+    new = ProfileThrottleDb({**args, "db-table": "custom", "columns": True})
+    assert new.db.table == "custom_throttle"
+    assert new.get("rid", b"pid", lock=False).day_cnt == 1
+    assert old.db.get(ProfileThrottleDb._get_db_key("rid", b"pid")) is None
+    # the file's other tables are kept
+    assert not os.path.exists(str(tmp_path / "quota.db.old"))
+    assert other.get("other", b"pid", lock=False).day_cnt == 1
+
+
 def test_persistent():
     pr = ProfileThrottleRule({"per_day": 3, "persistent": True, "rule_id": "rid"})
     pr.clear_quota(ProfileInfo(profile_id=b"pid", profile_words=[]))
@@ -171,6 +289,32 @@ def test_persistent():
     assert pr2._approve_and_use_quota(b"pid")
 
 
+def test_write_behind(tmp_path):
+    args = {
+        "per_day": 3,
+        "persistent": True,
+        "db-file": tmp_path / "quota.db",
+        "write-behind": True,
+        "write-behind-secs": 60,
+        "rule_id": "rid",
+    }
+    pr = ProfileThrottleRule(args)
+    assert pr._approve_and_use_quota(b"pid")
+    assert pr._approve_and_use_quota(b"pid")
+
+    # not written yet
+    pr2 = ProfileThrottleRule(args)
+    assert pr2.db.get("rid", b"pid", lock=False).day_cnt == 0
+
+    pr.db.close()
+    pr2 = ProfileThrottleRule(args)
+    assert pr2._approve_and_use_quota(b"pid")
+    assert not pr2._approve_and_use_quota(b"pid")
+
+    with pytest.raises(AssertionError):
+        ProfileThrottleRule({"atomic": True, **args})
+
+
 def test_throttle_db_corruption(tmp_path):
     # sqlite is resilient to file corruption, just resets counts
     path = tmp_path / "quote.db"
@@ -183,10 +327,21 @@ def test_throttle_db_corruption(tmp_path):
 def test_throttle_db_schema_bad(tmp_path):
     # sqlite is resilient to schema changes, just resets counts
     path = tmp_path / "quote.db"
+    other = ProfileThrottleDb(
+        {"persistent": True, "db-file": path, "db-table": "other", "rule_id": "rid"}
+    )
+    other.increment("rid", b"pid", other.get("rid", b"pid", lock=False))
+    other.close()
     with notanorm.SqliteDb(str(path)) as db:
         db.query("create table %s (ajunk, bjunk)" % UriDb.TABLE_NAME)
     db = ProfileThrottleDb({"persistent": True, "db-file": path, "rule_id": "rid"})
     assert db.increment("rid", b"pid", db.get("rid", b"pid", lock=False)).day_cnt == 1
+    # only that table is set aside, not the file
+    assert not os.path.exists(str(path) + ".old")
+    other = ProfileThrottleDb(
+        {"persistent": True, "db-file": path, "db-table": "other", "rule_id": "rid"}
+    )
+    assert other.get("rid", b"pid", lock=False).day_cnt == 1
 
 
 def test_throttle_db_uri_broken(db_uri):
@@ -196,6 +351,8 @@ def test_throttle_db_uri_broken(db_uri):
     db.db.db.query(
         "create table %s (`key` integer primary key, bjunk integer)" % UriDb.TABLE_NAME
     )
+    # or the open db is used
+    db.close()
     with pytest.raises(notanorm.errors.DbError):
         ProfileThrottleDb({"persistent": True, "db-uri": db_uri})
 
@@ -345,3 +502,480 @@ def test_locking_timeout():
     time.sleep(expiry_secs)
     assert pr2._approve_profile_request(b"pid"), "Expected lock to have expired"
     pr2._use_quota(b"pid")  # Clears lock to stop interference with other tests
+
+
+def test_locking_waits(tmp_path):
+    args = {"per_day": 10, "persistent": True, "db-file": tmp_path / "quota.db"}
+    pr1 = ProfileThrottleRule({**args, "rule_id": "rid"})
+    pr2 = ProfileThrottleRule({**args, "rule_id": "rid", "cas-retries": 10})
+
+    assert pr1._approve_profile_request(b"pid")
+    # released while pr2 retries
+    timer = threading.Timer(0.05, pr1._use_quota, (b"pid",))
+    timer.start()
+    assert pr2._approve_profile_request(b"pid")
+    pr2._use_quota(b"pid")
+    timer.join()
+    assert pr2.db.cas_retries > 0
+    assert pr1.db.get("rid", b"pid", lock=False).day_cnt == 2
+
+
+@pytest.mark.parametrize("columns", [False, True])
+def test_throttle_cas_threads(columns, tmp_path):
+    args = {
+        "per_hour": 1000,
+        "persistent": True,
+        "columns": columns,
+        "db-file": tmp_path / "quota.db",
+        "db-pool-size": 4,
+        "cas-retries": 20,
+        "rule_id": "rid",
+    }
+    # as on several servers
+    rules = [ProfileThrottleRule(args) for _ in range(4)]
+
+    def use(pr):
+        used = 0
+        for _ in range(10):
+            try:
+                used += pr._approve_and_use_quota(b"pid")
+            except RuntimeError:
+                # still leased after all the retries
+                pass
+        return used
+
+    with ThreadPool(8) as pool:
+        used = sum(pool.map(use, rules * 2))
+
+    # no increments are lost, and contention is retried rather than refused
+    assert rules[0].db.get("rid", b"pid", lock=False).hour_cnt == used
+    assert used > 60
+    assert sum(pr.db.cas_retries for pr in rules) > 0
+
+
+def test_throttle_sliding_window(tmp_path):
+    pr = ProfileThrottleRule(
+        {
+            "per_hour": 4,
+            "window": "sliding",
+            "persistent": True,
+            "db-file": tmp_path / "quote.db",
+            "rule_id": "rid",
+        }
+    )
+    pi = ProfileInfo(profile_id=b"pid", profile_words=[])
+    with unittest.mock.patch("policy_basics.per_profile_throttle.Timer") as timer:
+        set_time(timer, "2022-03-09 17:30Z")
+        for _ in range(4):
+            assert pr._approve_and_use_quota(b"pid")
+        assert pr.at_quota(pi)
+
+        # all of the last hour's requests are still in range at the top of the hour
+        set_time(timer, "2022-03-09 18:00Z")
+        assert not pr._approve_and_use_quota(b"pid")
+
+        # half of them are at half past
+        set_time(timer, "2022-03-09 18:30Z")
+        assert pr._approve_and_use_quota(b"pid")
+        assert pr._approve_and_use_quota(b"pid")
+        assert not pr._approve_and_use_quota(b"pid")
+
+        set_time(timer, "2022-03-09 20:00Z")
+        assert not pr.at_quota(pi)
+
+
+def test_throttle_token_bucket():
+    pr = ProfileThrottleRule(
+        {"window": "token_bucket", "rate": 60, "burst": 3, "rule_id": "rid"}
+    )
+    pi = ProfileInfo(profile_id=b"pid", profile_words=[])
+    with unittest.mock.patch("policy_basics.per_profile_throttle.Timer") as timer:
+        set_time(timer, "2022-03-09 17:00Z")
+        for _ in range(3):
+            assert pr._approve_and_use_quota(b"pid")
+        assert pr.at_quota(pi)
+        assert not pr._approve_and_use_quota(b"pid")
+
+        # one token a minute
+        set_time(timer, "2022-03-09 17:01Z")
+        assert pr._approve_and_use_quota(b"pid")
+        assert not pr._approve_and_use_quota(b"pid")
+
+        # refills up to the burst size
+        set_time(timer, "2022-03-09 18:00Z")
+        for _ in range(3):
+            assert pr._approve_and_use_quota(b"pid")
+        assert not pr._approve_and_use_quota(b"pid")
+
+
+def test_throttle_window_columns():
+    with pytest.raises(AssertionError):
+        ProfileThrottleDb({"persistent": True, "atomic": True, "window": "sliding"})
+    with pytest.raises(AssertionError):
+        ProfileThrottleDb({"window": "hourly"})
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        {},
+        {"persistent": True},
+        {"persistent": True, "columns": True},
+        {"persistent": True, "write-behind": True},
+        {"persistent": True, "db-uri": "mmap:"},
+    ],
+    ids=["memory", "json", "columns", "write-behind", "mmap"],
+)
+def test_throttle_sweep(args, tmp_path):
+    if "db-uri" in args:
+        args = {**args, "db-uri": args["db-uri"] + str(tmp_path / "quote.mmap")}
+    db = ProfileThrottleDb(
+        {**args, "db-file": tmp_path / "quote.db", "sweep-secs": 0, "rule_id": "rid"}
+    )
+    with unittest.mock.patch("policy_basics.per_profile_throttle.Timer") as timer:
+        set_time(timer, "2022-03-01 12:00Z")
+        for i in range(5):
+            db.increment("old", b"pid%i" % i, db.get("old", b"pid%i" % i, lock=False))
+        # locked, but long expired
+        db.get("old", b"locked", lock=True)
+        set_time(timer, "2022-03-02 12:00Z")
+        db.increment("rid", b"pid", db.get("rid", b"pid", lock=False))
+
+        set_time(timer, "2022-03-03 13:00Z")
+        assert db.sweep(max_rows=2) == 2
+        assert db.sweep() == 4
+        assert db.sweep() == 0
+
+        set_time(timer, "2022-03-02 13:00Z")
+        assert db.get("rid", b"pid", lock=False).day_cnt == 1
+
+
+def test_throttle_sweep_token_bucket(tmp_path):
+    args = {"persistent": True, "db-file": tmp_path / "quote.db", "sweep-secs": 0}
+    calendar = ProfileThrottleDb({**args, "rule_id": "cal"})
+    # refills over 100 hours
+    bucket_args = {**args, "window": "token_bucket", "rate": 1, "burst": 100}
+    bucket = ProfileThrottleDb({**bucket_args, "rule_id": "tb"})
+    with unittest.mock.patch("policy_basics.per_profile_throttle.Timer") as timer:
+        set_time(timer, "2022-03-01 12:00Z")
+        for _ in range(100):
+            bucket.increment("tb", b"pid", bucket.get("tb", b"pid", lock=False))
+        set_time(timer, "2022-03-04 12:00Z")
+        # the bucket still needs its row
+        assert calendar.sweep() == 0
+        assert bucket.get("tb", b"pid", lock=False).tokens == pytest.approx(72)
+        bucket.close()
+        assert calendar.sweep() == 1
+
+
+def test_throttle_sweep_amortized():
+    pr = ProfileThrottleRule({"per_day": 10, "rule_id": "rid", "sweep-secs": 0.1})
+    with unittest.mock.patch("policy_basics.per_profile_throttle.Timer") as timer:
+        set_time(timer, "2022-03-01 12:00Z")
+        assert pr._approve_and_use_quota(b"old")
+        set_time(timer, "2022-03-05 12:00Z")
+        with unittest.mock.patch.object(
+            ProfileThrottleDb, "sweep", wraps=pr.db.sweep
+        ) as sweep:
+            assert pr._approve_and_use_quota(b"pid")
+            sweep.assert_not_called()
+            time.sleep(0.2)
+            assert pr._approve_and_use_quota(b"pid")
+            # in the background
+            pr.db._ProfileThrottleDb__sweeper.join()
+            sweep.assert_called_once_with(1000)
+    assert len(pr.db.db.items()) == 1
+
+
+def test_throttle_sweep_background():
+    pr = ProfileThrottleRule({"per_day": 10, "rule_id": "rid", "sweep-secs": 0.1})
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_sweep(_max_rows):
+        started.set()
+        release.wait(5)
+        return 0
+
+    with unittest.mock.patch.object(pr.db, "sweep", side_effect=slow_sweep) as sweep:
+        time.sleep(0.2)
+        assert pr._approve_and_use_quota(b"pid")
+        assert started.wait(5)
+        # requests don't wait for it, or start another
+        time.sleep(0.2)
+        assert pr._approve_and_use_quota(b"pid")
+        assert sweep.call_count == 1
+        release.set()
+        pr.db._ProfileThrottleDb__sweeper.join()
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        {"persistent": True},
+        {"persistent": True, "columns": True},
+        {"persistent": True, "write-behind": True},
+    ],
+    ids=["json", "columns", "write-behind"],
+)
+def test_throttle_trim(args, tmp_path):
+    db = ProfileThrottleDb(
+        {**args, "db-file": tmp_path / "quote.db", "max-rows": 3, "rule_id": "rid"}
+    )
+    with unittest.mock.patch("policy_basics.per_profile_throttle.Timer") as timer:
+        for i in range(5):
+            set_time(timer, "2022-03-01 12:0%iZ" % i)
+            db.increment("rid", b"pid%i" % i, db.get("rid", b"pid%i" % i, lock=False))
+        assert db.trim(3) == 2
+        assert db.trim(3) == 0
+        # the oldest went
+        assert db.get("rid", b"pid1", lock=False).day_cnt == 0
+        assert db.get("rid", b"pid2", lock=False).day_cnt == 1
+        assert db.get("rid", b"pid4", lock=False).day_cnt == 1
+
+
+def test_throttle_max_rows(tmp_path):
+    pr = ProfileThrottleRule(
+        {
+            "per_day": 10,
+            "rule_id": "rid",
+            "persistent": True,
+            "columns": True,
+            "db-file": tmp_path / "quote.db",
+            "sweep-secs": 0.1,
+            "max-rows": 2,
+        }
+    )
+    for i in range(4):
+        assert pr._approve_and_use_quota(b"pid%i" % i)
+    time.sleep(0.2)
+    assert pr._approve_and_use_quota(b"pid")
+    pr.db._ProfileThrottleDb__sweeper.join()
+    counts = [
+        pr.db.get("rid", pid, lock=False).day_cnt for pid in (b"pid0", b"pid3", b"pid")
+    ]
+    # the least recently written went
+    assert counts == [0, 1, 1]
+
+
+@pytest.mark.parametrize("window", ["calendar", "sliding", "token_bucket"])
+def test_throttle_packed(window):
+    args = {"rule_id": "rid", "window": window, "rate": 10, "max-entries": 4}
+    db = ProfileThrottleDb(args)
+    pc = db.increment("rid", b"pid", db.get("rid", b"pid", lock=True))
+    data = db.db.get(b"pid")
+    assert isinstance(data, bytes)
+    assert db.get("rid", b"pid", lock=False).hour_cnt == pytest.approx(pc.hour_cnt)
+
+    # locks are flags, for this db's lock value
+    db.lock("rid", b"pid", pc)
+    assert db.get("rid", b"pid", lock=False).lock_value == db.lock_value
+    assert db.get("rid", b"pid", lock=True)
+
+    # other rules get their own keys
+    db.increment("other", b"pid", db.get("other", b"pid", lock=False))
+    assert db.get("other", b"pid", lock=False).hour_cnt == pytest.approx(1)
+
+    for i in range(10):
+        db.increment("rid", b"%i" % i, db.get("rid", b"%i" % i, lock=False))
+    assert len(db.db) <= 4
+
+
+def test_throttle_memory_size():
+    pids = [os.urandom(32) for _ in range(2000)]
+    tracemalloc.start()
+    try:
+        db = ProfileThrottleDb({"rule_id": "rid", "max-entries": 1000})
+        for pid in pids:
+            db.increment("rid", pid, db.get("rid", pid, lock=False))
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    # a dict of json counts took over 200 bytes per profile
+    assert size < 50 * 1000
+
+
+@pytest.mark.parametrize("atomic", [False, True])
+def test_throttle_memory_threads(atomic):
+    pr = ProfileThrottleRule({"per_hour": 50, "atomic": atomic, "rule_id": "rid"})
+    pids = [b"pid%i" % i for i in range(4)]
+
+    def use(pid):
+        # approve and use, without the lock a RuleSet would hold
+        used = 0
+        for _ in range(50):
+            try:
+                used += pr._approve_and_use_quota(pid)
+            except RuntimeError:
+                # atomic: went over quota since approval
+                pass
+        return pid, used
+
+    with ThreadPool(16) as pool:
+        results = pool.map(use, pids * 4)
+
+    for pid in pids:
+        # no increments are lost
+        used = sum(n for p, n in results if p == pid)
+        assert pr.db.get("rid", pid, lock=False).hour_cnt == used
+        if atomic:
+            assert used == 50
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8), reason="shared memory requires python 3.8"
+)
+def test_throttle_shared_memory():
+    args = {
+        "per_hour": 5,
+        "rule_id": "rid",
+        "shared-memory": "pbtest_" + os.urandom(8).hex(),
+        "max-entries": 64,
+    }
+    # as in two worker processes
+    pr1 = ProfileThrottleRule(args)
+    pr2 = ProfileThrottleRule(args)
+    try:
+        pi = ProfileInfo(profile_id=b"pid", profile_words=[])
+        assert pr1._approve_profile_request(b"pid")
+        assert not pr2._approve_profile_request(b"pid"), "Expected row to be locked"
+        pr1._use_quota(b"pid")
+        for _ in range(4):
+            assert pr2._approve_and_use_quota(b"pid")
+        assert pr1.at_quota(pi)
+        assert not pr1._approve_and_use_quota(b"pid")
+
+        # other rules get their own counts
+        pr1.db.increment("other", b"pid", pr1.db.get("other", b"pid", lock=False))
+        assert pr2.db.get("other", b"pid", lock=False).hour_cnt == 1
+
+        with unittest.mock.patch("policy_basics.per_profile_throttle.Timer") as timer:
+            set_time(timer, "2100-01-01 12:00Z")
+            assert pr1.db.sweep() == 2
+    finally:
+        pr1.db.db.unlink()
+
+
+def test_throttle_mmap(tmp_path):
+    path = tmp_path / "quota.mmap"
+    args = {
+        "per_day": 3,
+        "persistent": True,
+        "rule_id": "rid",
+        "db-uri": "mmap:" + str(path),
+        "atomic": True,
+    }
+    pr = ProfileThrottleRule(args)
+    assert pr._approve_and_use_quota(b"pid")
+    assert pr._approve_and_use_quota(b"pid")
+    pr.db.close()
+
+    # counts survive a restart
+    pr = ProfileThrottleRule(args)
+    assert pr._approve_and_use_quota(b"pid")
+    assert not pr._approve_and_use_quota(b"pid")
+    pr.db.close()
+
+    # a damaged file is moved aside
+    with open(path, "r+b") as f:
+        f.write(b"junk")
+    pr = ProfileThrottleRule(args)
+    assert pr._approve_and_use_quota(b"pid")
+    assert os.path.exists(str(path) + ".old")
+
+
+def test_throttle_shared_store(tmp_path):
+    args = {"persistent": True, "db-file": tmp_path / "quota.db"}
+    db1 = ProfileThrottleDb({**args, "rule_id": "rid1"})
+    db2 = ProfileThrottleDb({**args, "rule_id": "rid2"})
+    other = ProfileThrottleDb({**args, "db-table": "other"})
+    assert db1.db is db2.db
+    assert other.db is not db1.db
+
+    db1.close()
+    db2.increment("rid2", b"pid", db2.get("rid2", b"pid", lock=False))
+    sql_db = db2.db.db
+    db2.close()
+    assert sql_db.closed
+
+
+@pytest.mark.parametrize("columns", [True, False])
+def test_throttle_reserve_quotas(columns, tmp_path):
+    args = {
+        "persistent": columns,
+        "db-file": tmp_path / "quota.db",
+        "atomic": True,
+    }
+    rules = [
+        ProfileThrottleRule({**args, "rule_id": "day", "per_day": 2}),
+        ProfileThrottleRule({**args, "rule_id": "hour", "per_hour": 1}),
+        ProfileThrottleRule({"rule_id": "locking", "per_day": 5}),
+    ]
+    pi = ProfileInfo(profile_id=b"pid", profile_words=[])
+    request = ApprovalRequest(
+        request_type=RequestType.DECRYPT,
+        device_id=b"pid",
+        profile=pi,
+        auth_meta=None,
+        cryptographic_id=None,
+    )
+    with unittest.mock.patch("policy_basics.per_profile_throttle.Timer") as timer:
+        set_time(timer, "2022-03-09 17:00Z")
+        if columns:
+            with unittest.mock.patch.object(
+                CounterDb, "reserve_many", wraps=rules[0].db.db.reserve_many
+            ) as reserve_many:
+                assert ProfileThrottleRule.reserve_quotas(rules, request)
+                reserve_many.assert_called_once()
+        else:
+            assert ProfileThrottleRule.reserve_quotas(rules, request)
+
+        # the hour rule is at quota
+        assert not ProfileThrottleRule.reserve_quotas(rules, request)
+        # no quota is used
+        assert rules[0].db.get("day", b"pid", lock=False).day_cnt == 1
+        assert rules[2].db.get("locking", b"pid", lock=False).day_cnt == 1
+
+        set_time(timer, "2022-03-09 18:00Z")
+        assert ProfileThrottleRule.reserve_quotas(rules, request)
+        assert rules[0].at_quota(pi)
+        assert rules[2].db.get("locking", b"pid", lock=False).day_cnt == 2
+
+
+def test_throttle_reserve_quotas_batches(tmp_path):
+    def rule(name, **kws):
+        return ProfileThrottleRule(
+            {
+                "persistent": True,
+                "atomic": True,
+                "db-file": tmp_path / (name + ".db"),
+                "rule_id": name,
+                **kws,
+            }
+        )
+
+    rules = [
+        ProfileThrottleRule({"rule_id": "locking", "per_day": 5}),
+        rule("first", per_day=5),
+        rule("second", per_day=1),
+    ]
+    request = ApprovalRequest(
+        request_type=RequestType.DECRYPT,
+        device_id=b"pid",
+        profile=ProfileInfo(profile_id=b"pid", profile_words=[]),
+        auth_meta=None,
+        cryptographic_id=None,
+    )
+
+    def counts():
+        return [r.db.get(r.rule_id, b"pid", lock=False).day_cnt for r in rules]
+
+    with unittest.mock.patch("policy_basics.per_profile_throttle.Timer") as timer:
+        set_time(timer, "2022-03-09 17:00Z")
+        assert ProfileThrottleRule.reserve_quotas(rules, request)
+        assert counts() == [1, 1, 1]
+        # the first batch is released when the second is over quota
+        assert not ProfileThrottleRule.reserve_quotas(rules, request)
+        assert counts() == [1, 1, 1]
+        assert not ProfileThrottleRule.reserve_quotas(rules[::-1], request)
+        assert counts() == [1, 1, 1]
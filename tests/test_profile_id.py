@@ -4,9 +4,11 @@
 import os
 
 import atakama
+import pytest
 from atakama import ProfileInfo, ApprovalRequest, RequestType
 
 from policy_basics.profile_id import (
+    ProfileIdFile,
     ProfileIdRule,
 )
 
@@ -62,6 +64,85 @@ def test_profile_id_match():
     )
 
 
+def test_word_match():
+    pr = ProfileIdRule(
+        {
+            "profile_ids": [
+                "one two three four five six",
+                "one two three four",
+                "one two seven eight",
+                "nine ten eleven twelve",
+            ],
+            "rule_id": "rid",
+        }
+    )
+    match = pr._word_match
+    assert match("one two three four".split())
+    assert match("one two three four five".split())
+    assert match("one two seven eight nine".split())
+    assert match("nine ten eleven twelve".split())
+    assert not match("one two three".split())
+    assert not match("one two seven four".split())
+    assert not match("two three four five".split())
+    assert not match("ten eleven twelve one".split())
+    assert not match([])
+
+
+def test_profile_id_file(tmp_path):
+    path = str(tmp_path / "ids.bin")
+    pids = [os.urandom(16) for _ in range(1000)]
+    ProfileIdFile.write(path, pids + pids[:10])
+    ids = ProfileIdFile(path, check_secs=0)
+    assert len(ids) == 1000
+    assert all(pid in ids for pid in pids)
+    assert not any(os.urandom(16) in ids for _ in range(1000))
+    assert b"\x00" * 16 not in ids
+    assert b"\xff" * 16 not in ids
+    assert pids[0][:8] not in ids
+
+    # replaced
+    ProfileIdFile.write(path, pids[:1])
+    assert pids[1] not in ids
+    assert pids[0] in ids
+    ProfileIdFile.write(path, [])
+    assert pids[0] not in ids and len(ids) == 0
+
+    # bad files are not loaded
+    with open(path, "wb") as fh:
+        fh.write(b"short")
+    with pytest.raises(ValueError):
+        ProfileIdFile(path)
+    ProfileIdFile.write(path, pids[:1])
+    assert pids[0] in ids
+    os.unlink(path)
+    assert pids[0] in ids
+
+
+def test_profile_ids_file(tmp_path):
+    path = str(tmp_path / "ids.bin")
+    pid = os.urandom(8)
+    ProfileIdFile.write(path, [pid], size=8)
+    pr = ProfileIdRule(
+        {"profile_ids_file": path, "profile_ids_size": 8, "rule_id": "rid"}
+    )
+    for profile_id, res in ((pid, True), (os.urandom(8), False)):
+        assert (
+            pr.approve_request(
+                ApprovalRequest(
+                    request_type=None,
+                    device_id=b"whatever",
+                    profile=ProfileInfo(profile_id=profile_id, profile_words=[]),
+                    auth_meta=None,
+                    cryptographic_id=None,
+                )
+            )
+            == res
+        )
+
+    with pytest.raises(AssertionError):
+        ProfileIdRule({"rule_id": "rid"})
+
+
 def test_end_to_end():
     pid = os.urandom(16)
     hexpid = pid.hex()
@@ -0,0 +1,285 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+import fnmatch
+import socketserver
+import threading
+import time
+import unittest.mock
+from multiprocessing.pool import ThreadPool
+
+import pytest
+from atakama import ProfileInfo
+
+from tests.test_per_profile_throttle import set_time
+
+from policy_basics.per_profile_throttle import ProfileThrottleRule, ProfileThrottleDb
+from policy_basics.redis_db import RedisDb
+
+pytest.importorskip("redis")
+
+
+class FakeRedis(socketserver.ThreadingTCPServer):
+    """Enough of a redis server, speaking RESP2 or RESP3, to test RedisDb."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeRedisHandler)
+        self.lock = threading.Lock()
+        # key -> (value, expiry time or None)
+        self.data = {}
+        # key -> number of changes, for watch
+        self.versions = {}
+        self.commands = 0
+
+    @property
+    def uri(self):
+        return "redis://%s:%i/0" % self.server_address
+
+    def live(self, key):
+        ent = self.data.get(key)
+        if ent and ent[1] is not None and ent[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return ent
+
+    def changed(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    # pylint: disable=too-many-branches,too-many-return-statements
+    def run(self, cmd, args):
+        if cmd in ("PING",):
+            return "+PONG"
+        if cmd in ("CLIENT", "SELECT"):
+            return "+OK"
+        if cmd == "HELLO":
+            return {b"server": b"fake", b"proto": int(args[0]) if args else 2}
+        if cmd == "GET":
+            ent = self.live(args[0])
+            return ent and ent[0]
+        if cmd == "MGET":
+            return [(self.live(key) or (None,))[0] for key in args]
+        if cmd == "SET":
+            opts = [arg.upper() for arg in args[2:]]
+            if b"NX" in opts and self.live(args[0]):
+                return None
+            expiry = None
+            if b"EX" in opts:
+                expiry = time.monotonic() + int(opts[opts.index(b"EX") + 1])
+            self.data[args[0]] = (args[1], expiry)
+            self.changed(args[0])
+            return "+OK"
+        if cmd == "DEL":
+            removed = 0
+            for key in args:
+                if self.live(key):
+                    del self.data[key]
+                    removed += 1
+                self.changed(key)
+            return removed
+        if cmd in ("INCRBY", "DECRBY"):
+            ent = self.live(args[0]) or (b"0", None)
+            value = int(ent[0]) + int(args[1]) * (1 if cmd == "INCRBY" else -1)
+            self.data[args[0]] = (b"%i" % value, ent[1])
+            self.changed(args[0])
+            return value
+        if cmd == "EXPIRE":
+            ent = self.live(args[0])
+            if not ent:
+                return 0
+            self.data[args[0]] = (ent[0], time.monotonic() + int(args[1]))
+            return 1
+        if cmd == "SCAN":
+            pattern = args[args.index(b"MATCH") + 1].decode()
+            keys = [k for k in list(self.data) if self.live(k)]
+            return [b"0", [k for k in keys if fnmatch.fnmatchcase(k.decode(), pattern)]]
+        return ValueError("unknown command " + cmd)
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    server: FakeRedis
+    protocol = 2
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        assert line.startswith(b"*")
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def reply(self, value) -> bytes:  # pylint: disable=too-many-return-statements
+        if value is None:
+            return b"_\r\n" if self.protocol == 3 else b"$-1\r\n"
+        if isinstance(value, str):
+            return value.encode() + b"\r\n"
+        if isinstance(value, int):
+            return b":%i\r\n" % value
+        if isinstance(value, bytes):
+            return b"$%i\r\n%s\r\n" % (len(value), value)
+        if isinstance(value, Exception):
+            return b"-ERR %s\r\n" % str(value).encode()
+        if isinstance(value, dict):
+            return b"%%%i\r\n" % len(value) + b"".join(
+                self.reply(k) + self.reply(v) for k, v in value.items()
+            )
+        return b"*%i\r\n" % len(value) + b"".join(self.reply(v) for v in value)
+
+    def handle(self):
+        watched = {}
+        queued = None
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            cmd, args = args[0].decode().upper(), args[1:]
+            with self.server.lock:
+                self.server.commands += 1
+                if cmd == "HELLO" and args:
+                    self.protocol = int(args[0])
+                if cmd == "WATCH":
+                    watched.update((k, self.server.versions.get(k, 0)) for k in args)
+                    res = "+OK"
+                elif cmd in ("UNWATCH", "DISCARD"):
+                    watched, queued = {}, None
+                    res = "+OK"
+                elif cmd == "MULTI":
+                    queued = []
+                    res = "+OK"
+                elif cmd == "EXEC":
+                    if any(
+                        self.server.versions.get(k, 0) != v for k, v in watched.items()
+                    ):
+                        res = None
+                    else:
+                        res = [self.server.run(c, a) for c, a in queued or ()]
+                    watched, queued = {}, None
+                elif queued is not None:
+                    queued.append((cmd, args))
+                    res = "+QUEUED"
+                else:
+                    res = self.server.run(cmd, args)
+            self.wfile.write(self.reply(res))
+
+
+@pytest.fixture(name="redis_uri")
+def _redis_uri():
+    server = FakeRedis()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.uri
+    server.shutdown()
+    server.server_close()
+
+
+def test_redis_db(redis_uri):
+    db = RedisDb(redis_uri, prefix="test:")
+    db.set("key", 32)
+    assert db.get("key") == 32
+    db.set("key", "val")
+    assert db.get("key") == "val"
+    db.set_many([("a", "1"), ("b", 2)])
+    assert dict(db.items()) == {"key": "val", "a": "1", "b": 2}
+
+    assert not db.remove_if("a", "other")
+    assert db.remove_if("a", "1")
+    assert db.get("a") is None
+    db.remove("b")
+    assert db.get("b") is None
+
+    assert db.set_if("c", "1", None)
+    assert not db.set_if("c", "2", None)
+    assert not db.set_if("c", "2", "other")
+    assert db.set_if("c", 2, "1")
+    assert db.get("c") == 2
+    db.remove("c")
+
+    # other prefixes are left alone
+    other = RedisDb(redis_uri, prefix="other:")
+    other.set("key", "val")
+    db.clear()
+    assert db.get("key") is None
+    assert other.get("key") == "val"
+
+
+def test_redis_db_ttl(redis_uri):
+    db = RedisDb(redis_uri, ttl_secs=1)
+    db.set("key", "val")
+    time.sleep(1.2)
+    assert db.get("key") is None
+
+
+def test_redis_reserve(redis_uri):
+    db = RedisDb(redis_uri)
+    window = {"hour_start": 3600, "day_start": 0}
+    with ThreadPool(8) as pool:
+        results = pool.map(
+            lambda _: db.reserve("k", 4000, per_hour=10, per_day=-1, **window),
+            range(40),
+        )
+    # never over the limit
+    assert sum(results) <= 10
+    assert db.counts("k", **window) == (sum(results), sum(results))
+
+    assert db.reserve_many([("a", 1, 5), ("b", 1, 5)], 4000, **window)
+    # b is over, a is not incremented
+    assert not db.reserve_many([("a", 5, 5), ("b", 1, 5)], 4000, **window)
+    assert db.counts("a", **window) == (1, 1)
+    # new hour
+    assert db.reserve_many([("b", 1, 5)], 7300, hour_start=7200, day_start=0)
+    assert db.counts("b", hour_start=7200, day_start=0) == (1, 2)
+
+    db.release_many(["b", "none"], hour_start=7200, day_start=0)
+    assert db.counts("b", hour_start=7200, day_start=0) == (0, 1)
+    assert db.counts("none", hour_start=7200, day_start=0) == (0, 0)
+
+    db.clear_counts("b", hour_start=7200, day_start=0)
+    assert db.counts("b", hour_start=7200, day_start=0) == (0, 0)
+
+
+@pytest.mark.parametrize("atomic", [True, False])
+def test_throttle_redis(atomic, redis_uri):
+    args = {
+        "per_day": 3,
+        "per_hour": 2,
+        "persistent": True,
+        "atomic": atomic,
+        "db-uri": redis_uri,
+        "rule_id": "rid",
+    }
+    # as on two hosts
+    pr1 = ProfileThrottleRule(args)
+    pr2 = ProfileThrottleRule(args)
+    pi = ProfileInfo(profile_id=b"pid", profile_words=[])
+    with unittest.mock.patch("policy_basics.per_profile_throttle.Timer") as timer:
+        set_time(timer, "2022-03-09 17:00Z")
+        assert pr1._approve_and_use_quota(b"pid")
+        assert pr2._approve_and_use_quota(b"pid")
+        assert pr1.at_quota(pi)
+        assert not pr2._approve_and_use_quota(b"pid")
+
+        set_time(timer, "2022-03-09 18:00Z")
+        assert pr1._approve_and_use_quota(b"pid")
+        assert not pr2._approve_and_use_quota(b"pid")
+        assert pr1.db.get("rid", b"pid", lock=False).day_cnt == 3
+
+        pr2.clear_quota(pi)
+        assert not pr1.at_quota(pi)
+        assert pr1.db.sweep() == 0
+
+
+def test_throttle_redis_batch(redis_uri):
+    args = {"persistent": True, "atomic": True, "db-uri": redis_uri}
+    db = ProfileThrottleDb(args)
+    assert db.batches
+    assert db.reserve_many([("a", b"pid", 1, -1), ("b", b"pid", -1, 1)])
+    assert not db.reserve_many([("a", b"pid", 2, -1), ("b", b"pid", -1, 1)])
+    assert db.get("a", b"pid", lock=False).hour_cnt == 1
+    assert db.increment("a", b"pid", None).hour_cnt == 2
+
+    with pytest.raises(AssertionError):
+        ProfileThrottleDb({**args, "window": "sliding"})
@@ -2,11 +2,31 @@
 # SPDX-License-Identifier: LGPL-3.0-or-later
 
 import functools
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import unittest.mock
 from multiprocessing.pool import ThreadPool
 
+import notanorm
 import pytest
 
-from policy_basics.simple_db import UriDb, MemoryDb
+from policy_basics.per_profile_throttle import ProfileThrottleDb
+from policy_basics.shared_db import MmapDb, PackedMemoryDb, SharedMemoryDb
+from policy_basics.simple_db import (
+    UriDb,
+    CounterDb,
+    MemoryDb,
+    WriteBehindDb,
+    _flush_write_behind,
+)
+
+# multiprocessing.shared_memory is new in 3.8
+needs_shared_memory = pytest.mark.skipif(
+    sys.version_info < (3, 8), reason="shared memory requires python 3.8"
+)
 
 
 @pytest.mark.parametrize("persistent", [0, 1])
@@ -43,3 +63,423 @@ def test_simple_db(tmp_path, persistent):
     assert db.get(5) == 5
     db.clear()
     assert all(db.get(i) is None for i in range(100))
+
+
+def test_write_behind(tmp_path):
+    backing = UriDb(tmp_path / "quote.db")
+    db = WriteBehindDb(backing, max_staleness=0.2, flush_count=3)
+
+    db.set("a", "1")
+    db.set("b", "2")
+    assert db.get("a") == "1"
+    assert backing.get("a") is None
+
+    # flushed on count
+    db.set("c", "3")
+    assert backing.get("a") == "1"
+    assert backing.get("c") == "3"
+
+    # flushed on time
+    db.remove("a")
+    assert db.get("a") is None
+    assert backing.get("a") == "1"
+    time.sleep(0.5)
+    assert backing.get("a") is None
+
+    # cached reads are refreshed
+    assert db.get("b") == "2"
+    backing.set("b", "changed")
+    assert db.get("b") == "2"
+    time.sleep(0.3)
+    assert db.get("b") == "changed"
+
+    # flushed at exit
+    db.set("d", "4")
+    _flush_write_behind()
+    assert backing.get("d") == "4"
+
+    db.set("e", "5")
+    db.close()
+    assert UriDb(tmp_path / "quote.db").get("e") == "5"
+
+
+class SlowDb(MemoryDb):
+    """Writes wait until released, or fail while failures are left."""
+
+    def __init__(self):
+        super().__init__()
+        self.writing = threading.Event()
+        self.release = threading.Event()
+        self.failures = 0
+
+    def set_many(self, items):
+        items = list(items)
+        self.writing.set()
+        assert self.release.wait(5)
+        if self.failures:
+            self.failures -= 1
+            raise OSError("write failed")
+        super().set_many(items)
+
+
+def test_write_behind_during_flush():
+    backing = SlowDb()
+    backing.set("k", 4)
+    db = WriteBehindDb(backing, max_staleness=10)
+    assert db.get("k") == 4
+    db.set("k", 5)
+    flush = threading.Thread(target=db.flush)
+    flush.start()
+    assert backing.writing.wait(5)
+    # the value being written is read, not the old one
+    assert db.get("k") == 5
+    assert not db.set_if("k", 6, 4)
+    backing.release.set()
+    flush.join()
+    assert backing.get("k") == 5
+    assert db.get("k") == 5
+    assert db.set_if("k", 6, 5)
+    db.flush()
+    assert backing.get("k") == 6
+
+
+def test_write_behind_failed_flush():
+    backing = SlowDb()
+    backing.release.set()
+    backing.failures = 1
+    db = WriteBehindDb(backing, max_staleness=0.2)
+    db.set("k", 1)
+    time.sleep(0.3)
+    assert backing.failures == 0
+    assert backing.get("k") is None
+    assert db.get("k") == 1
+    # retried within max_staleness
+    time.sleep(0.3)
+    assert backing.get("k") == 1
+
+
+def test_uri_db_pool(tmp_path):
+    db = UriDb(tmp_path / "quote.db", pool_size=4, health_check_secs=0)
+    opened = []
+    real_open = db._UriDb__open
+
+    def track_open():
+        conn = real_open()
+        opened.append(conn)
+        return conn
+
+    db._UriDb__open = track_open
+
+    tpool = ThreadPool(10)
+    assert sum(tpool.map(lambda i: db.set(i, i) or db.get(i), range(100))) == sum(
+        range(100)
+    )
+    assert 1 <= len(opened) <= 3
+
+    # dropped connections are replaced
+    for conn in opened:
+        conn.close()
+    db.db.close()
+    assert sum(tpool.map(db.get, range(100))) == sum(range(100))
+    assert all(not conn.closed for conn in opened[-3:])
+    assert not db.db.closed
+
+    db.set_many((i, -i) for i in range(10))
+    assert db.get(9) == -9
+    db.close()
+
+
+@pytest.mark.parametrize("db_class", [UriDb, CounterDb])
+def test_uri_db_pool_one(db_class, tmp_path):
+    with unittest.mock.patch("notanorm.open_db", wraps=notanorm.open_db) as open_db:
+        db = db_class(tmp_path / "quote.db", pool_size=1)
+        db.set(db.TEST_KEY, 1 if db_class is UriDb else {"ts": 0})
+    # the checked connection is the pool's one
+    assert open_db.call_count == 1
+    db.close()
+
+
+def test_throttle_pool_size(tmp_path):
+    db = ProfileThrottleDb(
+        {"persistent": True, "db-file": tmp_path / "quota.db", "db-pool-size": 3}
+    )
+    assert db.db.pool_size == 3
+
+
+def test_uri_db_items(tmp_path):
+    db = UriDb(tmp_path / "quote.db")
+    for i in range(25):
+        db.set("key%02i" % i, i if i % 2 else "val%i" % i)
+    assert dict(db.items(page=10)) == {
+        "key%02i" % i: i if i % 2 else "val%i" % i for i in range(25)
+    }
+
+    assert not db.remove_if("key00", "other")
+    assert db.remove_if("key00", "val0")
+    assert not db.remove_if("key01", 2)
+    assert db.remove_if("key01", 1)
+    assert db.get("key00") is None and db.get("key01") is None
+
+
+def test_set_if(tmp_path):
+    db = UriDb(tmp_path / "quote.db")
+    assert db.set_if("key", "v1", None)
+    assert not db.set_if("key", "v1", None)
+    assert not db.set_if("key", "v2", "other")
+    assert db.set_if("key", "v2", "v1")
+    assert db.get("key") == "v2"
+
+    wb = WriteBehindDb(db, max_staleness=10)
+    assert wb.set_if("key", "v3", "v2")
+    assert not wb.set_if("key", "v4", "v2")
+    wb.flush()
+    assert db.get("key") == "v3"
+
+
+def test_counter_db_set_if(tmp_path):
+    db = CounterDb(tmp_path / "quote.db")
+    db.set(("rid", "pid"), {"ts": 1, "hour_cnt": 2})
+    row = db.get(("rid", "pid"))
+    assert row["ver"] == 0
+    # compared on the version only
+    assert db.set_if(("rid", "pid"), {**row, "hour_cnt": 3, "ver": 1}, row)
+    assert not db.set_if(("rid", "pid"), {**row, "hour_cnt": 4, "ver": 1}, row)
+    assert db.get(("rid", "pid"))["hour_cnt"] == 3
+    # reserve changes the version too
+    db.reserve(("rid", "pid"), 2, hour_start=0, day_start=0, per_hour=-1, per_day=-1)
+    assert db.get(("rid", "pid"))["ver"] == 2
+    assert db.set_if(("rid", "new"), {**row, "ver": 1}, None)
+    assert not db.set_if(("rid", "new"), {**row, "ver": 1}, None)
+
+
+def test_counter_db_release(tmp_path):
+    db = CounterDb(tmp_path / "quote.db")
+    window = {"hour_start": 3600, "day_start": 0}
+    for _ in range(2):
+        db.reserve(("rid", "pid"), 4000, **window, per_hour=-1, per_day=-1)
+    db.release_many([("rid", "pid"), ("rid", "none")], **window)
+    row = db.get(("rid", "pid"))
+    assert (row["hour_cnt"], row["day_cnt"]) == (1, 1)
+    # the hour has reset since
+    db.release_many([("rid", "pid")], hour_start=7200, day_start=0)
+    row = db.get(("rid", "pid"))
+    assert (row["hour_cnt"], row["day_cnt"]) == (1, 0)
+    assert db.get(("rid", "none")) is None
+
+
+def test_memory_db_max_entries():
+    db = MemoryDb(max_entries=10)
+    db.set(0, "val")
+    # keep 0 in use
+    for i in range(1, 100):
+        assert db.get(0) == "val"
+        db.set(i, "val")
+        assert len(db) <= 10
+    assert db.get(0) == "val"
+    assert db.get(98) == "val"
+    assert db.get(1) is None
+    db.remove(0)
+    assert db.get(0) is None
+
+
+def test_memory_db_ttl():
+    db = MemoryDb(ttl_secs=0.1)
+    db.set("old", "val")
+    time.sleep(0.2)
+    db.set("new", "val")
+    assert db.items() == [("new", "val")]
+    assert db.get("old") is None
+    assert db.get("new") == "val"
+    assert len(db) == 1
+
+
+def test_memory_db_update():
+    db = MemoryDb(stripes=4)
+
+    def add(key):
+        for _ in range(1000):
+            db.update(key, lambda val: (val or 0) + 1)
+
+    with ThreadPool(8) as pool:
+        pool.map(add, ["a", "b"] * 4)
+    assert db.get("a") == 4000
+    assert db.get("b") == 4000
+
+    assert db.update("a", lambda val: None) is None
+    assert db.get("a") is None
+    assert len(db) == 1
+
+
+def test_packed_memory_db():
+    db = PackedMemoryDb(4, max_entries=16)
+    db.set(b"key", b"val1")
+    db.set("other", b"val2")
+    assert db.get(b"key") == b"val1"
+    assert db.get(b"none") is None
+    with pytest.raises(ValueError):
+        db.set(b"key", b"toolong")
+    # keys are hashed, items() yields the keys it keeps, which it takes back
+    for key, value in db.items():
+        assert len(key) == PackedMemoryDb.KEY_SIZE
+        assert db.get(key) == value
+    assert not db.set_if(b"key", b"new1", b"val2")
+    assert db.set_if(b"key", b"new1", b"val1")
+    assert db.set_if(b"more", b"val3", None)
+    assert db.update(b"key", lambda val: val[:3] + b"!") == b"new!"
+    assert not db.remove_if(b"key", b"val1")
+    assert db.remove_if(b"key", b"new!")
+    db.remove("other")
+    assert db.items() == [(db.items()[0][0], b"val3")]
+    db.clear()
+    assert len(db) == 0
+
+
+def test_packed_memory_db_max_entries():
+    db = PackedMemoryDb(4, max_entries=8)
+    db.set("key0", b"val0")
+    for i in range(1, 100):
+        db.set("key%i" % i, b"val%i" % (i % 10))
+        assert len(db) <= 8
+        if i % 4 == 0:
+            # keep key0 set recently
+            db.set("key0", b"val0")
+    assert db.get("key0") == b"val0"
+    assert db.get("key99") == b"val9"
+    assert db.get("key1") is None
+
+
+def test_packed_memory_db_ttl():
+    db = PackedMemoryDb(3, max_entries=100, ttl_secs=0.1)
+    db.set("old", b"val")
+    time.sleep(0.2)
+    db.set("new", b"val")
+    assert [value for _, value in db.items()] == [b"val"]
+    assert db.get("old") is None
+    assert db.get("new") == b"val"
+    assert len(db) == 1
+
+
+def test_packed_memory_db_update():
+    db = PackedMemoryDb(4, max_entries=100, stripes=4)
+
+    def add(key):
+        for _ in range(1000):
+            db.update(
+                key,
+                lambda val: (int.from_bytes(val or b"", "little") + 1).to_bytes(
+                    4, "little"
+                ),
+            )
+
+    with ThreadPool(8) as pool:
+        pool.map(add, ["a", "b"] * 4)
+    assert db.get("a") == (4000).to_bytes(4, "little")
+    assert db.get("b") == (4000).to_bytes(4, "little")
+
+
+@pytest.fixture(name="shm_name")
+def _shm_name(tmp_path):
+    name = "pbtest_" + os.urandom(8).hex()
+    yield name
+    db = SharedMemoryDb(name, lock_dir=tmp_path)
+    db.unlink()
+    db.close()
+
+
+@needs_shared_memory
+def test_shared_memory_db(shm_name, tmp_path):
+    db = SharedMemoryDb(shm_name, slots=8, stripes=1, lock_dir=tmp_path)
+    for i in range(8):
+        db.set(b"key%i" % i, b"val%i" % i)
+    assert len(db) == 8
+    with pytest.raises(RuntimeError):
+        db.set(b"more", b"val")
+    db.remove(b"key3")
+    db.set("more", b"val")
+    assert db.get(b"more") == b"val"
+    assert db.get(b"key3") is None
+    with pytest.raises(ValueError):
+        db.set(b"key0", b"x" * 41)
+
+    # another process's view, long keys are hashed
+    other = SharedMemoryDb(shm_name, slots=100, lock_dir=tmp_path)
+    assert other.stripe_slots == 8
+    db.remove(b"more")
+    other.set("long" * 20, b"val")
+    assert db.get("long" * 20) == b"val"
+    assert len(db.items()) == 8
+
+    assert not db.remove_if(b"key0", b"other")
+    assert db.remove_if(b"key0", b"val0")
+    assert db.update(b"key1", lambda val: val + b"!") == b"val1!"
+    assert other.get(b"key1") == b"val1!"
+    other.clear()
+    assert len(db) == 0
+    db.close()
+    other.close()
+
+
+def test_shared_memory_db_python37(monkeypatch, tmp_path):
+    monkeypatch.setattr(sys, "version_info", (3, 7, 9))
+    with pytest.raises(RuntimeError, match="python 3.8"):
+        SharedMemoryDb("pbtest_" + os.urandom(8).hex(), lock_dir=tmp_path)
+
+
+def _add_shared(name, lock_dir):
+    db = SharedMemoryDb(name, lock_dir=lock_dir)
+    for i in range(500):
+        db.update(b"key%i" % (i % 4), lambda val: b"%i" % (int(val or 0) + 1))
+    db.close()
+
+
+@needs_shared_memory
+def test_shared_memory_db_processes(shm_name, tmp_path):
+    db = SharedMemoryDb(shm_name, slots=64, stripes=4, lock_dir=tmp_path)
+    procs = [
+        multiprocessing.Process(target=_add_shared, args=(shm_name, tmp_path))
+        for _ in range(4)
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    assert all(proc.exitcode == 0 for proc in procs)
+    assert [db.get(b"key%i" % i) for i in range(4)] == [b"500"] * 4
+    db.close()
+
+
+def test_mmap_db(tmp_path):
+    path = tmp_path / "quota.mmap"
+    db = MmapDb(path, slots=16, stripes=2, sync_secs=0)
+    db.set(b"key", b"val")
+    db.set("other", b"val")
+    db.remove("other")
+    db.close()
+
+    # kept across restarts, with the layout it was made with
+    db = MmapDb(path)
+    assert db.stripe_slots == 8
+    assert db.items() == [(b"key", b"val")]
+
+    # slots written half way are read as empty
+    with open(path, "r+b") as f:
+        data = f.read()
+        # the value is after the key and its length
+        f.seek(data.index(b"key") + db.key_size + 1)
+        f.write(b"bad")
+    assert db.get(b"key") is None
+    db.set(b"key", b"new")
+    assert db.get(b"key") == b"new"
+    db.close()
+
+    # truncated, with a valid header
+    with open(path, "r+b") as f:
+        f.truncate(200)
+    with pytest.raises(ValueError, match="layout needs"):
+        MmapDb(path)
+
+    with open(path, "r+b") as f:
+        f.seek(10)
+        f.write(b"\xff")
+    with pytest.raises(ValueError):
+        MmapDb(path)
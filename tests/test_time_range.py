@@ -2,14 +2,23 @@
 # SPDX-License-Identifier: LGPL-3.0-or-later
 
 # pylint: disable=invalid-name
+import os
 import unittest.mock
+from datetime import date, datetime
+
 import dateutil.parser
 import pytest
 
 from atakama import ApprovalRequest, RequestType, ProfileInfo
 
 from policy_basics import TimeRangeRule
-from policy_basics.time_range import LOCAL_TIMEZONE
+from policy_basics.time_range import (
+    LOCAL_TIMEZONE,
+    DateSet,
+    TimeArgs,
+    _parse_time,
+    load_calendar,
+)
 
 
 def test_time_range():
@@ -38,9 +47,12 @@ def test_time_range():
     assert not tr.times.in_range(dateutil.parser.parse("2022-03-09 18:00+04:00"))
 
     # interface is cool
-    with unittest.mock.patch("policy_basics.time_range.datetime") as dt:
-        dt.now.return_value = dateutil.parser.parse("2022-03-09 17:00+04:00")
-        assert tr.approve_request(
+    local = TimeRangeRule(
+        {"days": [2], "time_start": "09:00", "time_end": "17:00", "rule_id": "rid"}
+    )
+    with unittest.mock.patch("policy_basics.time_range._time") as tm:
+        tm.time.return_value = local_parse("2022-03-09 17:00").timestamp()
+        assert local.approve_request(
             ApprovalRequest(
                 request_type=RequestType.DECRYPT,
                 device_id=b"did",
@@ -61,12 +73,279 @@ def test_time_range():
     )
 
 
+@pytest.mark.parametrize("tz", ["", "+04:00", "-09:30"])
+def test_in_range_at(tz):
+    tr = TimeRangeRule(
+        {
+            "days": [1, 2, 3],
+            "include": ["2022-03-07"],
+            "exclude": ["2022-03-08"],
+            "time_start": "09:00" + tz,
+            "time_end": "17:00" + tz,
+            "time_ranges": [{"time_start": "21:00" + tz, "time_end": "03:00" + tz}],
+            "rule_id": "rid",
+        }
+    )
+    start = local_parse("2022-03-05 00:00").timestamp()
+    # in order, so each day is worked out once, then out of order
+    stamps = [start + i * 900 for i in range(14 * 96)] + [start + 1e5, start]
+    stamps += [local_parse("2022-03-09 17:00").timestamp()]
+    for ts in stamps:
+        now = datetime.fromtimestamp(ts, LOCAL_TIMEZONE)
+        assert tr.times.in_range_at(ts) == tr.times.in_range(now), now
+
+    # no times, the whole day
+    tr = TimeRangeRule({"days": [2], "rule_id": "rid"})
+    assert tr.times.in_range_at(local_parse("2022-03-09 00:00").timestamp())
+    assert tr.times.in_range_at(local_parse("2022-03-09 23:59:59").timestamp())
+    assert not tr.times.in_range_at(local_parse("2022-03-10 00:00").timestamp())
+
+
+def test_time_ranges():
+    tr = TimeRangeRule(
+        {
+            # weekdays
+            "days": [0, 1, 2, 3, 4],
+            "exclude": ["2022-03-09"],
+            "time_ranges": [
+                {"time_start": "06:00", "time_end": "10:00"},
+                {"time_start": "09:00", "time_end": "11:00"},
+                {"time_start": "10:00pm", "time_end": "2:00am"},
+            ],
+            "rule_id": "rid",
+        }
+    )
+    expect = {
+        # monday, overlapping ranges
+        "2022-03-07 05:59": False,
+        "2022-03-07 06:00": True,
+        "2022-03-07 10:30": True,
+        "2022-03-07 11:00": True,
+        "2022-03-07 11:01": False,
+        # overnight, from monday
+        "2022-03-07 22:00": True,
+        "2022-03-08 01:00": True,
+        "2022-03-08 02:00": True,
+        "2022-03-08 02:01": False,
+        # wednesday is excluded, the night before isn't
+        "2022-03-09 01:00": True,
+        "2022-03-09 07:00": False,
+        "2022-03-09 23:00": False,
+        "2022-03-10 01:00": False,
+        # friday night runs into saturday, but no later
+        "2022-03-12 01:00": True,
+        "2022-03-12 07:00": False,
+        "2022-03-12 23:00": False,
+        "2022-03-13 01:00": False,
+    }
+    for when, res in expect.items():
+        assert tr.times.in_range(local_parse(when)) == res, when
+        assert tr.times.in_range_at(local_parse(when).timestamp()) == res, when
+
+    # one overnight range
+    tr = TimeRangeRule({"time_start": "20:00", "time_end": "08:00", "rule_id": "rid"})
+    assert tr.times.in_range(local_parse("2022-03-07 07:00"))
+    assert not tr.times.in_range(local_parse("2022-03-07 12:00"))
+
+
+def test_date_set():
+    days = [date(2021, 12, 31), date(2022, 1, 1), date(2022, 3, 7), date(2030, 1, 1)]
+    dates = DateSet(days + days[:1])
+    assert len(dates) == 4
+    assert list(dates) == days
+    assert all(day in dates for day in days)
+    assert date(2022, 3, 8) not in dates
+    assert date(2021, 12, 30) not in dates
+    assert date(2030, 1, 2) not in dates
+    assert date(2022, 1, 1) not in DateSet([])
+
+
+HOLIDAYS_ICS = """BEGIN:VCALENDAR
+VERSION:2.0
+BEGIN:VEVENT
+DTSTART;VALUE=DATE:20220307
+DTEND;VALUE=DATE:20220308
+SUMMARY:One day
+END:VEVENT
+BEGIN:VEVENT
+DTSTART;VALUE=DATE:20220314
+DTEND;VALUE=DATE:20220317
+SUMMARY:Three days
+END:VEVENT
+BEGIN:VEVENT
+DTSTART:20220321T090000Z
+DTEND:20220321T170000Z
+SUMMARY:Times
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+def test_calendar_files(tmp_path):
+    ics = tmp_path / "holidays.ics"
+    ics.write_text(HOLIDAYS_ICS)
+    extra = tmp_path / "extra.txt"
+    extra.write_text("# weekend work\n2022-03-12\n\n2022-03-16\n")
+
+    tr = TimeRangeRule(
+        {
+            # not saturday
+            "days": [0, 1, 2, 3, 4, 6],
+            "exclude_file": str(ics),
+            "include_file": [str(extra)],
+            "rule_id": "rid",
+        }
+    )
+    expect = {
+        "2022-03-07": False,
+        "2022-03-08": True,
+        "2022-03-12": True,
+        "2022-03-13": True,
+        "2022-03-14": False,
+        "2022-03-15": False,
+        # excluded, even though included
+        "2022-03-16": False,
+        "2022-03-17": True,
+        "2022-03-21": False,
+        "2022-03-22": True,
+    }
+    for when, res in expect.items():
+        assert tr.times.in_range(local_parse(when + " 12:00")) == res, when
+
+    # shared between rules, until changed
+    tr2 = TimeRangeRule({"exclude_file": str(ics), "rule_id": "rid"})
+    assert tr2.times.exclude_calendars[0] is tr.times.exclude_calendars[0]
+    ics.write_text(HOLIDAYS_ICS.replace("20220307", "20220301"))
+    os.utime(ics, (0, 0))
+    tr3 = TimeRangeRule({"exclude_file": str(ics), "rule_id": "rid"})
+    assert date(2022, 3, 1) in tr3.times.exclude_calendars[0]
+    assert date(2022, 3, 1) not in tr.times.exclude_calendars[0]
+
+
+RECURRING_ICS = """BEGIN:VCALENDAR
+VERSION:2.0
+BEGIN:VTIMEZONE
+TZID:America/New_York
+BEGIN:DAYLIGHT
+DTSTART:20070311T020000
+RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=2SU
+TZOFFSETFROM:-0500
+TZOFFSETTO:-0400
+END:DAYLIGHT
+BEGIN:STANDARD
+DTSTART:20071104T020000
+RRULE:FREQ=YEARLY;BYMONTH=11;BYDAY=1SU
+TZOFFSETFROM:-0400
+TZOFFSETTO:-0500
+END:STANDARD
+END:VTIMEZONE
+BEGIN:VEVENT
+DTSTART;TZID=America/New_York:20220704T090000
+SUMMARY:Once
+END:VEVENT
+BEGIN:VEVENT
+DTSTART;VALUE=DATE:20201225
+DTEND;VALUE=DATE:20201226
+RRULE:FREQ=YEARLY
+EXDATE;VALUE=DATE:20211225
+SUMMARY:Christmas, every year
+  but 2021
+END:VEVENT
+BEGIN:VEVENT
+DTSTART:20220301T090000Z
+DTEND:20220302T170000Z
+RRULE:FREQ=WEEKLY;BYDAY=TU;UNTIL=20220315T
+ 090000Z
+RDATE;VALUE=DATE:20220401
+SUMMARY:Two days weekly, until the 15th, and once in April
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+def test_calendar_recurring(tmp_path):
+    ics = tmp_path / "recurring.ics"
+    ics.write_text(RECURRING_ICS)
+    dates = load_calendar(str(ics))
+    assert date(2020, 12, 25) in dates
+    assert date(2021, 12, 25) not in dates
+    assert date(2022, 12, 25) in dates
+    # without an end, for years ahead
+    assert date(date.today().year + 5, 12, 25) in dates
+    assert date(2020, 12, 26) not in dates
+    assert date(2022, 7, 4) in dates
+    # not the time zone's dst changes
+    assert date(2022, 3, 13) not in dates
+    assert date(2022, 11, 6) not in dates
+
+    weekly = {date(2022, 3, day) for day in (1, 2, 8, 9, 15, 16)}
+    weekly |= {date(2022, 4, 1), date(2022, 4, 2)}
+    weekly.add(date(2022, 7, 4))
+    assert {
+        day for day in dates if date(2022, 2, 1) <= day < date(2022, 8, 1)
+    } == weekly
+
+    ics.write_text(RECURRING_ICS.replace("FREQ=YEARLY", "FREQ=SOMETIMES"))
+    os.utime(ics, (0, 0))
+    with pytest.raises(ValueError, match="RRULE"):
+        load_calendar(str(ics))
+
+
 def test_tz_default():
     tr = TimeRangeRule({"time_start": "09:00", "time_end": "17:00", "rule_id": "rid"})
     assert tr.times.time_of_day_start.tzinfo
     assert tr.times.time_of_day_end.tzinfo
 
 
+@pytest.mark.filterwarnings("ignore:tzname")
+@pytest.mark.parametrize(
+    "text",
+    [
+        "09:00",
+        "9:00am",
+        "12:00am",
+        "12:30 PM",
+        "9:15 p.m.",
+        "21:00:15",
+        "09:00Z",
+        "09:00 UTC",
+        "09:00+04:00",
+        "09:00-0930",
+        "13:00pm",
+        "09:00 EST",
+    ],
+)
+def test_str_to_time(text):
+    try:
+        expect = dateutil.parser.parse(text).timetz()
+    except ValueError:
+        expect = None
+    if expect and not expect.tzinfo:
+        expect = expect.replace(tzinfo=LOCAL_TIMEZONE)
+    if expect is None:
+        with pytest.raises(ValueError):
+            TimeArgs.str_to_time(text)
+        return
+    got = TimeArgs.str_to_time(text)
+    assert got.replace(tzinfo=None) == expect.replace(tzinfo=None)
+    day = datetime(2022, 3, 7)
+    assert got.tzinfo.utcoffset(day) == expect.tzinfo.utcoffset(day)
+
+
+def test_str_to_time_fast():
+    _parse_time.cache_clear()
+    with unittest.mock.patch("dateutil.parser.parse", side_effect=AssertionError):
+        assert TimeArgs.str_to_time("9:00pm").hour == 21
+        assert TimeArgs.strs_to_dates(["2022-03-07", "20220308"]) == [
+            date(2022, 3, 7),
+            date(2022, 3, 8),
+        ]
+    assert TimeArgs.strs_to_dates(["March 9, 2022"]) == [date(2022, 3, 9)]
+    # repeated times are cached
+    assert TimeArgs.str_to_time("9:00pm") is TimeArgs.str_to_time("9:00pm")
+    assert _parse_time.cache_info().hits
+
+
 def test_day_only():
     tr = TimeRangeRule(
         {
@@ -128,11 +407,14 @@ def test_assertions():
         TimeRangeRule(
             {
                 "time_end": "09:00+04:00",
-                "time_start": "17:00+04:00",
+                "time_start": "09:00+04:00",
                 "rule_id": "rid",
             }
         )
 
+    with pytest.raises(Exception):
+        TimeRangeRule({"time_ranges": [{"time_start": "09:00"}], "rule_id": "rid"})
+
     with pytest.raises(Exception):
         TimeRangeRule(
             {